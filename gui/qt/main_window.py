@@ -324,6 +324,7 @@ class ElectrumWindow(QMainWindow):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
+                self.wallet.storage.flush()
                 shutil.copy2(path, new_path)
                 QMessageBox.information(None,"Wallet backup created", _("A copy of your wallet file was created in")+" '%s'" % str(new_path))
             except (IOError, os.error), reason:
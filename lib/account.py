@@ -30,6 +30,17 @@ class Account(object):
         # addresses will not be stored on disk
         self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
         self.change_addresses    = map(self.pubkeys_to_address, self.change_pubkeys)
+        self.build_index()
+
+    def build_index(self):
+        '''address -> (for_change, n), for constant time lookups'''
+        self.address_index = {}
+        for for_change in [1, 0]:
+            for n, address in enumerate(self.get_addresses(for_change)):
+                self.address_index[address] = (for_change, n)
+
+    def get_address_index(self, address):
+        return self.address_index.get(address)
 
     def dump(self):
         return {'receiving':self.receiving_pubkeys, 'change':self.change_pubkeys}
@@ -52,16 +63,25 @@ class Account(object):
     def derive_pubkeys(self, for_change, n):
         pass
 
-    def create_new_address(self, for_change):
+    def derive_range(self, for_change, start, count):
+        return [self.derive_pubkeys(for_change, n) for n in range(start, start + count)]
+
+    def create_new_addresses(self, for_change, count):
         pubkeys_list = self.change_pubkeys if for_change else self.receiving_pubkeys
         addr_list = self.change_addresses if for_change else self.receiving_addresses
-        n = len(pubkeys_list)
-        pubkeys = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(pubkeys)
-        pubkeys_list.append(pubkeys)
-        addr_list.append(address)
-        print_msg(address)
-        return address
+        start = len(pubkeys_list)
+        out = []
+        for n, pubkeys in enumerate(self.derive_range(for_change, start, count), start):
+            address = self.pubkeys_to_address(pubkeys)
+            pubkeys_list.append(pubkeys)
+            addr_list.append(address)
+            self.address_index.setdefault(address, (for_change, n))
+            print_msg(address)
+            out.append(address)
+        return out
+
+    def create_new_address(self, for_change):
+        return self.create_new_addresses(for_change, 1)[0]
 
     def pubkeys_to_address(self, pubkey):
         return public_key_to_bc_address(pubkey.decode('hex'))
@@ -79,14 +99,16 @@ class Account(object):
         limit = wallet.gap_limit_for_change if for_change else wallet.gap_limit
         while True:
             addresses = self.get_addresses(for_change)
-            if len(addresses) < limit:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
-                continue
-            if map( lambda a: wallet.address_is_old(a), addresses[-limit:] ) == limit*[False]:
+            # count the unused addresses at the end of the sequence, and
+            # derive the missing ones of the gap in one go
+            unused = 0
+            for address in reversed(addresses[-limit:]):
+                if wallet.address_is_old(address):
+                    break
+                unused += 1
+            if unused >= limit:
                 break
-            else:
-                address = self.create_new_address(for_change)
+            for address in self.create_new_addresses(for_change, limit - unused):
                 wallet.add_address(address)
 
     def synchronize(self, wallet):
@@ -99,6 +121,7 @@ class PendingAccount(Account):
         self.pending_address = v['address']
         self.change_pubkeys = []
         self.receiving_pubkeys = [ v['pubkey'] ]
+        self.build_index()
 
     def synchronize(self, wallet):
         return
@@ -127,6 +150,7 @@ class PendingAccount(Account):
 class ImportedAccount(Account):
     def __init__(self, d):
         self.keypairs = d['imported']
+        self.build_index()
 
     def synchronize(self, wallet):
         return
@@ -160,9 +184,11 @@ class ImportedAccount(Account):
     def add(self, address, pubkey, privkey, password):
         from wallet import pw_encode
         self.keypairs[address] = (pubkey, pw_encode(privkey, password ))
+        self.build_index()
 
     def remove(self, address):
         self.keypairs.pop(address)
+        self.build_index()
 
     def dump(self):
         return {'imported':self.keypairs}
@@ -211,12 +237,10 @@ class OldAccount(Account):
 
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
-        curve = SECP256k1
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string( mpk, curve = SECP256k1 )
-        pubkey_point = master_public_key.pubkey.point + z*curve.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
-        return '04' + public_key2.to_string().encode('hex')
+        master_public_key = (string_to_number(mpk[0:32]), string_to_number(mpk[32:64]))
+        x, y = get_ec_backend().add_mul_generator(master_public_key, z)
+        return '04' + '%064x' % x + '%064x' % y
 
     def derive_pubkeys(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
@@ -275,13 +299,17 @@ class OldAccount(Account):
         return mpk, s
 
 
+# (xpub, for_change) -> (cK, c), shared by all accounts and by the
+# x_pubkeys of transactions
+branch_nodes = {}
+MAX_BRANCH_NODES = 1000
+
+
 class BIP32_Account(Account):
 
     def __init__(self, v):
         Account.__init__(self, v)
         self.xpub = v['xpub']
-        self.xpub_receive = None
-        self.xpub_change = None
 
     def dump(self):
         d = Account.dump(self)
@@ -296,13 +324,30 @@ class BIP32_Account(Account):
     def get_master_pubkeys(self):
         return [self.xpub]
 
+    @classmethod
+    def get_branch_node(self, xpub, for_change):
+        '''Returns (cK, c) of xpub/for_change.'''
+        key = (xpub, for_change)
+        node = branch_nodes.get(key)
+        if node is None:
+            _, _, _, c, cK = deserialize_xkey(xpub)
+            node = CKD_pub(cK, c, for_change)
+            if len(branch_nodes) >= MAX_BRANCH_NODES:
+                branch_nodes.clear()
+            branch_nodes[key] = node
+        return node
+
     @classmethod
     def derive_pubkey_from_xpub(self, xpub, for_change, n):
-        _, _, _, c, cK = deserialize_xkey(xpub)
-        for i in [for_change, n]:
-            cK, c = CKD_pub(cK, c, i)
+        cK, c = self.get_branch_node(xpub, for_change)
+        cK, c = CKD_pub(cK, c, n)
         return cK.encode('hex')
 
+    @classmethod
+    def derive_range_from_xpub(self, xpub, for_change, start, count):
+        cK, c = self.get_branch_node(xpub, for_change)
+        return [CKD_pub(cK, c, n)[0].encode('hex') for n in range(start, start + count)]
+
     def get_pubkey_from_xpub(self, xpub, for_change, n):
         xpubs = self.get_master_pubkeys()
         i = xpubs.index(xpub)
@@ -310,17 +355,10 @@ class BIP32_Account(Account):
         return pubkeys[i]
 
     def derive_pubkeys(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        _, _, _, c, cK = deserialize_xkey(xpub)
-        cK, c = CKD_pub(cK, c, n)
-        result = cK.encode('hex')
-        return result
+        return self.derive_pubkey_from_xpub(self.xpub, for_change, n)
+
+    def derive_range(self, for_change, start, count):
+        return self.derive_range_from_xpub(self.xpub, for_change, start, count)
 
 
     def get_private_key(self, sequence, wallet, password):
@@ -385,6 +423,10 @@ class Multisig_Account(BIP32_Account):
     def derive_pubkeys(self, for_change, n):
         return map(lambda x: self.derive_pubkey_from_xpub(x, for_change, n), self.get_master_pubkeys())
 
+    def derive_range(self, for_change, start, count):
+        columns = map(lambda x: self.derive_range_from_xpub(x, for_change, start, count), self.get_master_pubkeys())
+        return map(list, zip(*columns))
+
     def redeem_script(self, for_change, n):
         pubkeys = self.get_pubkeys(for_change, n)
         return Transaction.multisig_script(sorted(pubkeys), self.m)
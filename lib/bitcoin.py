@@ -23,7 +23,7 @@ import re
 import hmac
 
 import version
-from util import print_error, InvalidPassword
+from util import print_error, InvalidPassword, LRUCache
 
 import ecdsa
 import aes
@@ -206,9 +206,18 @@ def hash_160(public_key):
         return md.digest()
 
 
+# pubkey -> address and address -> (addrtype, hash160), since the
+# same few addresses are converted over and over
+pubkey_address_cache = LRUCache(10000)
+address_hash_cache = LRUCache(10000)
+
 def public_key_to_bc_address(public_key):
-    h160 = hash_160(public_key)
-    return hash_160_to_bc_address(h160)
+    addr = pubkey_address_cache.get(public_key)
+    if addr is None:
+        h160 = hash_160(public_key)
+        addr = hash_160_to_bc_address(h160)
+        pubkey_address_cache.put(public_key, addr)
+    return addr
 
 def hash_160_to_bc_address(h160, addrtype = 30):
     vh160 = chr(addrtype) + h160
@@ -217,8 +226,12 @@ def hash_160_to_bc_address(h160, addrtype = 30):
     return base_encode(addr, base=58)
 
 def bc_address_to_hash_160(addr):
-    bytes = base_decode(addr, 25, base=58)
-    return ord(bytes[0]), bytes[1:21]
+    out = address_hash_cache.get(addr)
+    if out is None:
+        bytes = base_decode(addr, 25, base=58)
+        out = ord(bytes[0]), bytes[1:21]
+        address_hash_cache.put(addr, out)
+    return out
 
 
 __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
@@ -234,22 +247,16 @@ def base_encode(v, base):
         chars = __b58chars
     elif base == 43:
         chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-    result = ''
+    long_value = int(v.encode('hex'), 16) if v else 0
+    result = []
     while long_value >= base:
-        div, mod = divmod(long_value, base)
-        result = chars[mod] + result
-        long_value = div
-    result = chars[long_value] + result
+        long_value, mod = divmod(long_value, base)
+        result.append(chars[mod])
+    result.append(chars[long_value])
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
-    return (chars[0]*nPad) + result
+    nPad = len(v) - len(v.lstrip('\0'))
+    return (chars[0]*nPad) + ''.join(reversed(result))
 
 
 def base_decode(v, length, base):
@@ -259,18 +266,13 @@ def base_decode(v, length, base):
     elif base == 43:
         chars = __b43chars
     long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += chars.find(c) * (base**i)
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
-    nPad = 0
     for c in v:
-        if c == chars[0]: nPad += 1
-        else: break
+        long_value = long_value * base + chars.find(c)
+    if long_value < 0:
+        raise ValueError("invalid base%d string" % base)
+    h = '%x' % long_value
+    result = (('0' if len(h) % 2 else '') + h).decode('hex')
+    nPad = len(v) - len(v.lstrip(chars[0]))
     result = chr(0)*nPad + result
     if length is not None and len(result) != length:
         return None
@@ -467,11 +469,167 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         return klass.from_public_point( Q, curve )
 
 
+def xy_to_point(xy):
+    return Point(curve_secp256k1, xy[0], xy[1], generator_secp256k1.order())
+
+
+def rfc6979_nonces(secret, h):
+    """Candidate nonces of RFC 6979 with HMAC-SHA256, for the digest h"""
+    order = generator_secp256k1.order()
+    x = number_to_string(secret, order)
+    h1 = number_to_string(string_to_number(h) % order, order)
+    V = '\x01' * 32
+    K = '\x00' * 32
+    K = hmac.new(K, V + '\x00' + x + h1, hashlib.sha256).digest()
+    V = hmac.new(K, V, hashlib.sha256).digest()
+    K = hmac.new(K, V + '\x01' + x + h1, hashlib.sha256).digest()
+    V = hmac.new(K, V, hashlib.sha256).digest()
+    while True:
+        V = hmac.new(K, V, hashlib.sha256).digest()
+        k = string_to_number(V)
+        if 1 <= k < order:
+            yield k
+        K = hmac.new(K, V + '\x00', hashlib.sha256).digest()
+        V = hmac.new(K, V, hashlib.sha256).digest()
+
+
+class ECBackend(object):
+    """Point operations on secp256k1, with points as (x, y) tuples.
+
+    This is the reference implementation, on top of python-ecdsa.  Other
+    backends must give the same results; see lib/tests/test_ec_backend.py.
+    Signing only needs mul_generator: sign_digest computes the signatures
+    of python-ecdsa's sign_digest_deterministic (RFC 6979 nonces, S not
+    normalized), so every backend produces the same transactions.
+    """
+
+    name = 'python-ecdsa'
+
+    def mul_generator(self, k):
+        """k*G"""
+        P = generator_secp256k1 * k
+        return P.x(), P.y()
+
+    def add_mul_generator(self, point, k):
+        """point + k*G"""
+        P = generator_secp256k1 * k + xy_to_point(point)
+        return P.x(), P.y()
+
+    def mul_point(self, point, k):
+        """k*point"""
+        P = xy_to_point(point) * k
+        return P.x(), P.y()
+
+    def recover_pubkey(self, sig, recid, h):
+        """Public key of the 64 bytes signature sig (r, s) of digest h"""
+        public_key = MyVerifyingKey.from_signature(sig, recid, h, curve = SECP256k1)
+        P = public_key.pubkey.point
+        return P.x(), P.y()
+
+    def sign_digest(self, secret, h):
+        """Signature (r, s) of the 32 bytes digest h"""
+        order = generator_secp256k1.order()
+        z = string_to_number(h)
+        for k in rfc6979_nonces(secret, h):
+            r = self.mul_generator(k)[0] % order
+            s = ecdsa.numbertheory.inverse_mod(k, order) * (z + r * secret) % order
+            if r and s:
+                return r, s
+
+    def verify_digest(self, point, sig, h):
+        """Check the 64 bytes signature sig (r, s) of digest h"""
+        public_key = ecdsa.VerifyingKey.from_public_point(xy_to_point(point), curve = SECP256k1)
+        try:
+            return public_key.verify_digest(sig, h, sigdecode = ecdsa.util.sigdecode_string)
+        except ecdsa.BadSignatureError:
+            return False
+
+
+class CoincurveBackend(ECBackend):
+    """libsecp256k1, through the coincurve bindings"""
+
+    name = 'coincurve'
+
+    def __init__(self):
+        import coincurve
+        self.PublicKey = coincurve.PublicKey
+
+    def scalar(self, k):
+        return number_to_string(k % generator_secp256k1.order(), generator_secp256k1.order())
+
+    def mul_generator(self, k):
+        return self.PublicKey.from_secret(self.scalar(k)).point()
+
+    def add_mul_generator(self, point, k):
+        return self.PublicKey.from_point(*point).add(self.scalar(k)).point()
+
+    def mul_point(self, point, k):
+        return self.PublicKey.from_point(*point).multiply(self.scalar(k)).point()
+
+    def recover_pubkey(self, sig, recid, h):
+        return self.PublicKey.from_signature_and_message(sig + chr(recid), h, hasher=None).point()
+
+    def verify_digest(self, point, sig, h):
+        # libsecp256k1 only accepts low S signatures; (r, -s) is valid
+        # whenever (r, s) is
+        order = generator_secp256k1.order()
+        r, s = ecdsa.util.sigdecode_string(sig, order)
+        s = min(s, order - s)
+        der = ecdsa.util.sigencode_der(r, s, order)
+        try:
+            return self.PublicKey.from_point(*point).verify(der, h, hasher=None)
+        except Exception:
+            return False
+
+
+class TableBackend(ECBackend):
+    """Pure Python, with the precomputed multiples of G of ecmult.py for
+    k*G and P + k*G"""
+
+    name = 'python-table'
+
+    def __init__(self):
+        import ecmult
+        self.table = ecmult.get_generator_table()
+
+    def mul_generator(self, k):
+        return self.table.mul_affine(k)
+
+    def add_mul_generator(self, point, k):
+        return self.table.add_mul(point, k)
+
+
+# the first backend that can be loaded is used
+EC_BACKENDS = [CoincurveBackend, TableBackend, ECBackend]
+ec_backend = None
+
+def get_ec_backends():
+    out = []
+    for klass in EC_BACKENDS:
+        try:
+            out.append(klass())
+        except ImportError:
+            continue
+    return out
+
+def get_ec_backend():
+    global ec_backend
+    if ec_backend is None:
+        ec_backend = get_ec_backends()[0]
+        print_error("EC backend:", ec_backend.name)
+    return ec_backend
+
+def set_ec_backend(backend):
+    global ec_backend
+    ec_backend = backend
+
+
 class EC_KEY(object):
 
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
+        point = xy_to_point(get_ec_backend().mul_generator(secret))
+        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, point )
         self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
 
@@ -479,10 +637,10 @@ class EC_KEY(object):
         return point_to_ser(self.pubkey.point, compressed).encode('hex')
 
     def sign(self, msg_hash):
-        private_key = ecdsa.SigningKey.from_secret_exponent(self.secret, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
-        assert public_key.verify_digest(signature, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
+        r, s = get_ec_backend().sign_digest(self.secret, msg_hash)
+        signature = ecdsa.util.sigencode_string(r, s, generator_secp256k1.order())
+        P = self.pubkey.point
+        assert get_ec_backend().verify_digest((P.x(), P.y()), signature, msg_hash)
         return signature
 
     def sign_message(self, message, compressed, address):
@@ -512,10 +670,12 @@ class EC_KEY(object):
         recid = nV - 27
 
         h = Hash(msg_magic(message))
-        public_key = MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1)
+        backend = get_ec_backend()
+        point = backend.recover_pubkey(sig[1:], recid, h)
         # check public key
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
-        pubkey = point_to_ser(public_key.pubkey.point, compressed)
+        if not backend.verify_digest(point, sig[1:], h):
+            raise Exception("Bad signature")
+        pubkey = point_to_ser(xy_to_point(point), compressed)
         # check that we get the original signing address
         addr = public_key_to_bc_address(pubkey)
         if address != addr:
@@ -533,7 +693,7 @@ class EC_KEY(object):
 
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        ecdh_key = point_to_ser(xy_to_point(get_ec_backend().mul_point((pk.x(), pk.y()), ephemeral.privkey.secret_multiplier)))
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
@@ -567,7 +727,8 @@ class EC_KEY(object):
         if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
 
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
+        P = (ephemeral_pubkey.x(), ephemeral_pubkey.y())
+        ecdh_key = point_to_ser(xy_to_point(get_ec_backend().mul_point(P, self.privkey.secret_multiplier)))
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
@@ -584,10 +745,9 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    public_key = EC_KEY(secret).pubkey
+    K = point_to_ser(public_key.point, False)[1:]
+    K_compressed = GetPubKey(public_key,True)
     return K, K_compressed
 
 
@@ -631,11 +791,10 @@ def _CKD_pub(cK, c, s):
     from ecdsa.util import string_to_number, number_to_string
     order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    P = ser_to_point(cK)
+    pubkey_point = get_ec_backend().add_mul_generator((P.x(), P.y()), string_to_number(I[0:32]))
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
+    cK_n = point_to_ser(xy_to_point(pubkey_point), True)
     return cK_n, c_n
 
 
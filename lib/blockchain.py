@@ -18,15 +18,251 @@
 
 
 import os
+import sys
+import mmap
+import httplib
+import struct
+import threading
+import multiprocessing
+from array import array
 import util
 from bitcoin import *
 from util import print_error, print_msg
 
 try:		
     from ltc_scrypt import getPoWHash
+    getPoWHashes = lambda headers: map(getPoWHash, headers)
 except ImportError:		
     print_msg("Warning: ltc_scrypt not available, using fallback")		
     from scrypt import scrypt_1024_1_1_80 as getPoWHash
+    from scrypt import scrypt_1024_1_1_80_batch as getPoWHashes
+
+
+# Trusted chunks, as (chunk index, hash of the last header, bits, chain
+# digest).  The chain digest pins every header from the genesis block to
+# the end of the chunk: it is folded over the chunks as
+# Hash(digest of the chunks below + Hash(chunk)), starting from 32 zero
+# bytes.  Chunks up to the newest checkpoint are checked against it
+# instead of verifying proof of work; a digest is needed because headers
+# are linked by their scrypt hash, which is what we want to avoid
+# computing.  No entries ship yet: they must come from a headers file
+# whose proof of work was verified, with scripts/checkpoints, and can be
+# given with the 'checkpoints' config key, as a list of such entries.
+# The newest checkpoint vouches for every chunk below it; intermediate
+# ones only let the verified prefix be saved sooner.
+CHECKPOINTS = [
+]
+
+CHUNK_SIZE = 2016*80
+# chunks written at once when pending chunks are saved
+SAVE_BATCH = 16
+
+
+def pow_hashes(data):
+    '''PoW hashes of the concatenated 80-byte headers in data.  Module
+    level so that it can be sent to worker processes.'''
+    return getPoWHashes([data[i:i+80] for i in xrange(0, len(data), 80)])
+
+
+class HeaderStore(object):
+    '''Read-only memory map of the blockchain_headers file.
+
+    Headers are served from the mapping without reopening the file.
+    Timestamps and bits are kept in compact arrays indexed by height,
+    filled lazily from the mapping.  Block hashes are persisted in a side
+    file of 32 bytes per height (zero meaning unknown), written when
+    headers are verified.  Mappings are replaced when the files grow.'''
+
+    def __init__(self, path, hashes_path):
+        self.path = path
+        self.hashes_path = hashes_path
+        self.lock = threading.Lock()
+        self.mm = None
+        self.size = 0
+        self.hmm = None
+        self.hsize = 0
+        self.timestamps = array('I')
+        self.bits = array('I')
+        self.remap()
+        self.remap_hashes()
+
+    def remap(self):
+        mm = None
+        size = 0
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            size -= size % 80
+            if size:
+                with open(self.path, 'rb') as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # readers may still hold the old map; it is closed once released
+        self.mm = mm
+        self.size = size
+        self.truncate(size/80)
+
+    def remap_hashes(self):
+        hmm = None
+        hsize = 0
+        if os.path.exists(self.hashes_path):
+            hsize = os.path.getsize(self.hashes_path)
+            hsize -= hsize % 32
+            if hsize:
+                with open(self.hashes_path, 'rb') as f:
+                    hmm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.hmm = hmm
+        self.hsize = hsize
+
+    def count(self):
+        return self.size/80
+
+    def truncate(self, height):
+        '''Forget cached fields from height upwards'''
+        with self.lock:
+            del self.timestamps[height:]
+            del self.bits[height:]
+
+    def invalidate_hashes(self, height):
+        '''Zero the hash index from height upwards.  The file is never
+        shrunk, since readers may still hold a mapping of it.'''
+        with self.lock:
+            if height*32 < self.hsize:
+                with open(self.hashes_path, 'rb+') as f:
+                    f.seek(height*32)
+                    f.write('\0' * (self.hsize - height*32))
+
+    def written(self, height, data, hashes=None):
+        '''Called after data has been written to the file at height.
+        hashes is an optional list of the binary hashes of those headers.'''
+        self.truncate(height)
+        self.invalidate_hashes(height)
+        if (height*80 + len(data) > self.size) or self.mm is None:
+            self.remap()
+        if hashes:
+            self.set_hashes(height, hashes)
+
+    def read_chunk(self, index):
+        '''Raw data of a complete chunk, or None'''
+        mm = self.mm
+        if mm is None or (index+1)*2016 > self.size/80:
+            return None
+        return mm[index*2016*80:(index+1)*2016*80]
+
+    def read(self, height):
+        '''Raw 80-byte header, or None'''
+        mm = self.mm
+        if mm is None or height < 0 or height >= self.size/80:
+            return None
+        return mm[height*80:(height+1)*80]
+
+    def fill(self, height):
+        '''Extend the timestamps and bits arrays up to height'''
+        with self.lock:
+            mm = self.mm
+            start = len(self.timestamps)
+            stop = min(height + 1, self.size/80)
+            # decode whole chunks at a time, 20 words per header
+            while start < stop:
+                end = min(stop, start + 2016)
+                words = array('I', mm[start*80:end*80])
+                if sys.byteorder == 'big':
+                    words.byteswap()
+                self.timestamps.extend(words[17::20])
+                self.bits.extend(words[18::20])
+                start = end
+
+    def timestamp(self, height):
+        if height >= len(self.timestamps):
+            self.fill(height)
+        return self.timestamps[height]
+
+    def get_bits(self, height):
+        if height >= len(self.bits):
+            self.fill(height)
+        return self.bits[height]
+
+    def set_hashes(self, height, hashes):
+        '''Record the binary hashes of consecutive headers from height'''
+        with self.lock:
+            if not os.path.exists(self.hashes_path):
+                open(self.hashes_path, 'wb').close()
+            with open(self.hashes_path, 'rb+') as f:
+                if height*32 > self.hsize:
+                    f.seek(self.hsize)
+                    f.write('\0' * (height*32 - self.hsize))
+                else:
+                    f.seek(height*32)
+                f.write(''.join(hashes))
+            if (height + len(hashes))*32 > self.hsize:
+                self.remap_hashes()
+
+    def get_hash(self, height):
+        '''Binary hash of the header at height, or None if unknown'''
+        hmm = self.hmm
+        if hmm is None or height < 0 or height >= self.size/80 or (height+1)*32 > self.hsize:
+            return None
+        h = hmm[height*32:(height+1)*32]
+        if h != '\0'*32:
+            return h
+
+
+class PendingChunks(object):
+    '''Complete chunks that follow the headers file and wait for a
+    checkpoint.  They are kept in a side file, which starts with the
+    index of its first chunk, so that they take no memory and survive a
+    restart; only the Hash of each chunk is kept in memory.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.start = None
+        self.hashes = []
+
+    def count(self):
+        return len(self.hashes)
+
+    def load(self, start):
+        '''Resume the file if it starts at chunk start, else drop it'''
+        self.start = start
+        self.hashes = []
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+        with f:
+            head = f.read(4)
+            if len(head) == 4 and struct.unpack('<I', head)[0] == start:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if len(data) < CHUNK_SIZE:
+                        break
+                    self.hashes.append(Hash(data))
+        if self.hashes:
+            self.truncate(len(self.hashes))
+        else:
+            self.clear()
+
+    def read(self, k, n=1):
+        '''Data of n chunks from the k-th one'''
+        with open(self.path, 'rb') as f:
+            f.seek(4 + k*CHUNK_SIZE)
+            return f.read(n*CHUNK_SIZE)
+
+    def append(self, data):
+        if not self.hashes:
+            with open(self.path, 'wb') as f:
+                f.write(struct.pack('<I', self.start))
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self.hashes.append(Hash(data))
+
+    def truncate(self, k):
+        del self.hashes[k:]
+        with open(self.path, 'rb+') as f:
+            f.truncate(4 + k*CHUNK_SIZE)
+
+    def clear(self):
+        self.hashes = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 
 class Blockchain():
@@ -36,7 +272,21 @@ class Blockchain():
         self.network = network
         self.headers_url = 'http://electrum-verge.xyz/blockchain_headers'
         self.local_height = 0
+        self.store = HeaderStore(self.path(), self.hashes_path())
         self.set_local_height()
+        self.pool = None
+        # Hashing in a pool of processes is opt-in: the pool is forked
+        # from a process that already runs threads, and frozen builds
+        # need freeze_support.  0 means one worker per CPU.
+        self.num_workers = config.get('verify_workers', 1) or multiprocessing.cpu_count()
+        self.checkpoints = {}
+        for index, last_hash, bits, digest in CHECKPOINTS + config.get('checkpoints', []):
+            self.checkpoints[index] = (last_hash, bits, digest)
+        self.last_checkpoint = max(self.checkpoints) if self.checkpoints else -1
+        # chunks below the newest checkpoint wait here, from the end of
+        # the headers file, until a checkpoint vouches for them
+        self.pending = PendingChunks(self.path() + '.pending')
+        self.digest_cache = (-1, '\0'*32)
 
     def print_error(self, *msg):
         util.print_error("[blockchain]", *msg)
@@ -46,18 +296,40 @@ class Blockchain():
 
     def init(self):
         self.init_headers_file()
+        self.store.remap()
+        self.store.remap_hashes()
         self.set_local_height()
         self.print_error("%d blocks" % self.local_height)
 
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+    def compute_pow_hashes(self, data):
+        '''PoW hashes of consecutive raw headers.  Large batches are split
+        across a pool of verify_workers processes if the config sets it;
+        the result is the same as hashing them serially.'''
+        num = len(data)/80
+        if self.num_workers <= 1 or num < 2*self.num_workers:
+            return pow_hashes(data)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.num_workers)
+        step = (num + self.num_workers - 1)/self.num_workers*80
+        pieces = [data[i:i+step] for i in xrange(0, len(data), step)]
+        return sum(self.pool.map(pow_hashes, pieces), [])
+
     def verify_chain(self, chain):
+        '''Returns the list of binary hashes of the headers in chain, or
+        False if verification failed.'''
         first_header = chain[0]
-        prev_header = self.read_header(first_header.get('block_height') -1)
+        prev_hash = self.get_hash(first_header.get('block_height') -1)
+        hashes = []
 
         for header in chain:
 
             height = header.get('block_height')
 
-            prev_hash = self.hash_header(prev_header)
             bits, target = self.get_target(height/2016, chain)
             _hash = self.pow_hash_header(header)
             try:
@@ -67,9 +339,10 @@ class Blockchain():
             except Exception:
                 return False
 
-            prev_header = header
+            prev_hash = _hash
+            hashes.append(_hash.decode('hex')[::-1])
 
-        return True
+        return hashes
 
 
 
@@ -78,30 +351,111 @@ class Blockchain():
         height = index*2016
         num = len(data)/80
 
+        if index <= self.last_checkpoint:
+            self.verify_trusted_chunk(index, data)
+            return
+
         if index == 0:
-            previous_hash = ("0"*64)
+            previous_hash = '\0'*32
         else:
-            prev_header = self.read_header(index*2016-1)
-            if prev_header is None: raise
-            previous_hash = self.hash_header(prev_header)
+            previous_hash = self.store.get_hash(index*2016-1) or self.compute_hash(index*2016-1)
+            if previous_hash is None: raise
 
         bits, target = self.get_target(index)
+        hashes = self.compute_pow_hashes(data)
 
         for i in range(num):
             height = index*2016 + i
             raw_header = data[i*80:(i+1)*80]
-            header = self.header_from_string(raw_header)
-            _hash = self.pow_hash_header(header)
-            assert previous_hash == header.get('prev_block_hash')
-            assert bits == header.get('bits')
-            assert int('0x'+_hash,16) < target
+            _hash = hashes[i]
+            assert previous_hash == raw_header[4:36]
+            assert bits == struct.unpack_from('<I', raw_header, 72)[0]
+            assert int(_hash[::-1].encode('hex'), 16) < target
 
-            previous_header = header
             previous_hash = _hash
 
-        self.save_chunk(index, data)
+        self.save_chunk(index, data, hashes)
         self.print_error("validated chunk %d to height %d" % (index, height))
 
+    def get_pending(self):
+        '''The pending chunks, which start at the end of the headers
+        file'''
+        first = self.store.count()/2016
+        if self.pending.start != first:
+            self.pending.load(first)
+        return self.pending
+
+    def next_chunk(self):
+        '''Index of the first chunk that is neither saved nor pending'''
+        pending = self.get_pending()
+        return pending.start + pending.count()
+
+    def verify_trusted_chunk(self, index, data):
+        '''Chunks up to the newest checkpoint are checked for linkage to
+        the saved headers, and wait in the pending file until a
+        checkpointed chunk arrives.  The chain digest of that checkpoint
+        pins all of them; they are then saved in batches.  Header hashes
+        are taken from the prev_block_hash of each successor, and from
+        the checkpoint for the last header.  No proof of work is
+        computed.'''
+        assert len(data) == CHUNK_SIZE
+        first = self.store.count()/2016
+        if index < first:
+            # already saved
+            assert data == self.store.read_chunk(index)
+            return
+        pending = self.get_pending()
+        k = index - first
+        assert k <= pending.count()
+        if k < pending.count():
+            if pending.read(k) == data:
+                return
+            pending.truncate(k)
+        if k == 0:
+            if index == 0:
+                previous_hash = '\0'*32
+            else:
+                previous_hash = self.store.get_hash(index*2016-1) or self.compute_hash(index*2016-1)
+            assert data[4:36] == previous_hash
+        pending.append(data)
+        if index not in self.checkpoints:
+            return
+        last_hash, bits, digest = self.checkpoints[index]
+        chain_digest = self.chain_digest(first - 1)
+        for h in pending.hashes:
+            chain_digest = Hash(chain_digest + h)
+        if chain_digest.encode('hex') != digest:
+            pending.clear()
+            raise Exception("chunks %d to %d do not match checkpoint" % (first, index))
+        num = pending.count()
+        for k in xrange(0, num, SAVE_BATCH):
+            n = min(SAVE_BATCH, num - k)
+            data = pending.read(k, n)
+            hashes = [data[i+4:i+36] for i in xrange(80, len(data), 80)]
+            if k + n < num:
+                hashes.append(pending.read(k + n)[4:36])
+            else:
+                hashes.append(last_hash.decode('hex')[::-1])
+            self.save_chunk(first + k, data, hashes)
+        pending.clear()
+        self.digest_cache = (index, chain_digest)
+        self.print_error("checkpointed chunks %d to %d" % (first, index))
+
+    def chain_digest(self, index):
+        '''Chain digest of the saved chunks up to index'''
+        start, digest = self.digest_cache
+        if start > index:
+            start, digest = -1, '\0'*32
+        for i in xrange(start + 1, index + 1):
+            digest = Hash(digest + Hash(self.store.read_chunk(i)))
+        self.digest_cache = (index, digest)
+        return digest
+
+    def get_checkpoint(self, index):
+        '''Checkpoint entry for a locally verified chunk'''
+        return [index, self.get_hash((index+1)*2016 - 1), self.get_target(index)[0],
+                self.chain_digest(index).encode('hex')]
+
 
 
     def header_to_string(self, res):
@@ -115,14 +469,14 @@ class Blockchain():
 
 
     def header_from_string(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
+        version, prev_hash, merkle_root, timestamp, bits, nonce = struct.unpack('<I32s32sIII', s)
         h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
+        h['version'] = version
+        h['prev_block_hash'] = hash_encode(prev_hash)
+        h['merkle_root'] = hash_encode(merkle_root)
+        h['timestamp'] = timestamp
+        h['bits'] = bits
+        h['nonce'] = nonce
         return h
 
     def hash_header(self, header):
@@ -131,59 +485,133 @@ class Blockchain():
     def pow_hash_header(self, header):		
         return rev_hex(getPoWHash(self.header_to_string(header).decode('hex')).encode('hex'))
 
+    def get_hash(self, height):
+        '''Hex hash of the header at height, as found in the
+        prev_block_hash field of its successor.'''
+        if height == -1:
+            return "0"*64
+        h = self.store.get_hash(height) or self.compute_hash(height)
+        if h is not None:
+            return h[::-1].encode('hex')
+
+    def compute_hash(self, height):
+        raw = self.store.read(height)
+        if raw is None:
+            return None
+        h = getPoWHash(raw)
+        self.store.set_hashes(height, [h])
+        return h
+
     def path(self):
         return os.path.join(self.config.path, 'blockchain_headers')
 
+    def hashes_path(self):
+        return os.path.join(self.config.path, 'blockchain_hashes')
+
     def init_headers_file(self):
+        '''Bootstrap blockchain_headers from headers_url.  The download is
+        verified chunk by chunk as it streams, so an interrupted download
+        leaves a usable prefix; it is resumed on the next start for as long
+        as the .bootstrap marker file exists.'''
         filename = self.path()
-        if os.path.exists(filename):
+        marker = filename + '.bootstrap'
+        if os.path.exists(filename) and not os.path.exists(marker):
             return
+        if not os.path.exists(filename):
+            open(filename, 'wb+').close()
+        open(marker, 'wb').close()
+        self.store.remap()
+        self.set_local_height()
         try:
-            import urllib, socket
-            socket.setdefaulttimeout(30)
-            self.print_error("downloading ", self.headers_url )
-            urllib.urlretrieve(self.headers_url, filename)
+            self.download_headers()
             self.print_error("done.")
+        except (IOError, httplib.HTTPException) as e:
+            self.print_error("download interrupted:", e)
+            return
         except Exception:
-            self.print_error( "download failed. creating file", filename )
-            open(filename,'wb+').close()
+            self.print_error("verification of downloaded headers failed")
+        os.remove(marker)
+
+    def download_headers(self):
+        import urllib2
+        chunk_size = CHUNK_SIZE
+        index = self.next_chunk()
+        start = index * chunk_size
+        self.print_error("downloading", self.headers_url, "from byte", start)
+        request = urllib2.Request(self.headers_url)
+        if start:
+            request.add_header('Range', 'bytes=%d-' % start)
+        f = urllib2.urlopen(request, timeout=30)
+        try:
+            length = f.info().getheader('Content-Length')
+            if start and f.getcode() != 206:
+                # The server ignored the range, skip what we have
+                self.read_fully(f, start)
+                if length is not None:
+                    length = int(length) - start
+            remaining = int(length) if length is not None else None
+            while True:
+                data = self.read_fully(f, chunk_size)
+                if remaining is not None:
+                    remaining -= len(data)
+                    if len(data) < chunk_size and remaining > 0:
+                        raise IOError("connection closed with %d bytes left" % remaining)
+                data = data[:len(data) - len(data) % 80]
+                if not data:
+                    break
+                self.verify_chunk(index, data.encode('hex'))
+                index += 1
+                if len(data) < chunk_size:
+                    break
+        finally:
+            f.close()
 
-    def save_chunk(self, index, chunk):
+    def read_fully(self, f, n):
+        parts = []
+        while n > 0:
+            s = f.read(n)
+            if not s:
+                break
+            parts.append(s)
+            n -= len(s)
+        return ''.join(parts)
+
+    def save_chunk(self, index, chunk, hashes=None):
+        self.forget_digests(index*2016)
         filename = self.path()
         f = open(filename,'rb+')
         f.seek(index*2016*80)
         h = f.write(chunk)
         f.close()
+        self.store.written(index*2016, chunk, hashes)
         self.set_local_height()
 
-    def save_header(self, header):
+    def save_header(self, header, _hash=None):
         data = self.header_to_string(header).decode('hex')
         assert len(data) == 80
         height = header.get('block_height')
+        self.forget_digests(height)
         filename = self.path()
         f = open(filename,'rb+')
         f.seek(height*80)
         h = f.write(data)
         f.close()
+        self.store.written(height, data, [_hash] if _hash else None)
         self.set_local_height()
 
+    def forget_digests(self, height):
+        if self.digest_cache[0] >= height/2016:
+            self.digest_cache = (-1, '\0'*32)
+
     def set_local_height(self):
-        name = self.path()
-        if os.path.exists(name):
-            h = os.path.getsize(name)/80 - 1
-            if self.local_height != h:
-                self.local_height = h
+        h = self.store.count() - 1
+        if self.local_height != h:
+            self.local_height = h
 
     def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h
+        h = self.store.read(block_height)
+        if h is not None:
+            return self.header_from_string(h)
 
     def get_target(self, index, chain=None):
         if chain is None:
@@ -191,26 +619,26 @@ class Blockchain():
 
         max_target = 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
         if index == 0: return 0x1e0ffff0, max_target
-
-        first = self.read_header((index-1)*2016)
-        last = self.read_header(index*2016-1)
-        if last is None:
+        if index in self.checkpoints:
+            bits = self.checkpoints[index][1]
+            return bits, self.bits_to_target(bits)
+
+        first_timestamp = self.store.timestamp((index-1)*2016)
+        if index*2016-1 < self.store.count():
+            last_timestamp = self.store.timestamp(index*2016-1)
+            bits = self.store.get_bits(index*2016-1)
+        else:
             for h in chain:
                 if h.get('block_height') == index*2016-1:
-                    last = h
+                    last_timestamp = h.get('timestamp')
+                    bits = h.get('bits')
 
-        nActualTimespan = last.get('timestamp') - first.get('timestamp')
+        nActualTimespan = last_timestamp - first_timestamp
         nTargetTimespan = 84*60*60
         nActualTimespan = max(nActualTimespan, nTargetTimespan/4)
         nActualTimespan = min(nActualTimespan, nTargetTimespan*4)
 
-        bits = last.get('bits')
-        # convert to bignum
-        MM = 256*256*256
-        a = bits%MM
-        if a < 0x8000:
-            a *= 256
-        target = (a) * pow(2, 8 * (bits/MM - 3))
+        target = self.bits_to_target(bits)
 
         # new target
         new_target = min( max_target, (target * nActualTimespan)/nTargetTimespan )
@@ -227,9 +655,18 @@ class Blockchain():
             c /= 256
             i += 1
 
+        MM = 256*256*256
         new_bits = c + MM * i
         return new_bits, new_target
 
+    def bits_to_target(self, bits):
+        # convert to bignum
+        MM = 256*256*256
+        a = bits%MM
+        if a < 0x8000:
+            a *= 256
+        return (a) * pow(2, 8 * (bits/MM - 3))
+
     def connect_header(self, chain, header):
         '''Builds a header chain until it connects.  Returns True if it has
         successfully connected, False if verification failed, otherwise the
@@ -243,17 +680,18 @@ class Blockchain():
             return previous_height
 
         # Does it connect to my chain?
-        prev_hash = self.hash_header(previous_header)
+        prev_hash = self.get_hash(previous_height)
         if prev_hash != header.get('prev_block_hash'):
             self.print_error("reorg")
             return previous_height
 
         # The chain is complete.  Reverse to order by increasing height
         chain.reverse()
-        if self.verify_chain(chain):
+        hashes = self.verify_chain(chain)
+        if hashes:
             self.print_error("connected at height:", previous_height)
-            for header in chain:
-                self.save_header(header)
+            for header, _hash in zip(chain, hashes):
+                self.save_header(header, _hash)
             return True
 
         return False
@@ -264,4 +702,6 @@ class Blockchain():
             return idx + 1
         except Exception:
             self.print_error('verify_chunk failed')
-            return idx - 1
+            # start over before the chunks that were waiting for a
+            # checkpoint if they were dropped
+            return min(idx - 1, self.next_chunk())
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2015 Thomas Voegtlin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_right
+from itertools import islice
+from operator import itemgetter
+
+from bitcoin import DUST_THRESHOLD, MIN_RELAY_TX_FEE
+from util import NotEnoughFunds, print_error
+
+
+class CoinIndex(object):
+    '''Spendable coins in the order of get_spendable_coins(), oldest
+    first, and sorted by value on first use.  The wallet keeps the index
+    while its coins do not change, so choosers that stop at the first
+    coins of either order do not walk or sort all of them again.  Coins
+    are shared and must not be modified.'''
+
+    def __init__(self, coins):
+        self.coins = coins
+        self.sorted_coins = None
+        self.sorted_values = None
+
+    def __len__(self):
+        return len(self.coins)
+
+    def by_value(self):
+        '''Coins by increasing value'''
+        if self.sorted_coins is None:
+            self.sorted_coins = sorted(self.coins, key=itemgetter('value'))
+            self.sorted_values = [coin['value'] for coin in self.sorted_coins]
+        return self.sorted_coins
+
+    def above(self, value):
+        '''Coins worth more than value, by decreasing value'''
+        coins = self.by_value()
+        return coins[bisect_right(self.sorted_values, value):][::-1]
+
+
+def get_coin_index(coins):
+    return coins if isinstance(coins, CoinIndex) else CoinIndex(coins)
+
+
+class CoinChooserBase(object):
+    '''Picks the inputs of a transaction among the coins of the wallet.
+
+    make_tx() adds inputs to a transaction that already has its outputs,
+    until they pay for amount and the fee, and returns (total, fee).
+    The fee is fixed_fee if given, otherwise the wallet estimate for the
+    transaction as it stands.  coins is a list or a CoinIndex.
+
+    By default coins are spent in the order of get_spendable_coins(),
+    oldest first, and then the smallest inputs that are not needed are
+    dropped.  Subclasses change the order, or make_tx().
+    '''
+
+    def __init__(self, wallet, fixed_fee=None):
+        self.wallet = wallet
+        self.fixed_fee = fixed_fee
+
+    def get_fee(self, tx):
+        if self.fixed_fee is not None:
+            return self.fixed_fee
+        return self.wallet.estimated_fee(tx)
+
+    def add_coin(self, tx, coin):
+        '''Adds a copy of coin, which is returned'''
+        coin = dict(coin)
+        self.wallet.add_input_info(coin)
+        tx.add_input(coin)
+        return coin
+
+    def add_until_funded(self, tx, coins, amount):
+        '''Add coins in the given order until they pay for amount and
+        the fee.'''
+        total = 0
+        for coin in coins:
+            self.add_coin(tx, coin)
+            total += coin['value']
+            # no need to estimate fee until we have reached desired amount
+            if total < amount:
+                continue
+            fee = self.get_fee(tx)
+            if total >= amount + fee:
+                return total, fee
+        raise NotEnoughFunds()
+
+    def remove_unneeded(self, tx, total, amount, fee):
+        '''Remove the smallest inputs while the others still pay for
+        amount and fee.'''
+        for coin in sorted(tx.inputs, key=itemgetter('value')):
+            v = coin['value']
+            if total - v >= amount + fee:
+                tx.remove_input(coin)
+                total -= v
+                fee = self.get_fee(tx)
+            else:
+                break
+        return total, fee
+
+    def order(self, index):
+        '''Coins in the order they are spent'''
+        return index.coins
+
+    def make_tx(self, tx, coins, amount):
+        coins = self.order(get_coin_index(coins))
+        total, fee = self.add_until_funded(tx, coins, amount)
+        return self.remove_unneeded(tx, total, amount, fee)
+
+
+class CoinChooserOldest(CoinChooserBase):
+    '''Spend coins oldest first; the behaviour of the base class.'''
+
+
+class CoinChooserLargest(CoinChooserBase):
+    '''Spend the largest coins first, for the fewest inputs.'''
+
+    def order(self, index):
+        return reversed(index.by_value())
+
+
+class CoinChooserConsolidate(CoinChooserBase):
+    '''Spend the smallest coins first, and keep adding small coins, up
+    to MAX_INPUTS inputs, as long as each one is worth more than the fee
+    it adds.  This reduces the number of coins left in the wallet.'''
+
+    MAX_INPUTS = 200
+
+    def make_tx(self, tx, coins, amount):
+        coins = get_coin_index(coins).by_value()
+        total, fee = self.add_until_funded(tx, coins, amount)
+        for coin in islice(coins, len(tx.inputs), None):
+            if len(tx.inputs) >= self.MAX_INPUTS:
+                break
+            coin = self.add_coin(tx, coin)
+            new_fee = self.get_fee(tx)
+            if coin['value'] <= new_fee - fee:
+                tx.remove_input(coin)
+                continue
+            total += coin['value']
+            fee = new_fee
+        return total, fee
+
+
+class CoinChooserBnB(CoinChooserBase):
+    '''Look for coins that pay for amount and the fee without a change
+    output, by a depth first search over the coins sorted by value that
+    prunes branches already over or short of the target (branch and
+    bound).  If no such set is found within MAX_TRIES steps, coins are chosen as
+    by the base class.'''
+
+    MAX_TRIES = 100000
+
+    def make_tx(self, tx, coins, amount):
+        coins = get_coin_index(coins)
+        selection = self.search(tx, coins, amount)
+        if selection:
+            selection = [self.add_coin(tx, coin) for coin in selection]
+            total = sum(coin['value'] for coin in selection)
+            fee = self.get_fee(tx)
+            if amount + fee <= total <= amount + fee + self.cost_of_change:
+                return total, fee
+            print_error("coin selection does not match the fee, falling back")
+            for coin in selection:
+                tx.remove_input(coin)
+        return CoinChooserBase.make_tx(self, tx, coins, amount)
+
+    def search(self, tx, coins, amount):
+        '''Returns coins of the index paying for amount and their fee
+        with less than the cost of a change output in excess, or None.'''
+        if not coins:
+            return None
+        if self.fixed_fee is not None:
+            fee = lambda k: self.fixed_fee
+            input_fee = 0
+            self.cost_of_change = DUST_THRESHOLD
+        else:
+            # all inputs are assumed to have the size of the first one
+            coin = dict(coins.coins[0])
+            self.wallet.add_input_info(coin)
+            tx.add_input(coin)
+            size = tx.estimated_size()
+            tx.remove_input(coin)
+            base_size = tx.estimated_size()
+            fee_per_kb = self.wallet.fee_per_kb
+            input_fee = fee_per_kb * (size - base_size) / 1000.
+            fee = lambda k: max(int(fee_per_kb * base_size / 1000. + k * input_fee), MIN_RELAY_TX_FEE)
+            self.cost_of_change = max(DUST_THRESHOLD, fee_per_kb * 34 / 1000)
+
+        # coins worth less than their input fee never help
+        pool = coins.above(input_fee)
+        values = [c['value'] for c in pool]
+        n = len(values)
+        # lookahead[i] is the value of the coins not yet decided at index i
+        lookahead = [0] * (n + 1)
+        for i in range(n - 1, -1, -1):
+            lookahead[i] = lookahead[i + 1] + values[i]
+
+        best = None
+        best_excess = None
+        selected = []
+        value = 0
+        i = 0
+        for tries in xrange(self.MAX_TRIES):
+            # the fee only grows with more inputs, and each input is
+            # worth more than its fee, so both bounds hold for the
+            # whole branch
+            target = amount + fee(len(selected))
+            if value + lookahead[i] < target or value > target + self.cost_of_change:
+                backtrack = True
+            elif value >= target:
+                excess = value - target
+                if best is None or excess < best_excess:
+                    best = selected[:]
+                    best_excess = excess
+                    if excess == 0:
+                        break
+                backtrack = True
+            else:
+                # include coin i
+                selected.append(i)
+                value += values[i]
+                i += 1
+                continue
+            if not selected:
+                break
+            # exclude the last included coin and try the next ones
+            j = selected.pop()
+            value -= values[j]
+            i = j + 1
+        if best is None:
+            return None
+        return [pool[j] for j in best]
+
+
+COIN_CHOOSERS = {
+    'oldest': CoinChooserOldest,
+    'largest': CoinChooserLargest,
+    'consolidate': CoinChooserConsolidate,
+    'bnb': CoinChooserBnB,
+}
+
+def get_coin_chooser(name):
+    if name not in COIN_CHOOSERS:
+        raise BaseException("Unknown coin chooser '%s', use one of: %s" % (name, ', '.join(sorted(COIN_CHOOSERS))))
+    return COIN_CHOOSERS[name]
+
@@ -371,7 +371,7 @@ class Commands:
         sig = base64.b64decode(signature)
         return bitcoin.verify_message(address, sig, message)
 
-    def _mktx(self, outputs, fee, change_addr, domain, nocheck, unsigned):
+    def _mktx(self, outputs, fee, change_addr, domain, nocheck, unsigned, coin_chooser='oldest'):
         self.nocheck = nocheck
         change_addr = self._resolver(change_addr)
         domain = None if domain is None else map(self._resolver, domain)
@@ -395,8 +395,8 @@ class Commands:
                 amount = int(COIN*Decimal(amount))
             final_outputs.append(('address', address, amount))
 
-        coins = self.wallet.get_spendable_coins(domain)
-        tx = self.wallet.make_unsigned_transaction(coins, final_outputs, fee, change_addr)
+        coins = self.wallet.get_coin_index(domain)
+        tx = self.wallet.make_unsigned_transaction(coins, final_outputs, fee, change_addr, coin_chooser)
         str(tx) #this serializes
         if not unsigned:
             self.wallet.sign_transaction(tx, self.password)
@@ -415,10 +415,10 @@ class Commands:
         return outputs
 
     @command('wp')
-    def payto(self, destination, amount, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, deserialized=False, broadcast=False):
+    def payto(self, destination, amount, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, deserialized=False, broadcast=False, coin_chooser='oldest'):
         """Create a transaction. """
         domain = [from_addr] if from_addr else None
-        tx = self._mktx([(destination, amount)], tx_fee, change_addr, domain, nocheck, unsigned)
+        tx = self._mktx([(destination, amount)], tx_fee, change_addr, domain, nocheck, unsigned, coin_chooser)
         if broadcast:
             r, h = self.wallet.sendtx(tx)
             return h
@@ -426,11 +426,11 @@ class Commands:
             return tx.deserialize() if deserialized else tx
 
     @command('wp')
-    def paytomany(self, csv_file, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, deserialized=False, broadcast=False):
+    def paytomany(self, csv_file, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, deserialized=False, broadcast=False, coin_chooser='oldest'):
         """Create a multi-output transaction. """
         domain = [from_addr] if from_addr else None
         outputs = self._read_csv(csv_file)
-        tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned)
+        tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned, coin_chooser)
         if broadcast:
             r, h = self.wallet.sendtx(tx)
             return h
@@ -631,6 +631,7 @@ command_options = {
     'tx_fee':      ("-f", "--fee",         "Transaction fee (in XVG)"),
     'from_addr':   ("-F", "--from",        "Source address. If it isn't in the wallet, it will ask for the private key unless supplied in the format public_key:private_key. It's not saved in the wallet."),
     'change_addr': ("-c", "--change",      "Change address. Default is a spare address, or the source address if it's not in the wallet"),
+    'coin_chooser':(None, "--coins",       "Coin selection: oldest, largest, consolidate or bnb (no change output if possible)"),
     'nbits':       (None, "--nbits",       "Number of bits of entropy"),
     'entropy':     (None, "--entropy",     "Custom entropy"),
     'language':    ("-L", "--lang",        "Default language for wordlist"),
@@ -24,6 +24,8 @@ import threading
 import traceback
 import json
 import Queue
+import select
+import errno
 from collections import defaultdict
 
 import util
@@ -32,6 +34,9 @@ from util import print_error, print_stderr, parse_json
 from simple_config import SimpleConfig
 
 DAEMON_SOCKET = 'daemon.sock'
+# a client that lets this much output pile up is not reading, and is
+# dropped
+MAX_CLIENT_OUTPUT = 10 * 1000 * 1000
 
 
 def do_start_daemon(config):
@@ -66,25 +71,27 @@ def get_daemon(config, start_daemon):
 
 
 
-class ClientThread(util.DaemonThread):
+class DaemonClient:
+    '''A GUI or command connected to the daemon socket.  It has no
+    thread of its own; the NetworkServer thread reads its requests when
+    select() reports the socket readable.'''
 
     def __init__(self, server, s):
-        util.DaemonThread.__init__(self)
         self.server = server
         self.client_pipe = util.SocketPipe(s)
-        self.response_queue = Queue.Queue()
-        self.server.add_client(self)
+        self.client_pipe.set_timeout(0)
         self.subscriptions = defaultdict(list)
+        self.running = True
 
-    def reading_thread(self):
-        while self.is_running():
-            try:
-                request = self.client_pipe.get()
-            except util.timeout:
-                continue
-            if request is None:
-                self.running = False
-                break
+    def fileno(self):
+        return self.client_pipe.fileno()
+
+    def on_readable(self):
+        requests = self.client_pipe.get_all()
+        if requests is None:
+            self.running = False
+            return
+        for request in requests:
             method = request.get('method')
             params = request.get('params')
             if method == 'daemon.stop':
@@ -94,21 +101,29 @@ class ClientThread(util.DaemonThread):
                 self.subscriptions[method].append(params)
             self.server.send_request(self, request)
 
-    def run(self):
-        threading.Thread(target=self.reading_thread).start()
-        while self.is_running():
-            try:
-                response = self.response_queue.get(timeout=0.1)
-            except Queue.Empty:
-                continue
-            try:
-                self.client_pipe.send(response)
-            except socket.error:
-                self.running = False
-                break
-        self.server.remove_client(self)
+    def send_response(self, response):
+        if not self.running:
+            return
+        try:
+            self.client_pipe.send(response)
+        except socket.error:
+            self.running = False
+            return
+        if self.client_pipe.pending_output() > MAX_CLIENT_OUTPUT:
+            print_error("client is not reading, dropping it")
+            self.running = False
+
+    def wants_write(self):
+        return self.running and self.client_pipe.pending_output() > 0
 
+    def on_writable(self):
+        try:
+            self.client_pipe.flush()
+        except socket.error:
+            self.running = False
 
+    def close(self):
+        self.client_pipe.socket.close()
 
 
 
@@ -123,13 +138,18 @@ class NetworkServer(util.DaemonThread):
         self.lock = threading.RLock()
         # each GUI is a client of the daemon
         self.clients = []
+        # clients added by other threads, registered by run()
+        self.new_clients = util.SelectableQueue()
         self.request_id = 0
         self.requests = {}
 
     def add_client(self, client):
-        for key in ['status', 'banner', 'updated', 'servers', 'interfaces']:
+        self.new_clients.put(client)
+
+    def register_client(self, client):
+        for key in ['status', 'banner', 'updated', 'servers', 'interfaces', 'interface_stats']:
             value = self.network.get_status_value(key)
-            client.response_queue.put({'method':'network.status', 'params':[key, value]})
+            client.send_response({'method':'network.status', 'params':[key, value]})
         with self.lock:
             self.clients.append(client)
             print_error("new client:", len(self.clients))
@@ -148,28 +168,55 @@ class NetworkServer(util.DaemonThread):
             print_error("-->", request)
         self.pipe.send(request)
 
+    def process_response(self, response):
+        if self.debug:
+            print_error("<--", response)
+        response_id = response.get('id')
+        if response_id:
+            with self.lock:
+                client_id, client = self.requests.pop(response_id)
+            response['id'] = client_id
+            client.send_response(response)
+        else:
+            # notification
+            m = response.get('method')
+            v = response.get('params')
+            with self.lock:
+                clients = self.clients[:]
+            for client in clients:
+                if m == 'network.status' or v in client.subscriptions.get(m, []):
+                    client.send_response(response)
+
+    def socket_clients(self):
+        with self.lock:
+            return [c for c in self.clients if isinstance(c, DaemonClient)]
+
     def run(self):
         self.network.start()
         while self.is_running():
+            for client in self.new_clients.get_all():
+                self.register_client(client)
+            clients = self.socket_clients()
+            w = [c for c in clients if c.wants_write()]
             try:
-                response = self.pipe.get()
-            except util.timeout:
+                r, w, x = select.select([self.pipe, self.new_clients] + clients, w, [], 1.0)
+            except select.error as e:
+                if e[0] != errno.EINTR:
+                    raise
                 continue
-            if self.debug:
-                print_error("<--", response)
-            response_id = response.get('id')
-            if response_id:
-                with self.lock:
-                    client_id, client = self.requests.pop(response_id)
-                response['id'] = client_id
-                client.response_queue.put(response)
-            else:
-                # notification
-                m = response.get('method')
-                v = response.get('params')
-                for client in self.clients:
-                    if m == 'network.status' or v in client.subscriptions.get(m, []):
-                        client.response_queue.put(response)
+            for client in clients:
+                if client in w:
+                    client.on_writable()
+                if client in r:
+                    client.on_readable()
+            for response in self.pipe.get_all():
+                self.process_response(response)
+            for client in clients:
+                if not client.running:
+                    self.remove_client(client)
+                    client.close()
+        for client in self.socket_clients():
+            client.close()
         self.network.stop()
         print_error("server exiting")
 
@@ -199,8 +246,7 @@ def daemon_loop(server):
                 t = time.time()
             continue
         t = time.time()
-        client = ClientThread(server, connection)
-        client.start()
+        server.add_client(DaemonClient(server, connection))
     server.stop()
     # sleep so that other threads can terminate cleanly
     time.sleep(0.5)
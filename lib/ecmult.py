@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2015 Thomas Voegtlin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Fixed-base scalar multiplication on secp256k1 in pure Python.
+#
+# k*G is the sum over the windows of k of digit_i * 2^(w*i) * G; these
+# multiples are precomputed once, so a multiplication is ceil(256/w)
+# point additions and no doubling.  Points are added in Jacobian
+# coordinates (X, Y, Z) = (x*Z^2, y*Z^3), which avoids a modular inverse
+# per addition; only the result is converted back.
+
+import os
+import threading
+
+from util import print_error
+from simple_config import get_config
+
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+GX = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
+GY = 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8
+
+INFINITY = (1, 1, 0)
+WINDOW = 8
+
+
+def jacobian_double((X, Y, Z)):
+    if Y == 0 or Z == 0:
+        return INFINITY
+    YY = Y * Y % P
+    S = 4 * X * YY % P
+    M = 3 * X * X % P
+    X3 = (M * M - 2 * S) % P
+    Y3 = (M * (S - X3) - 8 * YY * YY) % P
+    Z3 = 2 * Y * Z % P
+    return X3, Y3, Z3
+
+
+def jacobian_add_affine((X1, Y1, Z1), (x2, y2)):
+    '''Jacobian point plus affine point'''
+    if Z1 == 0:
+        return x2, y2, 1
+    Z1Z1 = Z1 * Z1 % P
+    U2 = x2 * Z1Z1 % P
+    S2 = y2 * Z1 * Z1Z1 % P
+    H = (U2 - X1) % P
+    R = (S2 - Y1) % P
+    if H == 0:
+        if R == 0:
+            return jacobian_double((X1, Y1, Z1))
+        return INFINITY
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    Z3 = Z1 * H % P
+    return X3, Y3, Z3
+
+
+def to_affine((X, Y, Z)):
+    if Z == 0:
+        return None, None
+    z = pow(Z, P - 2, P)
+    zz = z * z % P
+    return X * zz % P, Y * zz * z % P
+
+
+def batch_to_affine(points):
+    '''Converts Jacobian points (not at infinity) with a single modular
+    inverse.'''
+    prefix = []
+    acc = 1
+    for X, Y, Z in points:
+        prefix.append(acc)
+        acc = acc * Z % P
+    inv = pow(acc, P - 2, P)
+    out = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        z = inv * prefix[i] % P
+        inv = inv * Z % P
+        zz = z * z % P
+        out[i] = (X * zz % P, Y * zz * z % P)
+    return out
+
+
+def is_sum((x1, y1), (x2, y2), (x3, y3)):
+    '''Whether affine point 3 is point 1 plus point 2 (neither at
+    infinity, nor opposite).  The slope equations are multiplied by the
+    denominator of the slope, so no modular inverse is needed.'''
+    if not (0 <= x3 < P and 0 <= y3 < P):
+        return False
+    dx = (x2 - x1) % P
+    dy = (y2 - y1) % P
+    if dx == 0:
+        if dy != 0 or y1 == 0:
+            return False
+        # doubling: the slope is 3*x1^2 / (2*y1)
+        dx = 2 * y1 % P
+        dy = 3 * x1 * x1 % P
+    dxdx = dx * dx % P
+    return ((x3 + x1 + x2) * dxdx - dy * dy) % P == 0 and \
+           ((y3 + y1) * dx - dy * (x1 - x3)) % P == 0
+
+
+class GeneratorTable(object):
+    '''rows[i][j] is (j+1) * 2^(window*i) * G, in affine coordinates.'''
+
+    def __init__(self, window=WINDOW, rows=None):
+        self.window = window
+        self.num_rows = (256 + window - 1) / window
+        self.rows = rows if rows is not None else self.build()
+
+    def row_bases(self):
+        base = (GX, GY, 1)
+        out = []
+        for i in range(self.num_rows):
+            out.append(base)
+            for j in range(self.window):
+                base = jacobian_double(base)
+        return batch_to_affine(out)
+
+    def build(self):
+        rows = []
+        for base in self.row_bases():
+            acc = (base[0], base[1], 1)
+            row = [acc]
+            for j in range((1 << self.window) - 2):
+                acc = jacobian_add_affine(acc, base)
+                row.append(acc)
+            rows.append(batch_to_affine(row))
+        return rows
+
+    def mul(self, k):
+        '''k*G in Jacobian coordinates'''
+        k %= N
+        mask = (1 << self.window) - 1
+        acc = INFINITY
+        for row in self.rows:
+            if k == 0:
+                break
+            d = k & mask
+            if d:
+                acc = jacobian_add_affine(acc, row[d - 1])
+            k >>= self.window
+        return acc
+
+    def mul_affine(self, k):
+        return to_affine(self.mul(k))
+
+    def add_mul(self, point, k):
+        '''point + k*G in affine coordinates'''
+        return to_affine(jacobian_add_affine(self.mul(k), point))
+
+    def file_size(self):
+        return self.num_rows * ((1 << self.window) - 1) * 64
+
+    def save(self, path):
+        temp_path = "%s.tmp.%s" % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            for row in self.rows:
+                f.write(''.join(('%064x%064x' % point).decode('hex') for point in row))
+        os.rename(temp_path, path)
+
+    @classmethod
+    def load(klass, path, window=WINDOW):
+        '''Returns the table saved at path, or None if the file is missing
+        or damaged.  The first point of each row must be the expected
+        multiple of G, and each following one the sum of its predecessor
+        and the first.'''
+        table = klass(window, rows=[])
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        if len(data) != table.file_size():
+            return None
+        n = (1 << window) - 1
+        rows = []
+        for i in range(table.num_rows):
+            row = []
+            for j in range(n):
+                offset = (i * n + j) * 64
+                point = (int(data[offset:offset+32].encode('hex'), 16),
+                         int(data[offset+32:offset+64].encode('hex'), 16))
+                if row and not is_sum(row[-1], row[0], point):
+                    return None
+                row.append(point)
+            rows.append(row)
+        if [row[0] for row in rows] != table.row_bases():
+            return None
+        table.rows = rows
+        return table
+
+
+generator_table = None
+generator_table_lock = threading.Lock()
+
+def get_generator_table():
+    '''Returns the process-wide table.  It is saved in the electrum
+    directory unless the config sets ecmult_table to false.'''
+    global generator_table
+    with generator_table_lock:
+        if generator_table is not None:
+            return generator_table
+        config = get_config()
+        path = None
+        if config is not None and config.path and os.path.isdir(config.path) and config.get('ecmult_table', True):
+            path = os.path.join(config.path, 'ecmult_w%d' % WINDOW)
+        table = GeneratorTable.load(path) if path else None
+        if table is None:
+            table = GeneratorTable()
+            if path:
+                try:
+                    table.save(path)
+                except (IOError, OSError) as e:
+                    print_error("cannot save generator table", e)
+        generator_table = table
+        return generator_table
+
+
+if __name__ == '__main__':
+
+    import sys
+    from timeit import default_timer
+    import ecdsa
+
+    out = sys.__stdout__
+    t0 = default_timer()
+    table = GeneratorTable()
+    out.write("build: %.3f s\n" % (default_timer() - t0))
+
+    G = ecdsa.ecdsa.generator_secp256k1
+    ks = [int(os.urandom(32).encode('hex'), 16) for i in range(200)]
+    t0 = default_timer()
+    expected = [G * k for k in ks]
+    dt_ecdsa = (default_timer() - t0) / len(ks)
+    t0 = default_timer()
+    results = [table.mul_affine(k) for k in ks]
+    dt_table = (default_timer() - t0) / len(ks)
+    assert results == [(Q.x(), Q.y()) for Q in expected]
+    out.write("k*G python-ecdsa: %.3f ms\n" % (dt_ecdsa * 1000))
+    out.write("k*G table:        %.3f ms\n" % (dt_table * 1000))
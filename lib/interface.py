@@ -21,6 +21,7 @@ import copy, re, errno, os
 import threading, traceback, sys, time, Queue
 import socket
 import ssl
+from collections import deque, defaultdict
 
 import requests
 ca_path = requests.certs.where()
@@ -36,9 +37,12 @@ def Interface(server, response_queue, config = None):
     to a single remote electrum server.  The object handles all necessary locking.  It's
     exposed API is:
 
-    - Inherits everything from threading.Thread.
+    - Inherits everything from threading.Thread.  The thread only opens
+      the connection; after that, the socket is served by the network
+      thread through fileno(), on_readable(), on_writable(),
+      send_requests() and close().
     - Member functions send_request(), stop(), is_connected()
-    - Member variable server.
+    - Member variables server and stats.
     
     "server" is constant for the object's lifetime and hence synchronization is unnecessary.
     """
@@ -51,6 +55,126 @@ def Interface(server, response_queue, config = None):
 # Connection status
 CS_OPENING, CS_CONNECTED, CS_FAILED = range(3)
 
+# Servers that did not answer a JSON-RPC batch; requests to them are
+# sent one by one.
+no_batch_servers = set()
+
+# SSL contexts by CA file, so that certificates are read and parsed
+# once, and not on every connection.  The files under certs/ are the
+# pinned certificates of servers; a context is loaded again if its
+# file changed.
+ssl_contexts = {}
+ssl_contexts_lock = threading.Lock()
+# Hosts whose certificate was signed by a CA; they are connected to
+# with the CA context directly.
+ca_signed_hosts = set()
+
+def get_ssl_context(ca_certs):
+    mtime = os.path.getmtime(ca_certs) if ca_certs else None
+    with ssl_contexts_lock:
+        cached = ssl_contexts.get(ca_certs)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        if ca_certs:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(ca_certs)
+        ssl_contexts[ca_certs] = mtime, context
+        return context
+
+def forget_ssl_context(ca_certs):
+    with ssl_contexts_lock:
+        ssl_contexts.pop(ca_certs, None)
+
+def wrap_ssl(s, ca_certs=None):
+    '''Client side handshake.  The certificate must be signed by
+    ca_certs, or it is not checked if ca_certs is None.'''
+    if not hasattr(ssl, 'SSLContext'):
+        # python < 2.7.9
+        cert_reqs = ssl.CERT_REQUIRED if ca_certs else ssl.CERT_NONE
+        return ssl.wrap_socket(s, ssl_version=ssl.PROTOCOL_SSLv23, cert_reqs=cert_reqs, ca_certs=ca_certs)
+    return get_ssl_context(ca_certs).wrap_socket(s)
+
+
+def median(values, default=None):
+    if not values:
+        return default
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+class InterfaceStats(object):
+    '''Health of a server, over the last WINDOW samples of each kind.
+
+    score() estimates, in seconds, what a request to the server costs:
+    the ping time, plus the delay of its new headers, plus penalties
+    for failed requests and missing blocks.  Lower is better.'''
+
+    WINDOW = 50
+    # assumed ping time of a server that was not measured yet
+    DEFAULT_PING = 1.0
+    # cost of a request that fails or times out
+    FAILURE_PENALTY = 10.0
+    # cost of each block the server is behind our verified chain
+    BLOCK_PENALTY = 30.0
+
+    def __init__(self):
+        self.ping_times = deque(maxlen=self.WINDOW)
+        self.response_times = defaultdict(lambda: deque(maxlen=self.WINDOW))
+        # True for answered requests, False for errors and timeouts
+        self.outcomes = deque(maxlen=self.WINDOW)
+        self.header_delays = deque(maxlen=self.WINDOW)
+        # set by the network
+        self.blocks_behind = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def on_response(self, method, elapsed, error):
+        if method == 'server.version':
+            self.ping_times.append(elapsed)
+        else:
+            self.response_times[method].append(elapsed)
+        self.outcomes.append(not error)
+        if error:
+            self.errors += 1
+
+    def on_timeout(self, n):
+        '''n requests timed out'''
+        self.outcomes.extend([False] * n)
+        self.timeouts += n
+
+    def on_header(self, delay):
+        '''A new header arrived delay seconds after the first server
+        sent it'''
+        self.header_delays.append(delay)
+
+    def failure_rate(self):
+        if not self.outcomes:
+            return 0.
+        return float(self.outcomes.count(False)) / len(self.outcomes)
+
+    def num_samples(self):
+        return len(self.outcomes)
+
+    def score(self):
+        return (median(self.ping_times, self.DEFAULT_PING)
+                + median(self.header_delays, 0.)
+                + self.FAILURE_PENALTY * self.failure_rate()
+                + self.BLOCK_PENALTY * self.blocks_behind)
+
+    def as_dict(self):
+        return {
+            'ping': median(self.ping_times),
+            'response_times': dict((m, median(t)) for m, t in self.response_times.items()),
+            'header_delay': median(self.header_delays),
+            'blocks_behind': self.blocks_behind,
+            'failure_rate': self.failure_rate(),
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'score': self.score(),
+        }
+
+
 class TcpInterface(threading.Thread):
 
     def __init__(self, server, response_queue, config = None):
@@ -66,6 +190,14 @@ class TcpInterface(threading.Thread):
         self.response_queue = response_queue
         self.request_queue = Queue.Queue()
         self.unanswered_requests = {}
+        # send times of the unanswered requests, for stats
+        self.request_times = {}
+        self.stats = InterfaceStats()
+        # JSON-RPC batches.  batch_supported is None until the server
+        # answers the first batch, whose ids are kept in unconfirmed_batch
+        self.batch_size = self.config.get('rpc_batch_size', 100)
+        self.batch_supported = False if server in no_batch_servers else None
+        self.unconfirmed_batch = []
         # request timeouts
         self.request_time = time.time()
         self.ping_time = 0
@@ -83,12 +215,28 @@ class TcpInterface(threading.Thread):
         if self.debug:
             self.print_error("<--", response)
 
+        if type(response) is list:
+            self.confirm_batch()
+            for r in response:
+                self.process_response(r)
+            return
+
         msg_id = response.get('id')
         error = response.get('error')
         result = response.get('result')
 
+        if msg_id is None and error and self.unconfirmed_batch:
+            self.reject_batch(error)
+            return
+
+        if msg_id in self.unconfirmed_batch:
+            self.confirm_batch()
+
         if msg_id is not None:
             method, params, _id, queue = self.unanswered_requests.pop(msg_id)
+            sent = self.request_times.pop(msg_id, None)
+            if sent is not None:
+                self.stats.on_response(method, time.time() - sent, error)
             if queue is None:
                 queue = self.response_queue
         else:
@@ -139,122 +287,187 @@ class TcpInterface(threading.Thread):
 
 
     def get_socket(self):
-        if self.use_ssl:
-            cert_path = os.path.join( self.config.path, 'certs', self.host)
-            if not os.path.exists(cert_path):
-                is_new = True
-                s = self.get_simple_socket()
-                if s is None:
-                    return
-                # try with CA first
-                try:
-                    s = ssl.wrap_socket(s, ssl_version=ssl.PROTOCOL_SSLv23, cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_path, do_handshake_on_connect=True)
-                except ssl.SSLError, e:
-                    s = None
-                if s and check_host_name(s.getpeercert(), self.host):
-                    self.print_error("SSL certificate signed by CA")
-                    return s
-
-                # get server certificate.
-                # Do not use ssl.get_server_certificate because it does not work with proxy
-                s = self.get_simple_socket()
-                if s is None:
-                    return
-                try:
-                    s = ssl.wrap_socket(s, ssl_version=ssl.PROTOCOL_SSLv23, cert_reqs=ssl.CERT_NONE, ca_certs=None)
-                except ssl.SSLError, e:
-                    self.print_error("SSL error retrieving SSL certificate:", e)
-                    return
-
-                dercert = s.getpeercert(True)
-                s.close()
-                cert = ssl.DER_cert_to_PEM_cert(dercert)
-                # workaround android bug
-                cert = re.sub("([^\n])-----END CERTIFICATE-----","\\1\n-----END CERTIFICATE-----",cert)
-                temporary_path = cert_path + '.temp'
-                with open(temporary_path,"w") as f:
-                    f.write(cert)
-            else:
-                is_new = False
-
         s = self.get_simple_socket()
-        if s is None:
-            return
-
-        if self.use_ssl:
-            try:
-                s = ssl.wrap_socket(s,
-                                    ssl_version=ssl.PROTOCOL_SSLv23,
-                                    cert_reqs=ssl.CERT_REQUIRED,
-                                    ca_certs= (temporary_path if is_new else cert_path),
-                                    do_handshake_on_connect=True)
-            except ssl.SSLError, e:
-                self.print_error("SSL error:", e)
-                if e.errno != 1:
-                    return
-                if is_new:
-                    rej = cert_path + '.rej'
-                    if os.path.exists(rej):
-                        os.unlink(rej)
-                    os.rename(temporary_path, rej)
-                else:
-                    with open(cert_path) as f:
-                        cert = f.read()
-                    try:
-                        x = x509.X509()
-                        x.parse(cert)
-                    except:
-                        traceback.print_exc(file=sys.stderr)
-                        self.print_error("wrong certificate")
-                        return
-                    try:
-                        x.check_date()
-                    except:
-                        self.print_error("certificate has expired:", cert_path)
-                        os.unlink(cert_path)
-                        return
-                    self.print_error("wrong certificate")
+        if s is None or not self.use_ssl:
+            return s
+        cert_path = os.path.join(self.config.path, 'certs', self.host)
+        if os.path.exists(cert_path):
+            return self.get_pinned_ssl_socket(s, cert_path)
+        if self.host in ca_signed_hosts:
+            return self.get_ca_ssl_socket(s)
+        return self.get_new_ssl_socket(s, cert_path)
+
+    def get_pinned_ssl_socket(self, s, cert_path):
+        try:
+            return wrap_ssl(s, cert_path)
+        except ssl.SSLError, e:
+            self.print_error("SSL error:", e)
+            if e.errno != 1:
                 return
-            except BaseException, e:
-                self.print_error(e)
-                if e.errno == 104:
-                    return
+            with open(cert_path) as f:
+                cert = f.read()
+            try:
+                x = x509.X509()
+                x.parse(cert)
+            except:
                 traceback.print_exc(file=sys.stderr)
+                self.print_error("wrong certificate")
                 return
+            try:
+                x.check_date()
+            except:
+                self.print_error("certificate has expired:", cert_path)
+                os.unlink(cert_path)
+                forget_ssl_context(cert_path)
+                return
+            self.print_error("wrong certificate")
+            return
+        except BaseException, e:
+            self.print_error(e)
+            if e.errno == 104:
+                return
+            traceback.print_exc(file=sys.stderr)
+            return
 
-            if is_new:
-                self.print_error("saving certificate")
-                os.rename(temporary_path, cert_path)
+    def get_new_ssl_socket(self, s, cert_path):
+        '''A self-signed certificate is pinned on first use, from the
+        handshake of this connection.  Other certificates must be signed
+        by a CA.'''
+        # Do not use ssl.get_server_certificate because it does not work with proxy
+        try:
+            s = wrap_ssl(s)
+        except (ssl.SSLError, socket.error), e:
+            self.print_error("SSL error retrieving SSL certificate:", e)
+            return
+        cert = ssl.DER_cert_to_PEM_cert(s.getpeercert(True))
+        # workaround android bug
+        cert = re.sub("([^\n])-----END CERTIFICATE-----","\\1\n-----END CERTIFICATE-----",cert)
+        try:
+            x = x509.X509()
+            x.parse(cert)
+        except:
+            traceback.print_exc(file=sys.stderr)
+            self.reject_certificate(s, cert_path, cert)
+            return
+        if x.issuer == x.subject:
+            try:
+                x.check_date()
+            except:
+                self.print_error("certificate has expired")
+                self.reject_certificate(s, cert_path, cert)
+                return
+            self.print_error("saving certificate")
+            temporary_path = cert_path + '.temp'
+            with open(temporary_path, "w") as f:
+                f.write(cert)
+            os.rename(temporary_path, cert_path)
+            return s
+
+        s.close()
+        s = self.get_simple_socket()
+        if s is None:
+            return
+        s = self.get_ca_ssl_socket(s)
+        if s is None:
+            with open(cert_path + '.rej', "w") as f:
+                f.write(cert)
+        return s
 
+    def get_ca_ssl_socket(self, s):
+        try:
+            s = wrap_ssl(s, ca_path)
+        except ssl.SSLError, e:
+            self.print_error("SSL error:", e)
+            s.close()
+            ca_signed_hosts.discard(self.host)
+            return
+        if not check_host_name(s.getpeercert(), self.host):
+            self.print_error("SSL certificate does not match host name")
+            s.close()
+            ca_signed_hosts.discard(self.host)
+            return
+        self.print_error("SSL certificate signed by CA")
+        ca_signed_hosts.add(self.host)
         return s
 
+    def reject_certificate(self, s, cert_path, cert):
+        s.close()
+        with open(cert_path + '.rej', "w") as f:
+            f.write(cert)
+
     def send_request(self, request, response_queue = None):
         '''Queue a request.  Blocking only if called from other threads.'''
         self.request_time = time.time()
         self.request_queue.put((copy.deepcopy(request), response_queue), threading.current_thread() != self)
 
+    def get_batch_size(self):
+        if self.batch_supported is False or self.batch_size <= 1:
+            return 1
+        if self.batch_supported is None and self.unconfirmed_batch:
+            # wait until we know whether the server handles batches
+            return 0
+        return self.batch_size
+
     def send_requests(self):
-        '''Sends all queued requests'''
+        '''Sends all queued requests, grouped in JSON-RPC batches of up
+        to rpc_batch_size requests'''
         while self.is_connected() and not self.request_queue.empty():
-            request, response_queue = self.request_queue.get()
-            method = request.get('method')
-            params = request.get('params')
-            r = {'id': self.message_id, 'method': method, 'params': params}
+            n = self.get_batch_size()
+            if n == 0:
+                return
+            batch = []
+            while len(batch) < n and not self.request_queue.empty():
+                request, response_queue = self.request_queue.get()
+                method = request.get('method')
+                params = request.get('params')
+                r = {'id': self.message_id, 'method': method, 'params': params}
+                self.unanswered_requests[self.message_id] = method, params, request.get('id'), response_queue
+                self.message_id += 1
+                batch.append(r)
+            if len(batch) > 1 and self.batch_supported is None:
+                self.unconfirmed_batch = [r['id'] for r in batch]
+            now = time.time()
+            for r in batch:
+                self.request_times[r['id']] = now
             try:
-                self.pipe.send(r)
+                self.pipe.send(batch if len(batch) > 1 else batch[0])
             except socket.error, e:
                 self.print_error("socket error:", e)
                 self.stop()
                 return
             if self.debug:
-                self.print_error("-->", r)
-            self.unanswered_requests[self.message_id] = method, params, request.get('id'), response_queue
-            self.message_id += 1
+                self.print_error("-->", batch)
+
+    def confirm_batch(self):
+        if self.batch_supported is None:
+            self.print_error("server supports batch requests")
+        self.batch_supported = True
+        self.unconfirmed_batch = []
+
+    def reject_batch(self, error):
+        '''The server could not parse our first batch.  Send its requests
+        again one by one.'''
+        self.print_error("server does not support batch requests:", error)
+        self.batch_supported = False
+        no_batch_servers.add(self.server)
+        for msg_id in self.unconfirmed_batch:
+            method, params, _id, queue = self.unanswered_requests[msg_id]
+            try:
+                self.pipe.send({'id': msg_id, 'method': method, 'params': params})
+            except socket.error, e:
+                self.print_error("socket error:", e)
+                self.stop()
+                return
+        self.unconfirmed_batch = []
 
     def is_connected(self):
         '''True if status is connected'''
         return self._status == CS_CONNECTED and not self.disconnect
 
+    def is_open(self):
+        '''True if the socket is open, even if stop() was called'''
+        return self._status == CS_CONNECTED
+
     def stop(self):
         if not self.disconnect:
             self.disconnect = True
@@ -268,38 +481,63 @@ class TcpInterface(threading.Thread):
         # stop interface if we have been waiting for more than 10 seconds
         if self.unanswered_requests and time.time() - self.request_time > 10 and self.pipe.idle_time() > 10:
             self.print_error("interface timeout", len(self.unanswered_requests))
+            self.stats.on_timeout(len(self.unanswered_requests))
             self.stop()
 
-    def get_and_process_response(self):
-        if self.is_connected():
-            try:
-                response = self.pipe.get()
-            except util.timeout:
-                return
-            # If remote side closed the socket, SocketPipe closes our socket and returns None
-            if response is None:
-                self.disconnect = True
-                self.print_error("connection closed remotely")
-            else:
-                self.process_response(response)
+    def fileno(self):
+        return self.pipe.fileno()
+
+    def wants_write(self):
+        return self.pipe.pending_output() > 0
+
+    def on_writable(self):
+        '''Send the data the socket did not take before'''
+        try:
+            self.pipe.flush()
+        except socket.error, e:
+            self.print_error("socket error:", e)
+            self.stop()
+
+    def on_readable(self):
+        '''Process the responses the server sent'''
+        if not self.is_connected():
+            return
+        responses = self.pipe.get_all()
+        if responses is None:
+            self.disconnect = True
+            self.print_error("connection closed remotely")
+            return
+        for response in responses:
+            self.process_response(response)
+
+    def close(self):
+        '''Close the socket of a stopped interface'''
+        s = self.pipe.socket
+        try:
+            s.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        s.close()
+        if self.unconfirmed_batch:
+            # the server dropped us instead of answering our batch
+            no_batch_servers.add(self.server)
+        self._status = CS_FAILED
+        self.notify_status()
 
     def run(self):
         s = self.get_socket()
+        if s and self.disconnect:
+            s.close()
+            s = None
         if s:
             self.pipe = util.SocketPipe(s)
-            s.settimeout(0.1)
+            self.pipe.set_timeout(0)
             self.print_error("connected")
             self._status = CS_CONNECTED
             # Indicate to parent that we've connected
             self.notify_status()
-            while self.is_connected():
-                self.maybe_ping()
-                self.send_requests()
-                self.get_and_process_response()
-            s.shutdown(socket.SHUT_RDWR)
-            s.close()
+            return
 
-        # Also for the s is None case 
         self._status = CS_FAILED
         # Indicate to parent that the connection is now down
         self.notify_status()
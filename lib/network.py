@@ -4,6 +4,8 @@ import os
 import sys
 import random
 import traceback
+import select
+import errno
 
 import socks
 import socket
@@ -13,7 +15,7 @@ import util
 from bitcoin import *
 import interface
 from blockchain import Blockchain
-from collections import deque
+from collections import deque, defaultdict
 
 DEFAULT_PORTS = {'t':'50001', 's':'50002', 'h':'8081', 'g':'8082'}
 
@@ -23,6 +25,31 @@ DEFAULT_SERVERS = {
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# longest wait for socket or queue events, for the timers of run()
+SELECT_TIMEOUT = 1.0
+# With auto_connect, the server in use is compared to the others every
+# STATS_INTERVAL seconds.  It is replaced if the score of the best one
+# is lower by SWITCH_MARGIN seconds and by a factor SWITCH_RATIO, at
+# most once every SWITCH_INTERVAL seconds, so that close servers do
+# not take turns.
+STATS_INTERVAL = 60
+SWITCH_INTERVAL = 600
+SWITCH_MARGIN = 0.5
+SWITCH_RATIO = 0.5
+# samples needed before a server can replace the one in use
+MIN_STATS_SAMPLES = 5
+# Read-only requests that are spread over the interfaces at the tip of
+# the main server.  Each interface has at most max_in_flight of them,
+# and they are sent to another one after FANOUT_TIMEOUT seconds.
+# Histories stay on the main server: another server may have a different
+# mempool, and its history would not match the status the synchronizer
+# subscribed to.  For the same reason, a fanned out request that gets an
+# error is sent again to the main server: a new transaction may not be
+# in the mempool of the other server yet.
+FANOUT_METHODS = set(['blockchain.transaction.get',
+                      'blockchain.transaction.get_merkle'])
+MAX_IN_FLIGHT = 10
+FANOUT_TIMEOUT = 10
 
 
 def parse_servers(result):
@@ -111,8 +138,9 @@ def serialize_server(host, port, protocol):
 
 class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote
-    electrum servers, each connection is handled by its own
-    thread object returned from Interface().  Its external API:
+    electrum servers.  Each connection is opened by its own thread
+    object returned from Interface(), then all of them are served by
+    the select() loop of run().  Its external API:
 
     - Member functions get_header(), get_parameters(), get_status_value(),
                        new_blockchain_height(), set_parameters(), start(),
@@ -126,8 +154,10 @@ class Network(util.DaemonThread):
         self.config = SimpleConfig(config) if type(config) == type({}) else config
         self.num_server = 8 if not self.config.get('oneserver') else 0
         self.blockchain = Blockchain(self.config, self)
-        self.queue = Queue.Queue()
+        self.queue = util.SelectableQueue()
         self.requests_queue = pipe.send_queue
+        # requests that wait for a connection
+        self.pending_requests = []
         self.response_queue = pipe.get_queue
         # A deque of interface header requests, processed left-to-right
         self.bc_requests = deque()
@@ -146,6 +176,11 @@ class Network(util.DaemonThread):
 
         self.banner = ''
         self.heights = {}
+        # highest height announced, and when it was first announced
+        self.best_height = 0
+        self.best_height_time = 0
+        # health of the servers, kept across reconnections
+        self.server_stats = {}
         self.merkle_roots = {}
         self.utxo_roots = {}
 
@@ -159,9 +194,17 @@ class Network(util.DaemonThread):
         self.addr_responses = {}
         # unanswered requests
         self.unanswered_requests = {}
+        # fanned out requests: id -> (request, interface, time sent)
+        self.fanout_requests = {}
+        self.in_flight = defaultdict(int)
+        self.fanout_full = False
+        # ids of fanned out requests that failed, for the main server
+        self.main_only_requests = set()
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
+        self.stats_time = time.time()
+        self.switch_time = 0
         # kick off the network.  interface is the main server we are currently
         # communicating with.  interfaces is the set of servers we are connecting
         # to or have an ongoing connection with
@@ -236,6 +279,8 @@ class Network(util.DaemonThread):
             value = self.get_servers()
         elif key == 'interfaces':
             value = self.get_interfaces()
+        elif key == 'interface_stats':
+            value = self.get_interface_stats()
         return value
 
     def notify(self, key):
@@ -250,6 +295,10 @@ class Network(util.DaemonThread):
         '''The interfaces that are in connected state'''
         return [s for s, i in self.interfaces.items() if i.is_connected()]
 
+    def get_interface_stats(self):
+        '''Health stats of the connected interfaces, by server'''
+        return dict((s, i.stats.as_dict()) for s, i in self.interfaces.items() if i.is_connected())
+
     def get_servers(self):
         if self.irc_servers:
             out = self.irc_servers
@@ -269,6 +318,9 @@ class Network(util.DaemonThread):
             if server == self.default_server:
                 self.set_status('connecting')
             i = interface.Interface(server, self.queue, self.config)
+            if server not in self.server_stats:
+                self.server_stats[server] = i.stats
+            i.stats = self.server_stats[server]
             self.interfaces[i.server] = i
             i.start()
 
@@ -305,8 +357,14 @@ class Network(util.DaemonThread):
 
     def stop_network(self):
         self.print_error("stopping network")
+        for request, i, t in self.fanout_requests.values():
+            self.pending_requests.append(request)
+        self.fanout_requests = {}
+        self.in_flight.clear()
         for i in self.interfaces.values():
             i.stop()
+            if i.is_open():
+                i.close()
         self.interface = None
         self.interfaces = {}
 
@@ -323,18 +381,52 @@ class Network(util.DaemonThread):
         else:
             self.switch_lagging_interface()
 
-    def switch_to_random_interface(self):
-        servers = self.get_interfaces()    # Those in connected state
-        if servers:
-            self.switch_to_interface(random.choice(servers))
+    def best_interface(self):
+        '''The connected interface with the lowest score; ties are
+        broken at random'''
+        candidates = [i for i in self.interfaces.values() if i.is_connected()]
+        if not candidates:
+            return None
+        random.shuffle(candidates)
+        return min(candidates, key=lambda i: i.stats.score())
+
+    def switch_to_best_interface(self):
+        i = self.best_interface()
+        if i:
+            self.switch_to_interface(i.server)
 
     def switch_lagging_interface(self, suggestion = None):
-        '''If auto_connect and lagging, switch interface'''
+        '''If auto_connect and lagging, switch interface: to suggestion
+        unless another server scores clearly better, otherwise to the
+        best one'''
         if self.server_is_lagging() and self.auto_connect:
+            i = None
             if suggestion and self.protocol == deserialize_server(suggestion)[2]:
+                i = self.interfaces.get(suggestion)
+            best = self.best_interface()
+            if i and i.is_connected() and not (best and self.scores_better(best, i)):
                 self.switch_to_interface(suggestion)
             else:
-                self.switch_to_random_interface()
+                self.switch_to_best_interface()
+
+    def scores_better(self, i, other):
+        score, other_score = i.stats.score(), other.stats.score()
+        return score < other_score - SWITCH_MARGIN and score < other_score * SWITCH_RATIO
+
+    def maybe_switch_to_better_interface(self):
+        '''If auto_connect, switch to a server that scores clearly
+        better than the current one'''
+        if not self.auto_connect or not self.is_connected():
+            return
+        if time.time() - self.switch_time < SWITCH_INTERVAL:
+            return
+        best = self.best_interface()
+        if best is None or best == self.interface or best.stats.num_samples() < MIN_STATS_SAMPLES:
+            return
+        if self.scores_better(best, self.interface):
+            self.print_error("%s scores %.2f, %s scores %.2f" % (self.interface.server, self.interface.stats.score(),
+                                                                 best.server, best.stats.score()))
+            self.switch_to_interface(best.server)
 
     def switch_to_interface(self, server):
         '''Switch to server as our interface.  If no connection exists nor
@@ -355,6 +447,7 @@ class Network(util.DaemonThread):
             # stop any current interface in order to terminate subscriptions
             self.stop_interface()
             self.interface = i
+            self.switch_time = time.time()
             self.addr_responses = {}
             self.send_subscriptions()
             self.set_status('connected')
@@ -386,21 +479,38 @@ class Network(util.DaemonThread):
             if i.server == self.default_server:
                 self.switch_to_interface(i.server)
         else:
-            self.interfaces.pop(i.server, None)
-            self.heights.pop(i.server, None)
+            # a stopped interface may have been replaced already
+            if self.interfaces.get(i.server) == i:
+                self.interfaces.pop(i.server)
+                self.heights.pop(i.server, None)
             if i == self.interface:
                 self.interface = None
                 self.addr_responses = {}
                 self.set_status('disconnected')
             self.disconnected_servers.add(i.server)
+            self.retry_fanout_requests(lambda fi, t: fi == i)
         # Our set of interfaces changed
         self.notify('interfaces')
+        self.notify('interface_stats')
 
     def process_response(self, i, response):
         # the id comes from the daemon or the network proxy
         _id = response.get('id')
-        if _id is not None:
-            if i != self.interface:
+        if _id in self.fanout_requests:
+            if self.fanout_requests[_id][1] != i:
+                # answered after we gave up on this interface
+                return
+            request = self.fanout_requests.pop(_id)[0]
+            self.in_flight[i.server] -= 1
+            if response.get('error') and i != self.interface:
+                i.print_error("error, asking the main server:", request['method'])
+                self.main_only_requests.add(_id)
+                self.pending_requests.append(request)
+                return
+        elif _id is not None:
+            # late answers to retried requests are not in
+            # unanswered_requests
+            if i != self.interface or _id not in self.unanswered_requests:
                 return
             self.unanswered_requests.pop(_id)
 
@@ -430,13 +540,10 @@ class Network(util.DaemonThread):
         process_request() and must do so in order to e.g. prevent the
         daemon seeming unresponsive.
         '''
-        unhandled = []
-        while not self.requests_queue.empty():
-            request = self.requests_queue.get()
-            if not self.process_request(request):
-                unhandled.append(request)
-        for request in unhandled:
-            self.requests_queue.put(request)
+        self.fanout_full = False
+        self.retry_fanout_requests(lambda fi, t: time.time() - t > FANOUT_TIMEOUT)
+        requests = self.pending_requests + self.requests_queue.get_all()
+        self.pending_requests = [r for r in requests if not self.process_request(r)]
 
     def process_request(self, request):
         '''Returns true if the request was processed.'''
@@ -470,15 +577,63 @@ class Network(util.DaemonThread):
         if not self.is_connected():
             return False
 
+        if method in FANOUT_METHODS and _id not in self.main_only_requests:
+            return self.send_fanout_request(request)
+        self.main_only_requests.discard(_id)
+
         self.unanswered_requests[_id] = request
         self.interface.send_request(request)
         return True
 
+    def pick_fanout_interface(self, exclude=None):
+        '''The connected interface at the tip of the main server with
+        the fewest fanned out requests, or None if they all have
+        max_in_flight'''
+        tip = (self.heights.get(self.interface.server), self.merkle_roots.get(self.interface.server))
+        limit = self.config.get('max_in_flight', MAX_IN_FLIGHT)
+        candidates = [i for i in self.interfaces.values()
+                      if i != exclude and i.is_connected()
+                      and self.in_flight[i.server] < limit
+                      and (self.heights.get(i.server), self.merkle_roots.get(i.server)) == tip]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda i: (self.in_flight[i.server], i.stats.score()))
+
+    def send_fanout_request(self, request, exclude=None):
+        '''Returns False if no interface can take the request now'''
+        if self.fanout_full:
+            return False
+        i = self.pick_fanout_interface(exclude)
+        if i is None:
+            # the interfaces are not going to have room again before
+            # the next call of handle_requests()
+            self.fanout_full = True
+            return False
+        self.fanout_requests[request['id']] = (request, i, time.time())
+        self.in_flight[i.server] += 1
+        i.send_request(request)
+        return True
+
+    def retry_fanout_requests(self, predicate):
+        '''Send the requests for which predicate(interface, time sent)
+        is true to another interface'''
+        for _id, (request, i, t) in self.fanout_requests.items():
+            if not predicate(i, t):
+                continue
+            i.print_error("retrying", request['method'])
+            if i.is_connected():
+                i.stats.on_timeout(1)
+            self.fanout_requests.pop(_id)
+            self.in_flight[i.server] -= 1
+            if not self.is_connected() or not self.send_fanout_request(request, i):
+                self.pending_requests.append(request)
+
     def check_interfaces(self):
         now = time.time()
         # nodes
         if len(self.interfaces) < self.num_server:
-            self.start_random_interface()
+            for n in range(self.num_server - len(self.interfaces)):
+                self.start_random_interface()
             if now - self.nodes_retry_time > NODES_RETRY_INTERVAL:
                 self.print_error('network: retrying connections')
                 self.disconnected_servers = set([])
@@ -486,7 +641,7 @@ class Network(util.DaemonThread):
         # main interface
         if not self.is_connected():
             if self.auto_connect:
-                self.switch_to_random_interface()
+                self.switch_to_best_interface()
             else:
                 if self.default_server in self.disconnected_servers:
                     if now - self.server_retry_time > SERVER_RETRY_INTERVAL:
@@ -494,26 +649,86 @@ class Network(util.DaemonThread):
                         self.server_retry_time = now
                 else:
                     self.switch_to_interface(self.default_server)
+        # stats
+        if now - self.stats_time > STATS_INTERVAL:
+            self.stats_time = now
+            self.maybe_switch_to_better_interface()
+            self.notify('interface_stats')
+
+    def pick_chunk_interface(self, interface, data, idx, exclude=None):
+        '''Round-robin over the connected interfaces that have chunk idx'''
+        height = min(data['if_height'], (idx + 1) * 2016 - 1)
+        candidates = [i for i in self.interfaces.values()
+                      if i != exclude and i.is_connected()
+                      and self.heights.get(i.server, 0) >= height]
+        if not candidates:
+            return interface
+        candidates.sort(key=lambda i: i.server)
+        data['rr'] = data.get('rr', -1) + 1
+        return candidates[data['rr'] % len(candidates)]
 
     def request_chunk(self, interface, data, idx):
         interface.print_error("requesting chunk %d" % idx)
         interface.send_request({'method':'blockchain.block.get_chunk', 'params':[idx]})
-        data['chunk_idx'] = idx
+        data['chunks'][idx] = (interface, time.time())
         data['req_time'] = time.time()
 
+    def request_chunks(self, interface, data):
+        '''Keep up to chunk_window chunk requests in flight'''
+        window = self.config.get('chunk_window', 4)
+        last_idx = data['if_height'] / 2016
+        while (data['next_request'] <= last_idx
+               and len(data['chunks']) + len(data['chunk_buffer']) < window):
+            idx = data['next_request']
+            self.request_chunk(self.pick_chunk_interface(interface, data, idx), data, idx)
+            data['next_request'] += 1
+
+    def start_chunks(self, interface, data, idx):
+        # chunk_idx is the next chunk to connect.  Chunks that arrive
+        # early wait in chunk_buffer.
+        data['chunks'] = {}
+        data['chunk_buffer'] = {}
+        data['chunk_idx'] = idx
+        data['next_request'] = idx
+        self.request_chunks(interface, data)
+
+    def retry_chunks(self, interface, data):
+        '''Send timed out chunk requests to another interface'''
+        now = time.time()
+        for idx, (i, req_time) in data['chunks'].items():
+            if now - req_time > 10:
+                i.print_error("chunk request %d timed out" % idx)
+                i.stats.on_timeout(1)
+                self.request_chunk(self.pick_chunk_interface(interface, data, idx, i), data, idx)
+
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         if self.bc_requests:
             req_if, data = self.bc_requests[0]
-            req_idx = data.get('chunk_idx')
+            chunks = data.get('chunks', {})
+            idx = response['params'][0]
             # Ignore unsolicited chunks
-            if req_if == interface and req_idx == response['params'][0]:
-                idx = self.blockchain.connect_chunk(req_idx, response['result'])
-                # If not finished, get the next chunk
-                if idx < 0 or self.get_local_height() >= data['if_height']:
+            if idx not in chunks or chunks[idx][0] != interface:
+                return
+            chunks.pop(idx)
+            data['chunk_buffer'][idx] = response['result']
+            # Connect buffered chunks in order
+            while data['chunk_idx'] in data['chunk_buffer']:
+                req_idx = data['chunk_idx']
+                idx = self.blockchain.connect_chunk(req_idx, data['chunk_buffer'].pop(req_idx))
+                if idx < 0:
                     self.bc_requests.popleft()
-                else:
-                    self.request_chunk(interface, data, idx)
+                    return
+                if idx < req_idx:
+                    # Verification failed, start over from the previous chunk
+                    self.start_chunks(req_if, data, idx)
+                    return
+                data['chunk_idx'] = idx
+            # If not finished, get the next chunks
+            if self.get_local_height() < data['if_height']:
+                self.request_chunks(req_if, data)
+            if not data['chunks']:
+                self.bc_requests.popleft()
 
     def request_header(self, interface, data, height):
         interface.print_error("requesting header %d" % height)
@@ -548,7 +763,7 @@ class Network(util.DaemonThread):
         if if_height <= local_height:
             return False
         elif if_height > local_height + 50:
-            self.request_chunk(interface, data, (local_height + 1) / 2016)
+            self.start_chunks(interface, data, self.blockchain.next_chunk())
         else:
             self.request_header(interface, data, if_height)
         return True
@@ -568,32 +783,71 @@ class Network(util.DaemonThread):
                 # Request headers if it is ahead of our blockchain
                 if not self.bc_request_headers(interface, data):
                     continue
+            elif 'chunks' in data:
+                self.retry_chunks(interface, data)
             elif time.time() - req_time > 10:
                 interface.print_error("blockchain request timed out")
+                interface.stats.on_timeout(1)
                 interface.stop()
                 continue
             # Put updated request state back at head of deque
             self.bc_requests.appendleft((interface, data))
             break
 
-    def run(self):
-        self.blockchain.init()
-        while self.is_running():
-            self.check_interfaces()
-            self.handle_requests()
-            self.handle_bc_requests()
-            try:
-                i, response = self.queue.get(timeout=0.1)
-            except Queue.Empty:
+    def serve_interfaces(self):
+        '''Send the queued requests of the connected interfaces and close
+        the stopped ones.  Returns the interfaces to read from.'''
+        out = []
+        for i in self.interfaces.values():
+            if not i.is_open():
+                # still connecting
                 continue
+            if i.is_connected():
+                i.maybe_ping()
+                i.send_requests()
+            if i.is_connected():
+                out.append(i)
+            else:
+                i.close()
+        return out
 
+    def wait_for_events(self, interfaces):
+        '''Wait until a server, the daemon or an interface thread has
+        something for us, then read the servers'''
+        r = [self.queue, self.requests_queue] + interfaces
+        w = [i for i in interfaces if i.wants_write()]
+        try:
+            r, w, x = select.select(r, w, [], SELECT_TIMEOUT)
+        except select.error as e:
+            if e[0] != errno.EINTR:
+                raise
+            return
+        for i in interfaces:
+            if i in w:
+                i.on_writable()
+            if i in r:
+                i.on_readable()
+
+    def process_queue(self):
+        for i, response in self.queue.get_all():
             # if response is None it is a notification about the interface
             if response is None:
                 self.process_if_notification(i)
             else:
                 self.process_response(i, response)
 
+    def run(self):
+        self.blockchain.init()
+        while self.is_running():
+            self.check_interfaces()
+            self.handle_requests()
+            self.handle_bc_requests()
+            interfaces = self.serve_interfaces()
+            self.wait_for_events(interfaces)
+            self.process_queue()
+
         self.stop_network()
+        self.blockchain.close()
         self.print_error("stopped")
 
     def on_header(self, i, r):
@@ -603,7 +857,20 @@ class Network(util.DaemonThread):
         height = header.get('block_height')
         if not height:
             return
+        # Header delays are measured on new blocks that extend our
+        # chain, so that a server announcing a bogus height is not
+        # taken as the reference.  The first header of a server is
+        # its current height, not a new block.
+        now = time.time()
+        local_height = self.get_local_height()
+        if self.best_height < height <= local_height + 1:
+            self.best_height = height
+            self.best_height_time = now
+        if i.server in self.heights and height == self.best_height:
+            i.stats.on_header(now - self.best_height_time)
         self.heights[i.server] = height
+        for server, h in self.heights.items():
+            self.server_stats[server].blocks_behind = max(0, local_height - h)
         self.merkle_roots[i.server] = header.get('merkle_root')
         self.utxo_roots[i.server] = header.get('utxo_root')
 
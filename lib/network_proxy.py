@@ -18,6 +18,9 @@
 
 import threading
 import Queue
+import select
+import errno
+import socket
 
 import util
 from network import Network
@@ -43,14 +46,17 @@ class NetworkProxy(util.DaemonThread):
         self.pending_transactions_for_notifications = []
         self.callbacks = {}
 
+        # put() wakes up run() before its timeout
+        self.wakeup_queue = util.SelectableQueue()
         if socket:
             self.pipe = util.SocketPipe(socket)
+            self.pipe.set_timeout(0)
             self.network = None
         else:
             self.pipe = util.QueuePipe()
             self.network = Network(self.pipe, config)
             self.network.start()
-            for key in ['status','banner','updated','servers','interfaces']:
+            for key in ['status','banner','updated','servers','interfaces','interface_stats']:
                 value = self.network.get_status_value(key)
                 self.pipe.get_queue.put({'method':'network.status', 'params':[key, value]})
 
@@ -61,20 +67,39 @@ class NetworkProxy(util.DaemonThread):
         self.blockchain_height = 0
         self.server_height = 0
         self.interfaces = []
+        self.interface_stats = {}
         self.jobs = []
 
 
+    def wakeup(self):
+        '''Run the jobs without waiting for a response'''
+        self.wakeup_queue.put(None)
+
     def run(self):
         while self.is_running():
             for job in self.jobs:
                 job()
+            w = [self.pipe] if self.pipe.pending_output() else []
             try:
-                response = self.pipe.get()
-            except util.timeout:
+                r, w, x = select.select([self.pipe, self.wakeup_queue], w, [], 1.0)
+            except select.error as e:
+                if e[0] != errno.EINTR:
+                    raise
                 continue
-            if response is None:
+            self.wakeup_queue.get_all()
+            if w:
+                try:
+                    self.pipe.flush()
+                except socket.error as e:
+                    print_error("daemon connection error:", e)
+                    break
+            # process everything queued before running the jobs again,
+            # so they can batch requests
+            responses = self.pipe.get_all() if self.pipe in r else []
+            if responses is None:
                 break
-            self.process(response)
+            for response in responses:
+                self.process(response)
         self.trigger_callback('stop')
         if self.network:
             self.network.stop()
@@ -96,6 +121,8 @@ class NetworkProxy(util.DaemonThread):
                 self.servers = value
             elif key == 'interfaces':
                 self.interfaces = value
+            elif key == 'interface_stats':
+                self.interface_stats = value
             self.trigger_callback(key)
             return
 
@@ -153,6 +180,9 @@ class NetworkProxy(util.DaemonThread):
                 self.message_id += 1
 
             self.pipe.send_all(requests)
+            if self.pipe.pending_output():
+                # let run() send the rest
+                self.wakeup()
             return ids
 
 
@@ -181,6 +211,9 @@ class NetworkProxy(util.DaemonThread):
     def get_interfaces(self):
         return self.interfaces
 
+    def get_interface_stats(self):
+        return self.interface_stats
+
     def get_header(self, height):
         return self.synchronous_get([('network.get_header', [height])])[0]
 
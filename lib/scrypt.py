@@ -19,6 +19,11 @@
 import hashlib
 import hmac
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def scrypt_1024_1_1_80(header):
     if not isinstance(header, str) or len(header) != 80:
         raise ValueError('header must be an 80-byte string')
@@ -244,6 +249,98 @@ def _xor_salsa8_2(X):
     ]
 
 
+# Headers hashed together by scrypt_1024_1_1_80_batch.  The scratchpad
+# takes 128 KB per header.  Below MIN_BATCH_SIZE the fixed cost of the
+# numpy calls outweighs the gain.
+BATCH_SIZE = 128
+MIN_BATCH_SIZE = 24
+
+# The batch kernel keeps each half of the salsa20/8 state as four rows of
+# four lanes, so that every step of a double round is a single operation
+# on a row:  a = (x0, x5, x10, x15), b = (x4, x9, x14, x3),
+# c = (x8, x13, x2, x7), d = (x12, x1, x6, x11).
+_PERM16 = [0, 5, 10, 15, 4, 9, 14, 3, 8, 13, 2, 7, 12, 1, 6, 11]
+_PERM32 = _PERM16 + [16 + i for i in _PERM16]
+_ROLL_LEFT = [1, 2, 3, 0]
+_ROLL_TWO = [2, 3, 0, 1]
+_ROLL_RIGHT = [3, 0, 1, 2]
+
+
+def scrypt_1024_1_1_80_batch(headers):
+    '''Hash a list of 80-byte headers; same results as mapping
+    scrypt_1024_1_1_80 over them, but the salsa20/8 core runs on numpy
+    arrays across all headers at once.'''
+    if numpy is None:
+        return map(scrypt_1024_1_1_80, headers)
+    result = []
+    for i in xrange(0, len(headers), BATCH_SIZE):
+        batch = headers[i:i+BATCH_SIZE]
+        if len(batch) < MIN_BATCH_SIZE:
+            result.extend(map(scrypt_1024_1_1_80, batch))
+        else:
+            result.extend(_scrypt_batch(batch))
+    return result
+
+def _scrypt_batch(headers):
+    n = len(headers)
+    macs = []
+    B = numpy.empty((n, 32), '<u4')
+    for j, header in enumerate(headers):
+        if not isinstance(header, str) or len(header) != 80:
+            raise ValueError('header must be an 80-byte string')
+        mac = hmac.new(header, digestmod=hashlib.sha256)
+        H = []
+        for i in xrange(4):
+            m = mac.copy()
+            m.update(header + '\0\0\0' + chr(i + 1))
+            H.append(m.digest())
+        B[j] = numpy.frombuffer(''.join(H), '<u4')
+        macs.append(mac)
+
+    X = B.T[_PERM32].astype(numpy.uint32).reshape(2, 4, 4, n)
+    V = numpy.empty((1024, n, 32), numpy.uint32)
+    cols = numpy.arange(n)
+
+    for i in xrange(1024):
+        V[i] = X.reshape(32, n).T
+        _xor_salsa8_2_batch(X)
+
+    for i in xrange(1024):
+        # x16 is the first lane of the second half
+        k = X[1, 0, 0] & 1023
+        X ^= V[k, cols].T.reshape(2, 4, 4, n)
+        _xor_salsa8_2_batch(X)
+
+    B = numpy.empty((n, 32), '<u4')
+    B[:, _PERM32] = X.reshape(32, n).T
+    result = []
+    for j in xrange(n):
+        mac = macs[j]
+        mac.update(B[j].tostring() + '\0\0\0\x01')
+        result.append(mac.digest())
+    return result
+
+def _xor_salsa8_2_batch(X):
+    X[0] ^= X[1]
+    _salsa20_8_batch(X[0])
+    X[1] ^= X[0]
+    _salsa20_8_batch(X[1])
+
+def _salsa20_8_batch(x):
+    a, b, c, d = x.copy()
+    for i in xrange(8):
+        # a column round, then the same steps on rotated lanes give the
+        # row round; rotating again restores the column layout
+        t = a + d; b ^= t << 7; t >>= 25; b ^= t
+        t = b + a; c ^= t << 9; t >>= 23; c ^= t
+        t = c + b; d ^= t << 13; t >>= 19; d ^= t
+        t = d + c; a ^= t << 18; t >>= 14; a ^= t
+        b, c, d = d.take(_ROLL_LEFT, 0), c.take(_ROLL_TWO, 0), b.take(_ROLL_RIGHT, 0)
+    x[0] += a
+    x[1] += b
+    x[2] += c
+    x[3] += d
+
 
 if __name__ == '__main__':
 
@@ -263,4 +360,13 @@ if __name__ == '__main__':
 
     dt = (default_timer() - t0) / len(vectors)
     print "%.1f ms/hash" % (dt*1000)
-    print "%.2f hash/s" % (1.0 / dt)
\ No newline at end of file
+    print "%.2f hash/s" % (1.0 / dt)
+
+    if numpy is not None:
+        headers = [h.decode('hex') for h, _ in vectors] * (BATCH_SIZE / len(vectors) + 1)
+        t0 = default_timer()
+        hashes = scrypt_1024_1_1_80_batch(headers)
+        dt = (default_timer() - t0) / len(headers)
+        assert hashes == [hash.decode('hex') for _, hash in vectors] * (BATCH_SIZE / len(vectors) + 1)
+        print "batch of %d: %.1f ms/hash" % (len(headers), dt*1000)
+        print "%.2f hash/s" % (1.0 / dt)
\ No newline at end of file
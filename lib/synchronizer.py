@@ -21,6 +21,7 @@ from threading import Lock
 
 from bitcoin import Hash, hash_encode
 from transaction import Transaction
+from tx_cache import get_tx_cache
 from util import print_error, print_msg
 import logging
 
@@ -43,6 +44,11 @@ class WalletSynchronizer():
         self.requested_tx = set()
         self.requested_histories = {}
         self.requested_addrs = set()
+        self.tx_cache = get_tx_cache()
+        # Requests queued by the response callbacks, sent together by
+        # main_loop()
+        self.pending_histories = []
+        self.pending_txs = []
         self.lock = Lock()
         self.initialize()
 
@@ -77,6 +83,7 @@ class WalletSynchronizer():
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.network.wakeup()
 
     def subscribe_to_addresses(self, addresses):
         if addresses:
@@ -97,8 +104,7 @@ class WalletSynchronizer():
         history = self.wallet.get_address_history(addr)
         if self.wallet.get_status(history) != result:
             if self.requested_histories.get(addr) is None:
-                self.network.send([('blockchain.address.get_history', [addr])],
-                                  self.addr_history_response)
+                self.pending_histories.append(addr)
                 self.requested_histories[addr] = result
 
     def addr_history_response(self, response):
@@ -133,16 +139,12 @@ class WalletSynchronizer():
             return
         tx_hash, tx_height = params
         assert tx_hash == hash_encode(Hash(result.decode('hex')))
-        tx = Transaction(result)
-        try:
-            tx.deserialize()
-        except Exception:
-            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
+        if not self.receive_tx(tx_hash, tx_height, result):
             return
-
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        if self.tx_cache:
+            self.tx_cache.put(tx_hash, result)
         self.requested_tx.remove((tx_hash, tx_height))
-        self.print_error("received tx:", tx_hash, len(tx.raw))
+        self.print_error("received tx:", tx_hash, len(result))
         if not self.requested_tx:
             self.network.trigger_callback('updated')
             # Updated gets called too many times from other places as
@@ -150,6 +152,16 @@ class WalletSynchronizer():
             # three times
             self.network.trigger_callback("new_transaction")
 
+    def receive_tx(self, tx_hash, tx_height, raw):
+        tx = Transaction(raw)
+        try:
+            tx.deserialize()
+        except Exception:
+            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
+            return False
+        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        return True
+
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
         missing = set()
@@ -157,10 +169,24 @@ class WalletSynchronizer():
             if self.wallet.transactions.get(tx_hash) is None:
                 missing.add((tx_hash, tx_height))
         missing -= self.requested_tx
-        if missing:
-            requests = [('blockchain.transaction.get', tx) for tx in missing]
+        if self.tx_cache:
+            for tx_hash, tx_height in list(missing):
+                raw = self.tx_cache.get(tx_hash)
+                if raw and self.receive_tx(tx_hash, tx_height, raw):
+                    missing.remove((tx_hash, tx_height))
+        self.pending_txs.extend(missing)
+        self.requested_tx |= missing
+
+    def send_pending_requests(self):
+        if self.pending_histories:
+            requests = [('blockchain.address.get_history', [addr])
+                        for addr in self.pending_histories]
+            self.network.send(requests, self.addr_history_response)
+            self.pending_histories = []
+        if self.pending_txs:
+            requests = [('blockchain.transaction.get', tx) for tx in self.pending_txs]
             self.network.send(requests, self.tx_response)
-            self.requested_tx |= missing
+            self.pending_txs = []
 
     def initialize(self):
         '''Check the initial state of the wallet.  Subscribe to all its
@@ -184,11 +210,12 @@ class WalletSynchronizer():
         # 1. Create new addresses
         self.wallet.synchronize()
 
-        # 2. Subscribe to new addresses
+        # 2. Subscribe to new addresses, send queued requests
         with self.lock:
             addresses = self.new_addresses
             self.new_addresses = set()
         self.subscribe_to_addresses(addresses)
+        self.send_pending_requests()
 
         logging.warn("///////////////////////")
         logging.warn("self.is_up_to_date()")
@@ -205,3 +232,6 @@ class WalletSynchronizer():
             if up_to_date:
                 self.wallet.save_transactions()
             self.network.trigger_callback('updated')
+
+        # 4. Commit wallet changes left pending by put()
+        self.wallet.storage.commit_pending()
@@ -6,7 +6,8 @@ from lib.bitcoin import (
     generator_secp256k1, point_to_ser, public_key_to_bc_address, EC_KEY,
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
-    is_valid, is_private_key, xpub_from_xprv)
+    is_valid, is_private_key, xpub_from_xprv, base_encode, base_decode,
+    bc_address_to_hash_160, hash_160_to_bc_address)
 
 try:
     import ecdsa
@@ -119,6 +120,27 @@ class Test_bitcoin(unittest.TestCase):
         result = Hash(payload)
         self.assertEqual(expected, result)
 
+    def test_base58(self):
+        for data, encoded in [('\0\0\x01', '112'), ('\x61', '2g'),
+                              ('\xff' * 4, '7YXq9G'), ('\0\x01\x02', '15T')]:
+            self.assertEqual(encoded, base_encode(data, base=58))
+            self.assertEqual(data, base_decode(encoded, None, base=58))
+        self.assertEqual('1', base_encode('', base=58))
+        self.assertEqual(None, base_decode('7YXq9G', 3, base=58))
+
+    def test_base43(self):
+        data = ''.join(map(chr, range(256)))
+        encoded = base_encode(data, base=43)
+        self.assertEqual('0', encoded[0])
+        self.assertEqual(data, base_decode(encoded, len(data), base=43))
+
+    def test_address_hash_160(self):
+        h160 = '\x12' * 20
+        address = hash_160_to_bc_address(h160, 33)
+        self.assertEqual((33, h160), bc_address_to_hash_160(address))
+        # cached
+        self.assertEqual((33, h160), bc_address_to_hash_160(address))
+
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
         # Taken from test vectors in https://en.bitcoin.it/wiki/BIP_0032_TestVectors
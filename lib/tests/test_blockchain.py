@@ -0,0 +1,319 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from lib import blockchain as blockchain_module
+from lib.blockchain import Blockchain, HeaderStore
+
+
+SAMPLE_HEADERS = os.path.join(os.path.dirname(__file__), '..', '..',
+                              '.electrum-xvg', 'blockchain_headers')
+
+
+class FakeConfig(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key, default=None):
+        return default
+
+
+class BlockchainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BlockchainTestCase, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.headers_path = os.path.join(self.electrum_dir, 'blockchain_headers')
+        with open(SAMPLE_HEADERS, 'rb') as f:
+            self.raw = f.read()
+        with open(self.headers_path, 'wb') as f:
+            f.write(self.raw[:2016*80])
+        self.blockchain = Blockchain(FakeConfig(self.electrum_dir), None)
+
+    def tearDown(self):
+        super(BlockchainTestCase, self).tearDown()
+        shutil.rmtree(self.electrum_dir)
+
+    def make_checkpoints(self):
+        """Checkpoints for the first two sample chunks.  Leaves an empty
+        headers file behind."""
+        checkpoints = [self.blockchain.get_checkpoint(0)]
+        with open(self.headers_path, 'wb') as f:
+            f.write(self.raw[:2*2016*80])
+        checkpoints.append(Blockchain(FakeConfig(self.electrum_dir), None).get_checkpoint(1))
+        open(self.headers_path, 'wb').close()
+        os.remove(os.path.join(self.electrum_dir, 'blockchain_hashes'))
+        return checkpoints
+
+    def checkpointed_blockchain(self):
+        config = FakeConfig(self.electrum_dir)
+        config.get = lambda key, default=None: self.checkpoints if key == 'checkpoints' else default
+        blockchain = Blockchain(config, None)
+        blockchain.compute_pow_hashes = None
+        return blockchain
+
+
+class Test_HeaderStore(BlockchainTestCase):
+
+    def test_read_header_matches_file(self):
+        for height in [0, 1, 1000, 2015]:
+            header = self.blockchain.read_header(height)
+            raw = self.raw[height*80:(height+1)*80]
+            self.assertEqual(raw.encode('hex'), self.blockchain.header_to_string(header))
+
+    def test_read_header_out_of_range(self):
+        self.assertEqual(None, self.blockchain.read_header(2016))
+        self.assertEqual(None, self.blockchain.read_header(-1))
+
+    def test_arrays_match_headers(self):
+        store = self.blockchain.store
+        for height in [0, 7, 2015]:
+            header = self.blockchain.read_header(height)
+            self.assertEqual(header['timestamp'], store.timestamp(height))
+            self.assertEqual(header['bits'], store.get_bits(height))
+
+    def test_empty_file(self):
+        open(self.headers_path, 'wb').close()
+        store = HeaderStore(self.headers_path, self.headers_path + '_hashes')
+        self.assertEqual(0, store.count())
+        self.assertEqual(None, store.read(0))
+
+    def test_save_chunk_grows_store(self):
+        self.assertEqual(2015, self.blockchain.height())
+        self.blockchain.store.timestamp(2015)
+        chunk = self.raw[2016*80:2*2016*80]
+        self.blockchain.save_chunk(1, chunk)
+        self.assertEqual(2*2016 - 1, self.blockchain.height())
+        header = self.blockchain.read_header(3000)
+        self.assertEqual(self.raw[3000*80:3001*80].encode('hex'),
+                         self.blockchain.header_to_string(header))
+        self.assertEqual(header['timestamp'], self.blockchain.store.timestamp(3000))
+
+    def test_save_header_overwrites_cached_fields(self):
+        header = self.blockchain.read_header(2015)
+        self.assertEqual(header['nonce'], self.blockchain.header_from_string(self.raw[2015*80:2016*80])['nonce'])
+        self.blockchain.store.timestamp(2015)
+        header['timestamp'] += 1
+        header['block_height'] = 2015
+        self.blockchain.save_header(header)
+        self.assertEqual(header['timestamp'], self.blockchain.store.timestamp(2015))
+        self.assertEqual(header['timestamp'], self.blockchain.read_header(2015)['timestamp'])
+
+
+class Test_HashIndex(BlockchainTestCase):
+
+    def test_get_hash_links_to_next_header(self):
+        for height in [0, 2014]:
+            next_header = self.blockchain.read_header(height + 1)
+            self.assertEqual(next_header['prev_block_hash'], self.blockchain.get_hash(height))
+
+    def test_genesis_parent_hash(self):
+        self.assertEqual("0"*64, self.blockchain.get_hash(-1))
+
+    def test_hashes_are_persisted(self):
+        h = self.blockchain.get_hash(10)
+        self.assertTrue(os.path.exists(os.path.join(self.electrum_dir, 'blockchain_hashes')))
+        blockchain = Blockchain(FakeConfig(self.electrum_dir), None)
+        self.assertEqual(h.decode('hex')[::-1], blockchain.store.get_hash(10))
+        self.assertEqual(None, blockchain.store.get_hash(9))
+
+    def test_save_header_invalidates_hashes_above(self):
+        self.blockchain.get_hash(100)
+        self.blockchain.get_hash(200)
+        header = self.blockchain.read_header(150)
+        header['block_height'] = 150
+        self.blockchain.save_header(header)
+        self.assertNotEqual(None, self.blockchain.store.get_hash(100))
+        self.assertEqual(None, self.blockchain.store.get_hash(200))
+
+    def test_connect_header_extends_chain(self):
+        with open(self.headers_path, 'wb') as f:
+            f.write(self.raw[:2000*80])
+        blockchain = Blockchain(FakeConfig(self.electrum_dir), None)
+        header = blockchain.header_from_string(self.raw[2000*80:2001*80])
+        header['block_height'] = 2000
+        # the sample chain does not follow the retargeting rules
+        blockchain.get_target = lambda index, chain=None: (header['bits'], 1 << 256)
+        self.assertTrue(blockchain.connect_header([], header))
+        self.assertEqual(2000, blockchain.height())
+        self.assertEqual(blockchain.read_header(2001 - 1)['nonce'], header['nonce'])
+        self.assertNotEqual(None, blockchain.store.get_hash(2000))
+
+
+class Test_ParallelVerification(BlockchainTestCase):
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(Test_ParallelVerification, self).tearDown()
+
+    def test_pool_is_opt_in(self):
+        self.assertEqual(1, self.blockchain.num_workers)
+        self.blockchain.compute_pow_hashes(self.raw[:12*80])
+        self.assertEqual(None, self.blockchain.pool)
+
+    def test_pool_matches_serial(self):
+        data = self.raw[:12*80]
+        self.blockchain.num_workers = 1
+        serial = self.blockchain.compute_pow_hashes(data)
+        self.blockchain.num_workers = 3
+        parallel = self.blockchain.compute_pow_hashes(data)
+        self.assertNotEqual(None, self.blockchain.pool)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(12, len(parallel))
+        self.assertEqual(self.raw[80*10+4:80*10+36], parallel[9])
+
+
+class Test_Checkpoints(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_Checkpoints, self).setUp()
+        self.checkpoints = self.make_checkpoints()
+        self.blockchain = self.checkpointed_blockchain()
+
+    def test_checkpointed_chunks_skip_pow(self):
+        self.assertEqual(1, self.blockchain.connect_chunk(0, self.raw[:2016*80].encode('hex')))
+        self.assertEqual(2, self.blockchain.connect_chunk(1, self.raw[2016*80:2*2016*80].encode('hex')))
+        self.assertEqual(2*2016 - 1, self.blockchain.height())
+        for height in [0, 2015, 2016, 4030]:
+            self.assertEqual(self.raw[(height+1)*80+4:(height+1)*80+36], self.blockchain.store.get_hash(height))
+        self.assertEqual(self.checkpoints[1][1], self.blockchain.get_hash(2*2016 - 1))
+
+    def test_tampered_chunk_is_rejected(self):
+        data = self.raw[:2016*80]
+        data = data[:1000] + chr(ord(data[1000]) ^ 1) + data[1001:]
+        self.assertEqual(-1, self.blockchain.connect_chunk(0, data.encode('hex')))
+        self.assertEqual(-1, self.blockchain.height())
+
+    def test_get_target_uses_table(self):
+        bits = self.checkpoints[1][2]
+        self.assertEqual((bits, self.blockchain.bits_to_target(bits)), self.blockchain.get_target(1))
+
+
+class Test_NewestCheckpoint(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_NewestCheckpoint, self).setUp()
+        self.checkpoints = self.make_checkpoints()[1:]
+        self.blockchain = self.checkpointed_blockchain()
+
+    def test_chunks_wait_for_checkpoint(self):
+        self.assertEqual(1, self.blockchain.connect_chunk(0, self.raw[:2016*80].encode('hex')))
+        self.assertEqual(-1, self.blockchain.height())
+        self.assertEqual(1, self.blockchain.next_chunk())
+        # pending chunks survive a restart
+        self.blockchain = self.checkpointed_blockchain()
+        self.assertEqual(1, self.blockchain.next_chunk())
+        self.assertEqual(2, self.blockchain.connect_chunk(1, self.raw[2016*80:2*2016*80].encode('hex')))
+        self.assertFalse(os.path.exists(self.headers_path + '.pending'))
+        self.assertEqual(2*2016 - 1, self.blockchain.height())
+        self.assertEqual(self.raw[:2*2016*80], open(self.headers_path, 'rb').read())
+        for height in [0, 2015, 4030]:
+            self.assertEqual(self.raw[(height+1)*80+4:(height+1)*80+36], self.blockchain.store.get_hash(height))
+
+    def test_pending_chunks_are_saved_in_batches(self):
+        self.addCleanup(setattr, blockchain_module, 'SAVE_BATCH', blockchain_module.SAVE_BATCH)
+        blockchain_module.SAVE_BATCH = 1
+        self.test_chunks_wait_for_checkpoint()
+
+    def test_tampered_chunk_below_checkpoint_is_rejected(self):
+        data = self.raw[:2016*80]
+        data = data[:1000] + chr(ord(data[1000]) ^ 1) + data[1001:]
+        self.assertEqual(1, self.blockchain.connect_chunk(0, data.encode('hex')))
+        self.assertEqual(0, self.blockchain.connect_chunk(1, self.raw[2016*80:2*2016*80].encode('hex')))
+        self.assertEqual(-1, self.blockchain.height())
+        self.assertEqual(0, self.blockchain.next_chunk())
+        self.assertFalse(os.path.exists(self.headers_path + '.pending'))
+
+    def test_partial_chunk_below_checkpoint_is_rejected(self):
+        self.assertEqual(-1, self.blockchain.connect_chunk(0, self.raw[:2000*80].encode('hex')))
+
+
+class HeadersRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        data = self.server.data
+        start = 0
+        if self.headers.getheader('Range'):
+            start = int(self.headers.getheader('Range')[6:-1])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.server.ranges.append(start)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        end = len(data)
+        if self.server.truncate:
+            end = self.server.truncate
+            self.server.truncate = None
+        self.wfile.write(data[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+class Test_Bootstrap(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_Bootstrap, self).setUp()
+        self.checkpoints = self.make_checkpoints()
+        os.remove(self.headers_path)
+        self.server = HTTPServer(('127.0.0.1', 0), HeadersRequestHandler)
+        self.server.data = self.raw[:2*2016*80]
+        self.server.ranges = []
+        self.server.truncate = None
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(Test_Bootstrap, self).tearDown()
+
+    def init_blockchain(self):
+        blockchain = self.checkpointed_blockchain()
+        blockchain.headers_url = 'http://127.0.0.1:%d/blockchain_headers' % self.server.server_port
+        blockchain.init()
+        return blockchain
+
+    def test_download(self):
+        blockchain = self.init_blockchain()
+        self.assertEqual(2*2016 - 1, blockchain.height())
+        self.assertEqual(self.server.data, open(self.headers_path, 'rb').read())
+        self.assertFalse(os.path.exists(self.headers_path + '.bootstrap'))
+        self.assertEqual([0], self.server.ranges)
+
+    def test_resume_after_interruption(self):
+        self.server.truncate = 3*2016*80/2
+        blockchain = self.init_blockchain()
+        self.assertEqual(2016 - 1, blockchain.height())
+        self.assertTrue(os.path.exists(self.headers_path + '.bootstrap'))
+        blockchain = self.init_blockchain()
+        self.assertEqual(2*2016 - 1, blockchain.height())
+        self.assertEqual([0, 2016*80], self.server.ranges)
+        self.assertFalse(os.path.exists(self.headers_path + '.bootstrap'))
+
+    def test_resume_before_checkpoint(self):
+        self.checkpoints = self.checkpoints[1:]
+        self.server.truncate = 3*2016*80/2
+        blockchain = self.init_blockchain()
+        self.assertEqual(-1, blockchain.height())
+        blockchain = self.init_blockchain()
+        self.assertEqual(2*2016 - 1, blockchain.height())
+        self.assertEqual([0, 2016*80], self.server.ranges)
+        self.assertEqual(self.server.data, open(self.headers_path, 'rb').read())
+
+    def test_bad_data_is_not_kept(self):
+        self.server.data = self.raw[:2016*80] + '\0' * 2016*80
+        blockchain = self.init_blockchain()
+        self.assertEqual(2016 - 1, blockchain.height())
+        self.assertFalse(os.path.exists(self.headers_path + '.bootstrap'))
+
+    def test_existing_file_is_not_downloaded(self):
+        open(self.headers_path, 'wb').close()
+        blockchain = self.init_blockchain()
+        self.assertEqual([], self.server.ranges)
@@ -0,0 +1,103 @@
+import unittest
+
+from lib.bitcoin import EC_KEY, public_key_to_bc_address, MIN_RELAY_TX_FEE
+from lib.coinchooser import CoinChooserOldest, CoinChooserLargest, CoinChooserConsolidate, CoinChooserBnB, CoinIndex, get_coin_chooser
+from lib.transaction import Transaction
+from lib.util import NotEnoughFunds
+
+
+PUBKEY = EC_KEY('\x01' * 32).get_public_key(True)
+ADDRESS = public_key_to_bc_address(PUBKEY.decode('hex'))
+COIN = 1000000
+
+
+class FakeWallet(object):
+    fee_per_kb = 100000
+
+    def add_input_info(self, coin):
+        coin['pubkeys'] = [PUBKEY]
+        coin['x_pubkeys'] = [PUBKEY]
+        coin['signatures'] = [None]
+        coin['num_sig'] = 1
+
+    def estimated_fee(self, tx):
+        fee = int(self.fee_per_kb * tx.estimated_size() / 1000.)
+        return max(fee, MIN_RELAY_TX_FEE)
+
+
+def make_coins(values):
+    return [{'address': ADDRESS, 'prevout_hash': '%064x' % n, 'prevout_n': 0,
+             'value': value, 'height': n}
+            for n, value in enumerate(values)]
+
+
+class TestCoinChooser(unittest.TestCase):
+
+    def make_tx(self, chooser, values, amount, fixed_fee=None):
+        tx = Transaction.from_io([], [('address', ADDRESS, amount)], nTime=1)
+        chooser = chooser(FakeWallet(), fixed_fee)
+        total, fee = chooser.make_tx(tx, make_coins(values), amount)
+        self.assertEqual(total, sum(txin['value'] for txin in tx.inputs))
+        self.assertTrue(total >= amount + fee)
+        return tx, fee
+
+    def input_values(self, tx):
+        return sorted(txin['value'] for txin in tx.inputs)
+
+    def test_oldest_spends_in_order(self):
+        tx, fee = self.make_tx(CoinChooserOldest, [3*COIN, 1*COIN, 5*COIN, 2*COIN], 7*COIN)
+        # 3, 1 and 5 are needed, then 1 is not
+        self.assertEqual([3*COIN, 5*COIN], self.input_values(tx))
+        self.assertEqual(MIN_RELAY_TX_FEE, fee)
+
+    def test_largest_uses_fewest_inputs(self):
+        tx, fee = self.make_tx(CoinChooserLargest, [1*COIN, 2*COIN, 9*COIN, 1*COIN], 3*COIN)
+        self.assertEqual([9*COIN], self.input_values(tx))
+
+    def test_consolidate_adds_small_coins(self):
+        tx, fee = self.make_tx(CoinChooserConsolidate, [5*COIN, 1*COIN, 1*COIN, 1*COIN], COIN/2)
+        self.assertEqual([COIN, COIN, COIN, 5*COIN], self.input_values(tx))
+        tx, fee = self.make_tx(CoinChooserOldest, [5*COIN, 1*COIN, 1*COIN, 1*COIN], COIN/2)
+        self.assertEqual([5*COIN], self.input_values(tx))
+
+    def test_bnb_finds_exact_match(self):
+        fee = 200000
+        values = [4*COIN, 3*COIN + fee, 6*COIN, 2*COIN]
+        tx, _ = self.make_tx(CoinChooserBnB, values, 5*COIN, fixed_fee=fee)
+        self.assertEqual([2*COIN, 3*COIN + fee], self.input_values(tx))
+
+    def test_bnb_estimated_fee(self):
+        values = [7*COIN, 1*COIN, 4*COIN, 3*COIN, 5*COIN]
+        tx, fee = self.make_tx(CoinChooserBnB, values, 6*COIN - MIN_RELAY_TX_FEE)
+        self.assertEqual(MIN_RELAY_TX_FEE, fee)
+        self.assertEqual(6*COIN, sum(self.input_values(tx)))
+        # oldest needs a change output
+        tx, fee = self.make_tx(CoinChooserOldest, values, 6*COIN - MIN_RELAY_TX_FEE)
+        self.assertEqual([7*COIN], self.input_values(tx))
+
+    def test_bnb_falls_back_to_oldest(self):
+        values = [3*COIN, 5*COIN, 7*COIN]
+        tx, fee = self.make_tx(CoinChooserBnB, values, 4*COIN, fixed_fee=0)
+        self.assertEqual([5*COIN], self.input_values(tx))
+
+    def test_coin_index(self):
+        index = CoinIndex(make_coins([3*COIN, 1*COIN, 5*COIN, 2*COIN]))
+        self.assertEqual([COIN, 2*COIN, 3*COIN, 5*COIN], [c['value'] for c in index.by_value()])
+        self.assertEqual([5*COIN, 3*COIN], [c['value'] for c in index.above(2*COIN)])
+        self.assertEqual([], index.above(5*COIN))
+
+    def test_index_is_not_modified(self):
+        coins = make_coins([3*COIN, 1*COIN, 5*COIN, 2*COIN])
+        index = CoinIndex(coins)
+        for name in ['oldest', 'largest', 'consolidate', 'bnb']:
+            tx = Transaction.from_io([], [('address', ADDRESS, 4*COIN)], nTime=1)
+            get_coin_chooser(name)(FakeWallet()).make_tx(tx, index, 4*COIN)
+            self.assertTrue(tx.inputs)
+        self.assertEqual(make_coins([3*COIN, 1*COIN, 5*COIN, 2*COIN]), coins)
+
+    def test_not_enough_funds(self):
+        for name in ['oldest', 'largest', 'consolidate', 'bnb']:
+            self.assertRaises(NotEnoughFunds, self.make_tx, get_coin_chooser(name), [COIN, COIN], 2*COIN)
+
+    def test_unknown_chooser(self):
+        self.assertRaises(BaseException, get_coin_chooser, 'random')
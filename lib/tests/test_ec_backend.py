@@ -0,0 +1,103 @@
+import hashlib
+import random
+import unittest
+
+import ecdsa
+
+from lib import bitcoin
+from lib.bitcoin import (ECBackend, EC_KEY, get_ec_backend, get_ec_backends, set_ec_backend,
+                         generator_secp256k1, number_to_string, bip32_root, bip32_public_derivation,
+                         Hash, public_key_to_bc_address)
+
+
+ORDER = generator_secp256k1.order()
+
+
+class TestECBackends(unittest.TestCase):
+    """Every available backend must match the reference one."""
+
+    def setUp(self):
+        super(TestECBackends, self).setUp()
+        self.reference = ECBackend()
+        self.backends = get_ec_backends()
+        self.rand = random.Random(42)
+        self.saved_backend = bitcoin.ec_backend
+
+    def tearDown(self):
+        set_ec_backend(self.saved_backend)
+        super(TestECBackends, self).tearDown()
+
+    def scalars(self, n=5):
+        return [1, 2, ORDER - 1] + [self.rand.randrange(1, ORDER) for i in range(n)]
+
+    def sign(self, k, h):
+        key = ecdsa.SigningKey.from_secret_exponent(k, curve=ecdsa.SECP256k1)
+        return key.sign_digest_deterministic(h, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_string)
+
+    def test_reference_is_available(self):
+        self.assertEqual('python-ecdsa', self.backends[-1].name)
+        self.assertTrue('python-table' in [b.name for b in self.backends])
+        self.assertTrue(get_ec_backend().name in [b.name for b in self.backends])
+
+    def test_mul_generator(self):
+        for k in self.scalars():
+            expected = self.reference.mul_generator(k)
+            for backend in self.backends:
+                self.assertEqual(expected, backend.mul_generator(k), backend.name)
+
+    def test_add_mul_generator(self):
+        for k in self.scalars():
+            point = self.reference.mul_generator(self.rand.randrange(1, ORDER))
+            expected = self.reference.add_mul_generator(point, k)
+            for backend in self.backends:
+                self.assertEqual(expected, backend.add_mul_generator(point, k), backend.name)
+
+    def test_mul_point(self):
+        for k in self.scalars():
+            point = self.reference.mul_generator(self.rand.randrange(1, ORDER))
+            expected = self.reference.mul_point(point, k)
+            for backend in self.backends:
+                self.assertEqual(expected, backend.mul_point(point, k), backend.name)
+
+    def test_sign_digest(self):
+        for k in self.scalars():
+            h = Hash(str(k))
+            expected = ecdsa.util.sigdecode_string(self.sign(k, h), ORDER)
+            for backend in self.backends:
+                self.assertEqual(expected, backend.sign_digest(k, h), backend.name)
+
+    def test_recover_and_verify(self):
+        for i in range(8):
+            k = self.rand.randrange(1, ORDER)
+            h = Hash(str(i))
+            sig = self.sign(k, h)
+            point = self.reference.mul_generator(k)
+            r, s = ecdsa.util.sigdecode_string(sig, ORDER)
+            # both encodings of the signature are valid
+            other = ecdsa.util.sigencode_string(r, ORDER - s, ORDER)
+            bad = ecdsa.util.sigencode_string(r, (s + 1) % ORDER, ORDER)
+            for backend in self.backends:
+                self.assertTrue(backend.verify_digest(point, sig, h), backend.name)
+                self.assertTrue(backend.verify_digest(point, other, h), backend.name)
+                self.assertFalse(backend.verify_digest(point, bad, h), backend.name)
+                self.assertFalse(backend.verify_digest(point, sig, Hash('x')), backend.name)
+                recovered = []
+                for recid in range(4):
+                    try:
+                        recovered.append(backend.recover_pubkey(sig, recid, h))
+                    except Exception:
+                        continue
+                self.assertTrue(point in recovered, backend.name)
+
+    def test_keys_and_signatures(self):
+        xpub = bip32_root('backend test')[1]
+        secret = number_to_string(self.rand.randrange(1, ORDER), ORDER)
+        results = []
+        for backend in self.backends:
+            set_ec_backend(backend)
+            key = EC_KEY(secret)
+            address = public_key_to_bc_address(key.get_public_key(True).decode('hex'))
+            sig = key.sign_message('hello', True, address)
+            EC_KEY.verify_message(address, sig, 'hello')
+            results.append((key.get_public_key(False), sig, bip32_public_derivation(xpub, "", "/1/5")))
+        self.assertEqual(1, len(set(results)))
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.bitcoin import generator_secp256k1
+from lib.ecmult import GeneratorTable, N
+
+
+class TestGeneratorTable(unittest.TestCase):
+
+    def setUp(self):
+        super(TestGeneratorTable, self).setUp()
+        self.table = GeneratorTable(window=4)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestGeneratorTable, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def expected(self, k):
+        Q = generator_secp256k1 * k
+        return Q.x(), Q.y()
+
+    def test_mul_matches_ecdsa(self):
+        for k in [1, 2, 15, 16, 0xff << 200, N - 1, N + 5, int('f' * 64, 16)]:
+            self.assertEqual(self.expected(k), self.table.mul_affine(k))
+
+    def test_mul_by_order_is_infinity(self):
+        self.assertEqual((None, None), self.table.mul_affine(N))
+
+    def test_add_mul(self):
+        point = self.expected(12345)
+        self.assertEqual(self.expected(12345 + 678), self.table.add_mul(point, 678))
+        # doubling and inverse
+        self.assertEqual(self.expected(2 * 12345), self.table.add_mul(point, 12345))
+        self.assertEqual((None, None), self.table.add_mul(point, N - 12345))
+
+    def test_save_and_load(self):
+        path = os.path.join(self.path, 'table')
+        self.table.save(path)
+        self.assertEqual(self.table.file_size(), os.path.getsize(path))
+        table = GeneratorTable.load(path, window=4)
+        self.assertEqual(self.table.rows, table.rows)
+        self.assertEqual(None, GeneratorTable.load(path, window=5))
+        self.assertEqual(None, GeneratorTable.load(os.path.join(self.path, 'missing'), window=4))
+
+    def test_damaged_file_is_rejected(self):
+        path = os.path.join(self.path, 'table')
+        self.table.save(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:1000] + chr(ord(data[1000]) ^ 1) + data[1001:])
+        self.assertEqual(None, GeneratorTable.load(path, window=4))
+
+    def test_swapped_points_are_rejected(self):
+        path = os.path.join(self.path, 'table')
+        rows = [list(row) for row in self.table.rows]
+        rows[1][3], rows[1][4] = rows[1][4], rows[1][3]
+        GeneratorTable(window=4, rows=rows).save(path)
+        self.assertEqual(None, GeneratorTable.load(path, window=4))
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 from lib import interface
@@ -22,3 +25,157 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(interface.check_host_name(
             peercert={'subject': [('commonName', '*.bar.com')]},
             name='foo.bar.com'))
+
+
+class FakePipe(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, request):
+        self.sent.append(request)
+
+
+class FakeConfig(object):
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+
+    def get(self, key, default=None):
+        return self.batch_size if key == 'rpc_batch_size' else default
+
+
+class TestBatchRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.response_queue = interface.Queue.Queue()
+        self.interface = self.make_interface(3)
+
+    def tearDown(self):
+        interface.no_batch_servers.clear()
+
+    def make_interface(self, batch_size):
+        i = interface.TcpInterface('localhost:50001:t', self.response_queue, FakeConfig(batch_size))
+        i.pipe = FakePipe()
+        i._status = interface.CS_CONNECTED
+        return i
+
+    def queue_requests(self, i, n):
+        for j in range(n):
+            i.send_request({'method': 'blockchain.address.subscribe', 'params': ['a%d' % j], 'id': 100 + j})
+
+    def responses(self):
+        out = []
+        while not self.response_queue.empty():
+            out.append(self.response_queue.get()[1])
+        return out
+
+    def test_requests_are_batched(self):
+        self.queue_requests(self.interface, 5)
+        self.interface.send_requests()
+        # nothing more is sent until the first batch is answered
+        self.assertEqual(1, len(self.interface.pipe.sent))
+        batch = self.interface.pipe.sent[0]
+        self.assertEqual([0, 1, 2], [r['id'] for r in batch])
+
+        self.interface.process_response([{'id': 1, 'result': 'x'}, {'id': 0, 'result': 'y'}])
+        self.assertTrue(self.interface.batch_supported)
+        self.interface.send_requests()
+        self.assertEqual(2, len(self.interface.pipe.sent))
+        self.assertEqual([3, 4], [r['id'] for r in self.interface.pipe.sent[1]])
+
+        responses = self.responses()
+        self.assertEqual([101, 100], [r['id'] for r in responses])
+        self.assertEqual(['a1'], responses[0]['params'])
+        self.assertEqual('x', responses[0]['result'])
+        self.assertEqual([2, 3, 4], sorted(self.interface.unanswered_requests))
+
+    def test_single_request_is_not_wrapped(self):
+        self.queue_requests(self.interface, 1)
+        self.interface.send_requests()
+        self.assertEqual(0, self.interface.pipe.sent[0]['id'])
+        self.assertEqual(None, self.interface.batch_supported)
+
+    def test_rejected_batch_is_resent(self):
+        self.queue_requests(self.interface, 4)
+        self.interface.send_requests()
+        self.interface.process_response({'id': None, 'error': 'invalid request'})
+        self.assertFalse(self.interface.batch_supported)
+        self.assertEqual([0, 1, 2], [r['id'] for r in self.interface.pipe.sent[1:]])
+        self.interface.send_requests()
+        self.assertEqual(3, self.interface.pipe.sent[-1]['id'])
+        self.assertEqual([], self.responses())
+
+        i = self.make_interface(3)
+        self.queue_requests(i, 2)
+        i.send_requests()
+        self.assertEqual([0, 1], [r['id'] for r in i.pipe.sent])
+
+    def test_batch_size_one_disables_batches(self):
+        i = self.make_interface(1)
+        self.queue_requests(i, 2)
+        i.send_requests()
+        self.assertEqual([0, 1], [r['id'] for r in i.pipe.sent])
+
+
+class TestInterfaceStats(unittest.TestCase):
+
+    def test_responses_are_timed(self):
+        i = interface.TcpInterface('localhost:50001:t', interface.Queue.Queue(), FakeConfig(1))
+        i.pipe = FakePipe()
+        i._status = interface.CS_CONNECTED
+        i.send_request({'method': 'server.version', 'params': []})
+        i.send_request({'method': 'blockchain.address.get_history', 'params': ['a']})
+        i.send_requests()
+        i.request_times[0] -= 0.2
+        i.process_response({'id': 0, 'result': '1.0'})
+        i.process_response({'id': 1, 'error': 'busy'})
+        stats = i.stats.as_dict()
+        self.assertTrue(0.2 <= stats['ping'] < 1)
+        self.assertEqual(['blockchain.address.get_history'], stats['response_times'].keys())
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual(0.5, stats['failure_rate'])
+        self.assertEqual({}, i.request_times)
+
+    def test_score(self):
+        fast = interface.InterfaceStats()
+        slow = interface.InterfaceStats()
+        unknown = interface.InterfaceStats()
+        for n in range(10):
+            fast.on_response('server.version', 0.05, None)
+            slow.on_response('server.version', 0.4, None)
+        self.assertTrue(fast.score() < slow.score() < unknown.score())
+        fast.on_header(2.0)
+        self.assertTrue(slow.score() < fast.score())
+        slow.on_timeout(10)
+        self.assertEqual(0.5, slow.failure_rate())
+        self.assertTrue(unknown.score() < slow.score())
+        unknown.blocks_behind = 1
+        self.assertTrue(slow.score() < unknown.score())
+
+
+class TestSSLContexts(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSSLContexts, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.cert_path = os.path.join(self.path, 'host')
+        shutil.copy(interface.ca_path, self.cert_path)
+
+    def tearDown(self):
+        super(TestSSLContexts, self).tearDown()
+        interface.forget_ssl_context(self.cert_path)
+        shutil.rmtree(self.path)
+
+    def test_contexts_are_cached(self):
+        context = interface.get_ssl_context(self.cert_path)
+        self.assertEqual(interface.ssl.CERT_REQUIRED, context.verify_mode)
+        self.assertTrue(context is interface.get_ssl_context(self.cert_path))
+        self.assertEqual(interface.ssl.CERT_NONE, interface.get_ssl_context(None).verify_mode)
+        # the file changed
+        mtime = os.path.getmtime(self.cert_path)
+        os.utime(self.cert_path, (mtime + 10, mtime + 10))
+        self.assertFalse(context is interface.get_ssl_context(self.cert_path))
+        context = interface.get_ssl_context(self.cert_path)
+        interface.forget_ssl_context(self.cert_path)
+        self.assertFalse(context is interface.get_ssl_context(self.cert_path))
@@ -0,0 +1,139 @@
+import shutil
+import tempfile
+import unittest
+
+from lib import util
+from lib.interface import InterfaceStats
+from lib.network import Network
+from lib.simple_config import SimpleConfig
+
+
+class FakeInterface(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.stats = InterfaceStats()
+        self.sent = []
+
+    def is_connected(self):
+        return True
+
+    def send_request(self, request):
+        self.sent.append(request)
+
+    def print_error(self, *msg):
+        pass
+
+
+class NetworkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(NetworkTestCase, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        config = SimpleConfig({'electrum_path': self.electrum_dir, 'server': '127.0.0.1:1:t',
+                               'oneserver': True, 'max_in_flight': 2})
+        self.network = Network(util.QueuePipe(), config)
+        self.interfaces = [FakeInterface('s%d:50001:t' % n) for n in range(4)]
+        self.network.interfaces = dict((i.server, i) for i in self.interfaces)
+        self.network.interface = self.interfaces[0]
+        for i in self.interfaces:
+            self.network.heights[i.server] = 100
+            self.network.merkle_roots[i.server] = 'a'
+        # on another chain
+        self.network.merkle_roots['s3:50001:t'] = 'b'
+        # status notifications
+        self.network.response_queue.get_all()
+        self.request_id = 0
+
+    def tearDown(self):
+        super(NetworkTestCase, self).tearDown()
+        shutil.rmtree(self.electrum_dir)
+
+
+class TestFanout(NetworkTestCase):
+
+    def request(self, method='blockchain.transaction.get'):
+        self.request_id += 1
+        return {'method': method, 'params': ['x'], 'id': self.request_id}
+
+    def sent(self):
+        return [len(i.sent) for i in self.interfaces]
+
+    def test_requests_are_spread(self):
+        for n in range(6):
+            self.assertTrue(self.network.process_request(self.request()))
+        self.assertEqual([2, 2, 2, 0], self.sent())
+        self.network.fanout_full = False
+        self.assertFalse(self.network.process_request(self.request()))
+        # subscriptions stay on the main server
+        self.assertTrue(self.network.process_request(self.request('blockchain.address.subscribe')))
+        self.assertEqual([3, 2, 2, 0], self.sent())
+        # and so do histories, which depend on the mempool of the server
+        self.assertTrue(self.network.process_request(self.request('blockchain.address.get_history')))
+        self.assertEqual([4, 2, 2, 0], self.sent())
+
+    def test_response(self):
+        self.network.process_request(self.request())
+        i = self.network.fanout_requests[1][1]
+        self.network.process_response(i, {'method': 'blockchain.transaction.get', 'params': ['x'],
+                                          'result': 'tx', 'id': 1})
+        self.assertEqual({}, self.network.fanout_requests)
+        self.assertEqual(0, self.network.in_flight[i.server])
+        self.assertEqual('tx', self.network.response_queue.get_nowait()['result'])
+
+    def test_error_is_retried_on_main_server(self):
+        main = self.interfaces[0]
+        self.network.in_flight[main.server] = 1
+        self.network.process_request(self.request())
+        i = self.network.fanout_requests[1][1]
+        self.assertNotEqual(main, i)
+        self.network.process_response(i, {'method': 'blockchain.transaction.get', 'params': ['x'],
+                                          'error': 'not found', 'id': 1})
+        self.assertTrue(self.network.response_queue.empty())
+        self.network.handle_requests()
+        self.assertEqual([1], [r['id'] for r in main.sent])
+        self.assertEqual({}, self.network.fanout_requests)
+        self.network.process_response(main, {'method': 'blockchain.transaction.get', 'params': ['x'],
+                                             'error': 'not found', 'id': 1})
+        self.assertEqual('not found', self.network.response_queue.get_nowait()['error'])
+
+    def test_retry_on_timeout(self):
+        self.network.process_request(self.request())
+        request, i, t = self.network.fanout_requests[1]
+        self.network.fanout_requests[1] = request, i, t - 60
+        self.network.handle_requests()
+        other = self.network.fanout_requests[1][1]
+        self.assertNotEqual(i, other)
+        self.assertEqual([1], [r['id'] for r in other.sent])
+        self.assertEqual(1, i.stats.timeouts)
+        # a late answer is ignored
+        self.network.process_response(i, {'method': 'blockchain.transaction.get', 'params': ['x'],
+                                          'result': 'tx', 'id': 1})
+        self.assertTrue(self.network.response_queue.empty())
+        self.assertEqual(1, self.network.in_flight[other.server])
+
+
+class TestInterfaceStatus(NetworkTestCase):
+
+    def test_status_values(self):
+        self.assertEqual(sorted(i.server for i in self.interfaces),
+                         sorted(self.network.get_status_value('interfaces')))
+        stats = self.network.get_status_value('interface_stats')
+        self.assertEqual(sorted(self.network.get_interfaces()), sorted(stats))
+        self.assertEqual(InterfaceStats.DEFAULT_PING, stats['s1:50001:t']['score'])
+
+    def test_switch_lagging_interface(self):
+        switched = []
+        self.network.auto_connect = True
+        self.network.server_is_lagging = lambda: True
+        self.network.switch_to_interface = switched.append
+        self.network.switch_lagging_interface('s2:50001:t')
+        self.assertEqual(['s2:50001:t'], switched)
+        # a suggestion that scores clearly worse is not taken
+        for n in range(5):
+            self.interfaces[1].stats.on_response('server.version', 0.1, None)
+            self.interfaces[2].stats.on_response('server.version', 3.0, None)
+        self.network.switch_lagging_interface('s2:50001:t')
+        self.assertEqual('s1:50001:t', switched[-1])
+        self.network.switch_lagging_interface('s9:50001:t')
+        self.assertEqual('s1:50001:t', switched[-1])
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import unittest
+
+import ecdsa
+
+from lib.bitcoin import EC_KEY, SECP256k1, SecretToASecret, public_key_to_bc_address, Hash
+from lib.transaction import Transaction, TxInput, TxOutput, SignatureHasher
+from lib.util import MyEncoder
+
+
+COINBASE_TX = ('01000000' + '00e1f505' + '01' + '00' * 32 + 'ffffffff' + '02' + '0101' + 'ffffffff'
+               + '01' + '00e1f50500000000' + '01' + '51' + '00000000')
+
+
+class TestTransaction(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTransaction, self).setUp()
+        secret = '\x01' * 32
+        self.sec = SecretToASecret(secret, True)
+        self.pubkey = EC_KEY(secret).get_public_key(True)
+        self.address = public_key_to_bc_address(self.pubkey.decode('hex'))
+        txin = {
+            'prevout_hash': 'ab' * 32,
+            'prevout_n': 1,
+            'address': self.address,
+            'pubkeys': [self.pubkey],
+            'x_pubkeys': [self.pubkey],
+            'signatures': [None],
+            'num_sig': 1,
+            'value': 2000,
+        }
+        outputs = [('address', self.address, 1500), ('address', self.address, 400)]
+        self.tx = Transaction.from_io([txin], outputs, nTime=1440000000)
+        self.tx.sign({self.pubkey: self.sec})
+
+    def test_deserialize_signed(self):
+        tx = Transaction(self.tx.raw)
+        d = tx.deserialize()
+        self.assertEqual(1440000000, tx.time)
+        self.assertEqual(1440000000, d['nTime'])
+        txin = tx.inputs[0]
+        self.assertTrue(isinstance(txin, TxInput))
+        self.assertEqual('ab' * 32, txin['prevout_hash'])
+        self.assertEqual(1, txin['prevout_n'])
+        self.assertEqual(False, txin.get('is_coinbase'))
+        self.assertEqual(self.address, txin.get('address'))
+        self.assertEqual([self.pubkey], txin['pubkeys'])
+        self.assertEqual(self.tx.inputs[0]['signatures'], txin['signatures'])
+        self.assertEqual(None, txin.get('redeemScript'))
+        self.assertTrue(tx.is_complete())
+        self.assertEqual([('address', self.address, 1500), ('address', self.address, 400)],
+                         list(tuple(o) for o in tx.outputs))
+        self.assertEqual(1900, tx.output_value())
+
+    def test_fields_are_parsed_on_access(self):
+        tx = Transaction(self.tx.raw)
+        tx.deserialize()
+        txin = tx.inputs[0]
+        self.assertEqual(0, txin.state)
+        txin['prevout_n']
+        self.assertEqual(1, txin.state)
+        txin['address']
+        self.assertEqual(2, txin.state)
+        self.assertFalse(tx.outputs[1].parsed)
+        _type, address, value = tx.outputs[1]
+        self.assertEqual(400, value)
+        self.assertEqual(1, tx.outputs[1]['prevout_n'])
+
+    def test_reserialize(self):
+        tx = Transaction(self.tx.raw)
+        tx.deserialize()
+        self.assertEqual(self.tx.raw, tx.serialize())
+
+    def test_setitem_and_extra_keys(self):
+        tx = Transaction(self.tx.raw)
+        tx.deserialize()
+        txin = tx.inputs[0]
+        txin['value'] = 2000
+        txin['signatures'][0] = None
+        self.assertEqual(2000, txin['value'])
+        self.assertTrue('value' in txin)
+        self.assertFalse('redeemScript' in txin)
+        self.assertFalse(tx.is_complete())
+        self.assertRaises(KeyError, lambda: txin['foo'])
+
+    def test_coinbase(self):
+        tx = Transaction(COINBASE_TX)
+        d = tx.deserialize()
+        txin = tx.inputs[0]
+        self.assertTrue(txin['is_coinbase'])
+        self.assertEqual('0101', txin['scriptSig'])
+        self.assertEqual(None, txin.get('address'))
+        self.assertEqual(None, txin.get('prevout_hash'))
+        self.assertEqual(['is_coinbase', 'scriptSig'], sorted(txin.keys()))
+        self.assertEqual(('script', '\x51', 100000000), tuple(tx.outputs[0]))
+
+    def test_json(self):
+        d = Transaction(COINBASE_TX).deserialize()
+        out = json.loads(json.dumps(d, cls=MyEncoder))
+        self.assertEqual({'is_coinbase': True, 'scriptSig': '0101'}, out['inputs'][0])
+        self.assertEqual(100000000, out['outputs'][0]['value'])
+        self.assertEqual('51', out['outputs'][0]['scriptPubKey'])
+
+    def test_truncated(self):
+        self.assertRaises(Exception, Transaction(COINBASE_TX[:-20]).deserialize)
+
+
+class TestSignatureHasher(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSignatureHasher, self).setUp()
+        self.keypairs = {}
+        inputs = []
+        for n in range(1, 5):
+            secret = chr(n) * 32
+            pubkey = EC_KEY(secret).get_public_key(True)
+            self.keypairs[pubkey] = SecretToASecret(secret, True)
+            inputs.append({
+                'prevout_hash': ('%02x' % n) * 32,
+                'prevout_n': n,
+                'address': public_key_to_bc_address(pubkey.decode('hex')),
+                'pubkeys': [pubkey],
+                'x_pubkeys': [pubkey],
+                'signatures': [None],
+                'num_sig': 1,
+                'value': 1000 * n,
+            })
+        outputs = [('address', inputs[0]['address'], 5000), ('address', inputs[1]['address'], 4000)]
+        self.tx = Transaction.from_io(inputs, outputs, nTime=1440000000)
+
+    def test_hashes_match_serialization(self):
+        hasher = SignatureHasher(self.tx)
+        for i in range(len(self.tx.inputs)):
+            self.assertEqual(Hash(self.tx.tx_for_sig(i).decode('hex')), hasher.get(i))
+
+    def test_signatures_match_serialization(self):
+        self.tx.sign(self.keypairs)
+        self.assertTrue(self.tx.is_complete())
+        for i, txin in enumerate(self.tx.inputs):
+            for_sig = Hash(self.tx.tx_for_sig(i).decode('hex'))
+            private_key = ecdsa.SigningKey.from_secret_exponent(EC_KEY(chr(i + 1) * 32).secret, curve=SECP256k1)
+            sig = private_key.sign_digest_deterministic(for_sig, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_der)
+            self.assertEqual(sig.encode('hex'), txin['signatures'][0])
+
+
+class TestTxSizeEstimator(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTxSizeEstimator, self).setUp()
+        self.keys = [EC_KEY(chr(n) * 32) for n in range(1, 16)]
+        self.address = public_key_to_bc_address(self.keys[0].get_public_key(True).decode('hex'))
+
+    def p2pkh_input(self, n, compressed=True, with_pubkey=True):
+        key = self.keys[n % len(self.keys)]
+        pubkey = key.get_public_key(compressed)
+        return {
+            'prevout_hash': ('%02x' % (n % 256)) * 32,
+            'prevout_n': n,
+            'address': public_key_to_bc_address(pubkey.decode('hex')),
+            'pubkeys': [pubkey if with_pubkey else None],
+            'x_pubkeys': [pubkey],
+            'signatures': [None],
+            'num_sig': 1,
+            'value': 1000,
+        }
+
+    def multisig_input(self, n, m, compressed=True):
+        pubkeys = [key.get_public_key(compressed) for key in self.keys[:n]]
+        return {
+            'prevout_hash': 'cd' * 32,
+            'prevout_n': 0,
+            'address': self.address,
+            'pubkeys': pubkeys,
+            'x_pubkeys': pubkeys,
+            'signatures': [None] * n,
+            'num_sig': m,
+            'redeemScript': Transaction.multisig_script(pubkeys, m),
+            'value': 1000,
+        }
+
+    def assertSize(self, tx):
+        self.assertEqual(len(tx.serialize(-1))/2, tx.estimated_size())
+
+    def test_input_types(self):
+        inputs = [self.p2pkh_input(0), self.p2pkh_input(1, compressed=False),
+                  self.p2pkh_input(2, with_pubkey=False), self.multisig_input(3, 2),
+                  self.multisig_input(15, 15, compressed=False)]
+        outputs = [('address', self.address, 1000), ('script', '\x6a\x04abcd', 0)]
+        for txin in inputs:
+            self.assertSize(Transaction.from_io([txin], outputs, nTime=1))
+        self.assertSize(Transaction.from_io(inputs, outputs, nTime=1))
+
+    def test_incremental(self):
+        tx = Transaction.from_io([], [('address', self.address, 1000)], nTime=1)
+        self.assertSize(tx)
+        inputs = [self.p2pkh_input(n) for n in range(260)]
+        for txin in inputs:
+            tx.add_input(txin)
+            if len(tx.inputs) in [1, 252, 253, 254, 260]:
+                self.assertSize(tx)
+        for txin in inputs[:10]:
+            tx.remove_input(txin)
+        self.assertSize(tx)
+        output = ('address', self.address, 5)
+        tx.add_output(output)
+        self.assertSize(tx)
+        tx.remove_output(output)
+        self.assertSize(tx)
+
+    def test_output_count_boundary(self):
+        tx = Transaction.from_io([self.p2pkh_input(0)], [], nTime=1)
+        for n in range(253):
+            tx.add_output(('address', self.address, n))
+        self.assertSize(tx)
+
+    def test_direct_changes_are_noticed(self):
+        tx = Transaction.from_io([self.p2pkh_input(0)], [('address', self.address, 1)], nTime=1)
+        tx.estimated_size()
+        tx.inputs.append(self.multisig_input(2, 1))
+        self.assertSize(tx)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib import simple_config, tx_cache
+from lib.bitcoin import Hash, hash_encode
+from lib.tx_cache import TxCache, get_tx_cache
+
+
+def make_tx(n):
+    raw = ('%02x' % n) * 100
+    return hash_encode(Hash(raw.decode('hex'))), raw
+
+
+class FakeConfig(object):
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+
+    def get(self, key, default=None):
+        return self.options.get(key, default)
+
+
+class TestTxCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTxCache, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.cache = TxCache(os.path.join(self.path, 'transactions'), 1000)
+
+    def tearDown(self):
+        super(TestTxCache, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        tx_hash, raw = make_tx(1)
+        self.assertEqual(None, self.cache.get(tx_hash))
+        self.assertTrue(self.cache.put(tx_hash, raw))
+        self.assertEqual(raw, self.cache.get(tx_hash))
+        self.assertEqual(100, os.path.getsize(self.cache.file_path(tx_hash)))
+
+    def test_wrong_hash_is_not_stored(self):
+        tx_hash, raw = make_tx(1)
+        other_hash, other_raw = make_tx(2)
+        self.assertFalse(self.cache.put(tx_hash, other_raw))
+        self.assertEqual(None, self.cache.get(tx_hash))
+
+    def test_corrupted_entry_is_removed(self):
+        tx_hash, raw = make_tx(1)
+        self.cache.put(tx_hash, raw)
+        with open(self.cache.file_path(tx_hash), 'wb') as f:
+            f.write('\0' * 100)
+        self.assertEqual(None, self.cache.get(tx_hash))
+        self.assertFalse(os.path.exists(self.cache.file_path(tx_hash)))
+
+    def test_invalid_hash_is_rejected(self):
+        victim = os.path.join(self.path, 'victim')
+        with open(victim, 'w') as f:
+            f.write('data')
+        tx_hash, raw = make_tx(1)
+        for name in [victim, '../victim', tx_hash.upper(), tx_hash + '/..', None]:
+            self.assertEqual(None, self.cache.get(name))
+            self.assertFalse(self.cache.put(name, raw))
+            self.cache.remove(name)
+        self.assertTrue(os.path.exists(victim))
+
+    def test_least_recently_used_are_evicted(self):
+        txs = [make_tx(n) for n in range(12)]
+        for i, (tx_hash, raw) in enumerate(txs[:9]):
+            self.cache.put(tx_hash, raw)
+            os.utime(self.cache.file_path(tx_hash), (1000 + i, 1000 + i))
+        # reading the oldest entry makes it the most recent
+        self.cache.get(txs[0][0])
+        self.cache.put(*txs[9])
+        self.cache.put(*txs[10])
+        self.assertEqual(900, sum(size for mtime, size, name in self.cache.list_files()))
+        self.assertEqual(None, self.cache.get(txs[1][0]))
+        self.assertEqual(None, self.cache.get(txs[2][0]))
+        self.assertEqual(txs[0][1], self.cache.get(txs[0][0]))
+        self.assertEqual(txs[10][1], self.cache.get(txs[10][0]))
+
+    def test_get_tx_cache_follows_config(self):
+        saved = simple_config.get_config()
+        try:
+            simple_config.set_config(FakeConfig(self.path, {'tx_cache_size': 0}))
+            self.assertEqual(None, get_tx_cache())
+            simple_config.set_config(FakeConfig(self.path, {}))
+            cache = get_tx_cache()
+            self.assertEqual(os.path.join(self.path, 'transactions'), cache.path)
+            self.assertTrue(cache is get_tx_cache())
+        finally:
+            simple_config.set_config(saved)
+            tx_cache.tx_cache = None
@@ -1,5 +1,7 @@
+import select
 import unittest
-from lib.util import format_satoshis, parse_URI
+import socket
+from lib.util import format_satoshis, parse_URI, LRUCache, SelectableQueue, SocketPipe, socket_pair
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +70,72 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+
+    def test_selectable_queue(self):
+        q = SelectableQueue()
+        self.assertEqual([], select.select([q], [], [], 0)[0])
+        q.put(1)
+        q.put(2)
+        self.assertEqual([q], select.select([q], [], [], 0)[0])
+        self.assertEqual([1, 2], q.get_all())
+        self.assertEqual([], select.select([q], [], [], 0)[0])
+
+    def test_socket_pipe_get_all(self):
+        a, b = socket_pair()
+        pipe = SocketPipe(a)
+        pipe.set_timeout(0)
+        self.assertEqual([], pipe.get_all())
+        b.sendall('{"id": 1}\n{"id": 2}\n{"id"')
+        self.assertEqual([{'id': 1}, {'id': 2}], pipe.get_all())
+        b.sendall(': 3}\n')
+        b.close()
+        self.assertEqual([{'id': 3}], pipe.get_all())
+        self.assertEqual(None, pipe.get_all())
+
+    def test_socket_pipe_large_message(self):
+        a, b = socket_pair()
+        pipe = SocketPipe(a)
+        result = 'ab' * 200000
+        for data in ['{"id": 1, "result": "', result[:100000], result[100000:], '"}\nnot json\n{"id": 2}', '\n']:
+            pipe.feed(data)
+        self.assertEqual([{'id': 1, 'result': result}, {'id': 2}], list(pipe.messages))
+        b.close()
+        self.assertEqual({'id': 1, 'result': result}, pipe.get())
+        self.assertEqual({'id': 2}, pipe.get())
+        self.assertEqual(None, pipe.get())
+
+    def test_socket_pipe_send_does_not_block(self):
+        a, b = socket_pair()
+        pipe = SocketPipe(a)
+        pipe.set_timeout(0)
+        result = 'ab' * 2000000
+        pipe.send({'id': 1, 'result': result})
+        self.assertTrue(pipe.pending_output() > 0)
+        reader = SocketPipe(b)
+        reader.set_timeout(0)
+        received = []
+        while not received:
+            select.select([b], [a] if pipe.pending_output() else [], [], 1.0)
+            pipe.flush()
+            received += reader.get_all()
+        self.assertEqual([{'id': 1, 'result': result}], received)
+        self.assertEqual(0, pipe.pending_output())
+
+    def test_socket_pipe_send_to_closed_peer(self):
+        a, b = socket_pair()
+        pipe = SocketPipe(a)
+        pipe.set_timeout(0)
+        b.close()
+        with self.assertRaises(socket.error):
+            for i in range(10):
+                pipe.send({'id': i})
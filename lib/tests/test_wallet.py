@@ -6,7 +6,19 @@ import os
 import json
 
 from StringIO import StringIO
-from lib.wallet import WalletStorage, NewWallet
+from lib.wallet import WalletStorage, NewWallet, COINBASE_MATURITY
+from lib.account import ImportedAccount, BIP32_Account, Multisig_Account
+from lib.bitcoin import bip32_root, bip32_public_derivation, deserialize_xkey
+
+
+class FakeTransaction(object):
+
+    def __init__(self, inputs, outputs):
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def deserialize(self):
+        pass
 
 
 class FakeSynchronizer(object):
@@ -64,6 +76,114 @@ class TestWalletStorage(WalletTestCase):
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
 
+    def test_put_appends_to_journal(self):
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps({"a": "b", "c": "d"}))
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "x")
+        storage.put("c", None)
+        storage.commit()
+        self.assertEqual({"a": "b", "c": "d"}, json.loads(open(self.wallet_path).read()))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("x", storage.get("a"))
+        self.assertEqual(None, storage.get("c"))
+
+    def test_truncated_journal_entry_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        with open(storage.journal_path(), "a") as f:
+            f.write('["c", "d')
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.file_exists)
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual(None, storage.get("c"))
+
+    def test_commits_after_truncated_entry_are_kept(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        with open(storage.journal_path(), "a") as f:
+            f.write('["c", {"x"')
+        storage = WalletStorage(self.wallet_path)
+        storage.put("d", 4)
+        storage.put("e", 5)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual(4, storage.get("d"))
+        self.assertEqual(5, storage.get("e"))
+
+    def test_dict_changes_are_journaled(self):
+        storage = WalletStorage(self.wallet_path)
+        history = dict(("addr%d" % i, [["%064x" % i, i]]) for i in range(100))
+        storage.put("addr_history", history)
+        size = os.path.getsize(storage.journal_path())
+        history["addr1"].append(["ff" * 32, 0])
+        del history["addr2"]
+        history["new"] = []
+        storage.put("addr_history", history)
+        self.assertTrue(os.path.getsize(storage.journal_path()) - size < 200)
+        self.assertEqual(history, WalletStorage(self.wallet_path).get("addr_history"))
+        storage.put("addr_history", None)
+        storage.put("addr_history", {"x": 1})
+        self.assertEqual({"x": 1}, WalletStorage(self.wallet_path).get("addr_history"))
+
+    def test_put_is_debounced(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.defer_commits = True
+        storage.put("a", "b")
+        storage.put("c", {"d": 1})
+        self.assertEqual(["c"], storage.dirty.keys())
+        storage.last_commit = 0
+        storage.commit_pending()
+        self.assertEqual({}, storage.dirty)
+        self.assertEqual({"d": 1}, WalletStorage(self.wallet_path).get("c"))
+
+    def test_put_commits_without_synchronizer(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.put("c", "d")
+        self.assertEqual("d", WalletStorage(self.wallet_path).get("c"))
+
+    def test_unsaved_keys_are_not_written(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("wallet_type", "standard", False)
+        del storage
+        self.assertFalse(os.path.exists(self.wallet_path))
+        self.assertFalse(WalletStorage(self.wallet_path).file_exists)
+
+    def test_put_copies_value(self):
+        storage = WalletStorage(self.wallet_path)
+        value = {"d": [1]}
+        storage.put("c", value)
+        value["d"].append(2)
+        self.assertEqual({"d": [1]}, storage.get("c"))
+
+    def test_flush_folds_journal_into_file(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.put("c", "d")
+        storage.flush()
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        self.assertEqual({"a": "b", "c": "d"}, json.loads(open(self.wallet_path).read()))
+
+    def test_journal_is_compacted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.MIN_JOURNAL_SIZE = 100
+        for i in range(10):
+            storage.put("a", "x" * i)
+            storage.commit()
+        self.assertTrue(os.path.getsize(storage.journal_path()) <= 100)
+        self.assertEqual("x" * 9, WalletStorage(self.wallet_path).get("a"))
+
+    def test_invalid_value_is_not_saved(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", object())
+        storage.put("b", "c")
+        storage.put("b", object())
+        storage.flush()
+        self.assertEqual(None, storage.get("a"))
+        self.assertEqual({"b": "c"}, json.loads(open(self.wallet_path).read()))
+
 
 class TestNewWallet(WalletTestCase):
 
@@ -107,3 +227,155 @@ class TestNewWallet(WalletTestCase):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+    def test_address_index(self):
+        account = self.wallet.default_account()
+        for i in range(3):
+            self.wallet.create_new_address(account, 0)
+            self.wallet.create_new_address(account, 1)
+        for for_change in [0, 1]:
+            for n, address in enumerate(account.get_addresses(for_change)):
+                self.assertTrue(self.wallet.is_mine(address))
+                self.assertEqual(('0', (for_change, n)), self.wallet.get_address_index(address))
+                self.assertEqual(bool(for_change), self.wallet.is_change(address))
+                self.assertEqual('0', self.wallet.get_account_from_address(address))
+        self.assertFalse(self.wallet.is_mine(self.import_key_address))
+        self.assertEqual(None, self.wallet.get_account_from_address(self.import_key_address))
+
+    def test_address_index_after_gap_limit_change(self):
+        account = self.wallet.default_account()
+        for i in range(5):
+            self.wallet.create_new_address(account, 0)
+        addresses = account.get_addresses(0)
+        self.wallet.gap_limit = len(addresses)
+        self.assertTrue(self.wallet.change_gap_limit(2))
+        self.assertTrue(self.wallet.is_mine(addresses[1]))
+        self.assertFalse(self.wallet.is_mine(addresses[2]))
+
+    def test_balance_cache_follows_history(self):
+        address = self.wallet.create_new_address(self.wallet.default_account(), 0)
+        other = self.import_key_address
+        h1, h2, h3 = 'aa'*32, 'bb'*32, 'cc'*32
+        tx1 = FakeTransaction([{'address': other, 'prevout_hash': '00'*32, 'prevout_n': 0}],
+                              [('address', address, 1000)])
+        tx2 = FakeTransaction([{'address': address, 'prevout_hash': h1, 'prevout_n': 0}],
+                              [('address', other, 900)])
+        tx3 = FakeTransaction([{'is_coinbase': True, 'address': None}],
+                              [('address', address, 500)])
+        self.wallet.network = None
+        self.wallet.stored_height = 120
+        self.assertEqual((0, 0, 0), self.wallet.get_balance())
+
+        self.wallet.receive_history_callback(address, [(h1, 100)])
+        self.wallet.receive_tx_callback(h1, tx1, 100)
+        self.assertEqual((1000, 0, 0), self.wallet.get_balance())
+        self.assertEqual((1000, 0, 0), self.wallet.get_addr_balance(address))
+        self.assertEqual([h1], [c['prevout_hash'] for c in self.wallet.get_spendable_coins()])
+
+        self.wallet.receive_history_callback(address, [(h1, 100), (h2, 0)])
+        self.wallet.receive_tx_callback(h2, tx2, 0)
+        self.assertEqual((1000, -1000, 0), self.wallet.get_balance())
+        self.assertEqual([], self.wallet.get_spendable_coins())
+        self.assertEqual(1000, self.wallet.get_addr_received(address))
+
+        self.wallet.receive_history_callback(address, [(h1, 100), (h2, 110), (h3, 110)])
+        self.wallet.receive_tx_callback(h3, tx3, 110)
+        self.assertEqual((0, 0, 500), self.wallet.get_balance())
+        self.assertEqual([], self.wallet.get_spendable_coins())
+        # coinbase maturity only depends on the local height
+        self.wallet.stored_height = 110 + COINBASE_MATURITY
+        self.assertEqual((500, 0, 0), self.wallet.get_balance())
+        self.assertEqual([h3], [c['prevout_hash'] for c in self.wallet.get_spendable_coins()])
+
+        self.wallet.receive_history_callback(address, [(h1, 100), (h2, 110)])
+        self.assertEqual((0, 0, 0), self.wallet.get_balance())
+        self.assertEqual((0, 0, 0), self.wallet.get_addr_balance(address))
+
+    def test_coin_index_follows_history(self):
+        address = self.wallet.create_new_address(self.wallet.default_account(), 0)
+        h1, h2 = 'aa'*32, 'bb'*32
+        tx1 = FakeTransaction([{'address': self.import_key_address, 'prevout_hash': '00'*32, 'prevout_n': 0}],
+                              [('address', address, 1000)])
+        tx2 = FakeTransaction([{'is_coinbase': True, 'address': None}],
+                              [('address', address, 500)])
+        self.wallet.network = None
+        self.wallet.stored_height = 120
+        self.wallet.receive_history_callback(address, [(h1, 100)])
+        self.wallet.receive_tx_callback(h1, tx1, 100)
+        index = self.wallet.get_coin_index()
+        self.assertEqual([h1], [c['prevout_hash'] for c in index.coins])
+        self.assertTrue(index is self.wallet.get_coin_index())
+        self.assertFalse(index is self.wallet.get_coin_index([address]))
+
+        self.wallet.receive_history_callback(address, [(h1, 100), (h2, 110)])
+        self.wallet.receive_tx_callback(h2, tx2, 110)
+        self.assertEqual([h1], [c['prevout_hash'] for c in self.wallet.get_coin_index().coins])
+        self.wallet.stored_height = 110 + COINBASE_MATURITY
+        self.assertEqual([h1, h2], [c['prevout_hash'] for c in self.wallet.get_coin_index().coins])
+        self.wallet.set_frozen_state([address], True)
+        self.assertEqual(0, len(self.wallet.get_coin_index()))
+
+
+class TestImportedAccount(unittest.TestCase):
+
+    def test_index_follows_add_and_remove(self):
+        account = ImportedAccount({'imported': {}})
+        account.add('b', None, None, None)
+        account.add('a', None, None, None)
+        self.assertEqual((0, 0), account.get_address_index('a'))
+        self.assertEqual((0, 1), account.get_address_index('b'))
+        account.remove('a')
+        self.assertEqual(None, account.get_address_index('a'))
+        self.assertEqual((0, 0), account.get_address_index('b'))
+
+
+class FakeGapWallet(object):
+    gap_limit = 5
+    gap_limit_for_change = 3
+
+    def __init__(self):
+        self.used = set()
+        self.added = []
+
+    def address_is_old(self, address):
+        return address in self.used
+
+    def add_address(self, address):
+        self.added.append(address)
+
+
+class TestBIP32Account(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBIP32Account, self).setUp()
+        self.xpubs = [bip32_root(seed)[1] for seed in ['seed one', 'seed two']]
+
+    def reference_pubkey(self, xpub, for_change, n):
+        xpub = bip32_public_derivation(xpub, "", "/%d/%d" % (for_change, n))
+        return deserialize_xkey(xpub)[4].encode('hex')
+
+    def test_derive_range(self):
+        account = BIP32_Account({'xpub': self.xpubs[0]})
+        pubkeys = account.derive_range(1, 3, 4)
+        self.assertEqual([self.reference_pubkey(self.xpubs[0], 1, n) for n in range(3, 7)], pubkeys)
+        self.assertEqual(pubkeys[1], account.derive_pubkeys(1, 4))
+        self.assertEqual(pubkeys[1], BIP32_Account.derive_pubkey_from_xpub(self.xpubs[0], 1, 4))
+
+    def test_multisig_derive_range(self):
+        account = Multisig_Account({'xpubs': self.xpubs, 'm': 2})
+        pubkeys = account.derive_range(0, 0, 3)
+        self.assertEqual([account.derive_pubkeys(0, n) for n in range(3)], pubkeys)
+        self.assertEqual(self.reference_pubkey(self.xpubs[1], 0, 2), pubkeys[2][1])
+
+    def test_synchronize_fills_gap(self):
+        account = BIP32_Account({'xpub': self.xpubs[0]})
+        wallet = FakeGapWallet()
+        account.synchronize(wallet)
+        self.assertEqual(5, len(account.get_addresses(0)))
+        self.assertEqual(3, len(account.get_addresses(1)))
+        wallet.used.add(account.get_addresses(0)[1])
+        account.synchronize(wallet)
+        addresses = account.get_addresses(0)
+        self.assertEqual(7, len(addresses))
+        self.assertEqual(addresses, wallet.added[:5] + wallet.added[8:])
+        self.assertEqual((0, 6), account.get_address_index(addresses[6]))
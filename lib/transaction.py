@@ -423,58 +423,329 @@ def get_address_from_output_script(bytes):
 
 
 
-def parse_input(vds):
-    d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
-    prevout_n = vds.read_uint32()
-    scriptSig = vds.read_bytes(vds.read_compact_size())
-    d['scriptSig'] = scriptSig.encode('hex')
-    sequence = vds.read_uint32()
-    if prevout_hash == '00'*32:
-        d['is_coinbase'] = True
-    else:
-        d['is_coinbase'] = False
-        d['prevout_hash'] = prevout_hash
-        d['prevout_n'] = prevout_n
-        d['sequence'] = sequence
-        d['pubkeys'] = []
-        d['signatures'] = {}
-        d['address'] = None
-        if scriptSig:
-            parse_scriptSig(d, scriptSig)
-    return d
+def stream_at(buf, offset):
+    vds = BCDataStream()
+    vds.write(buf)
+    vds.seek_file(offset)
+    return vds
+
+
+class TxInput(object):
+    """Input of a deserialized transaction.
+
+    Behaves like a dict of the input fields, but keeps a reference to
+    the binary transaction and reads the fields from it the first time
+    one of them is accessed.  The scriptSig is only parsed when a
+    signature field is needed.
+    """
+
+    SCRIPT_KEYS = ('pubkeys', 'signatures', 'address', 'x_pubkeys', 'num_sig', 'redeemScript')
+    KEYS = ('prevout_hash', 'prevout_n', 'scriptSig', 'sequence', 'is_coinbase') + SCRIPT_KEYS
+
+    # state: 0 nothing parsed, 1 outpoint and scriptSig read, 2 scriptSig parsed
+    __slots__ = ('buf', 'offset', 'state', 'extra') + KEYS
+
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.offset = offset
+        self.state = 0
+        self.extra = None
+
+    def parse_outpoint(self):
+        vds = stream_at(self.buf, self.offset)
+        prevout_hash = hash_encode(vds.read_bytes(32))
+        prevout_n = vds.read_uint32()
+        self.scriptSig = vds.read_bytes(vds.read_compact_size()).encode('hex')
+        sequence = vds.read_uint32()
+        if prevout_hash == '00'*32:
+            self.is_coinbase = True
+        else:
+            self.is_coinbase = False
+            self.prevout_hash = prevout_hash
+            self.prevout_n = prevout_n
+            self.sequence = sequence
+        self.state = 1
+
+    def parse_script(self):
+        if self.state == 0:
+            self.parse_outpoint()
+        self.state = 2
+        if self.is_coinbase:
+            return
+        self.pubkeys = []
+        self.signatures = {}
+        self.address = None
+        if self.scriptSig:
+            parse_scriptSig(self, self.scriptSig.decode('hex'))
+
+    def parse(self, key):
+        if key in self.SCRIPT_KEYS:
+            if self.state < 2:
+                self.parse_script()
+        elif self.state == 0:
+            self.parse_outpoint()
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            self.parse(key)
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.KEYS:
+            self.parse(key)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
 
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-def parse_output(vds, i):
-    d = {}
-    d['value'] = vds.read_int64()
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
-    d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
-    d['scriptPubKey'] = scriptPubKey.encode('hex')
-    d['prevout_n'] = i
-    return d
+    def __contains__(self, key):
+        return self.get(key, self) is not self
 
+    def keys(self):
+        self.parse('address')
+        keys = [k for k in self.KEYS if hasattr(self, k)]
+        if self.extra:
+            keys += self.extra.keys()
+        return keys
 
-def deserialize(raw):
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class TxOutput(object):
+    """Output of a deserialized transaction.
+
+    Unpacks like the (type, address, value) tuples of Transaction.outputs
+    and can be indexed like the dict of its fields.  The script is only
+    decoded when the type or address is needed.
+    """
+
+    KEYS = ('value', 'type', 'address', 'scriptPubKey', 'prevout_n')
+
+    __slots__ = ('buf', 'offset', 'parsed') + KEYS
+
+    def __init__(self, buf, offset, n):
+        self.buf = buf
+        self.offset = offset
+        self.prevout_n = n
+        self.parsed = False
+
+    def parse(self):
+        vds = stream_at(self.buf, self.offset)
+        self.value = vds.read_int64()
+        script = vds.read_bytes(vds.read_compact_size())
+        try:
+            self.type, self.address = get_address_from_output_script(script)
+        except Exception:
+            # non-standard script with a truncated push
+            self.type, self.address = 'script', script
+        self.scriptPubKey = script.encode('hex')
+        self.parsed = True
+
+    def __getitem__(self, key):
+        if not self.parsed:
+            self.parse()
+        if type(key) is int:
+            return (self.type, self.address, self.value)[key]
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        return iter((self['type'], self['address'], self['value']))
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def as_dict(self):
+        return dict((k, self[k]) for k in self.KEYS)
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+def parse_transaction(buf):
+    """Deserialize a binary transaction.  Inputs and outputs are only
+    located here; their fields are read when accessed."""
     vds = BCDataStream()
-    vds.write(raw.decode('hex'))
+    vds.write(buf)
     d = {}
-    start = vds.read_cursor
     d['version'] = vds.read_int32()
     d['nTime'] = vds.read_uint32()
     n_vin = vds.read_compact_size()
-    d['inputs'] = list(parse_input(vds) for i in xrange(n_vin))
+    d['inputs'] = inputs = []
+    for i in xrange(n_vin):
+        inputs.append(TxInput(buf, vds.read_cursor))
+        vds.read_cursor += 36
+        n = vds.read_compact_size()
+        vds.read_cursor += n + 4
     n_vout = vds.read_compact_size()
-    d['outputs'] = list(parse_output(vds,i) for i in xrange(n_vout))
+    d['outputs'] = outputs = []
+    for i in xrange(n_vout):
+        outputs.append(TxOutput(buf, vds.read_cursor, i))
+        vds.read_cursor += 8
+        n = vds.read_compact_size()
+        vds.read_cursor += n
     d['lockTime'] = vds.read_uint32()
+    if vds.read_cursor > len(buf):
+        raise SerializationError("attempt to read past end of buffer")
     return d
 
 
+def deserialize(raw):
+    return parse_transaction(raw.decode('hex'))
+
+
 def push_script(x):
     return op_push(len(x)/2) + x
 
 
-class Transaction:
+def push_size(n):
+    return len(op_push(n))/2 + n
+
+
+def var_int_size(n):
+    return len(var_int(n))/2
+
+
+class TxSizeEstimator(object):
+    """Tracks len(tx.serialize(-1))/2 as inputs and outputs are added
+    and removed, without serializing.  Inputs are counted with the 0x48
+    bytes signature placeholders used by input_script(for_sig=-1).
+    """
+
+    def __init__(self, tx):
+        self.tx = tx
+        self.n_inputs = self.n_outputs = 0
+        self.inputs_size = self.outputs_size = 0
+        for txin in tx.inputs:
+            self.add_input(txin)
+        for output in tx.outputs:
+            self.add_output(output)
+
+    def input_size(self, txin):
+        p2sh = txin.get('redeemScript') is not None
+        num_sig = txin['num_sig'] if p2sh else 1
+        script = num_sig * push_size(0x48)
+        if not p2sh:
+            pubkey = txin['pubkeys'][0]
+            # without pubkey, the input carries 'fd' + addrtype + hash160
+            script += push_size(len(pubkey)/2 if pubkey is not None else 22)
+        else:
+            redeem_script = 3 + sum(push_size(len(k)/2) for k in txin['pubkeys'])
+            script += 1 + push_size(redeem_script)
+        # prevout, script, sequence
+        return 36 + var_int_size(script) + script + 4
+
+    def output_size(self, output):
+        output_type, addr, amount = output
+        if output_type == 'script':
+            script = len(addr)
+        else:
+            script = len(self.tx.pay_script(output_type, addr))/2
+        return 8 + var_int_size(script) + script
+
+    def add_input(self, txin):
+        self.n_inputs += 1
+        self.inputs_size += self.input_size(txin)
+
+    def remove_input(self, txin):
+        self.n_inputs -= 1
+        self.inputs_size -= self.input_size(txin)
+
+    def add_output(self, output):
+        self.n_outputs += 1
+        self.outputs_size += self.output_size(output)
+
+    def remove_output(self, output):
+        self.n_outputs -= 1
+        self.outputs_size -= self.output_size(output)
+
+    def size(self):
+        # version, time, input and output counts, lock time
+        return 4 + 4 + var_int_size(self.n_inputs) + self.inputs_size \
+            + var_int_size(self.n_outputs) + self.outputs_size + 4
+
+
+class SignatureHasher(object):
+    """Hashes signed by the inputs of a transaction.
+
+    The preimages of the inputs only differ by the script placed in the
+    input being signed, so the prevouts, the inputs with an empty script
+    and the outputs are serialized once, in binary, and the sha256 state
+    of the preimage prefix before input i is kept to be copied.
+    """
+
+    def __init__(self, tx):
+        self.tx = tx
+        inputs = tx.inputs
+        self.prevouts = [txin['prevout_hash'].decode('hex')[::-1] + struct.pack('<I', txin['prevout_n'])
+                         for txin in inputs]
+        self.empty_inputs = [prevout + '\x00\xff\xff\xff\xff' for prevout in self.prevouts]
+        tail = [var_int(len(tx.outputs)).decode('hex')]
+        for output_type, addr, amount in tx.outputs:
+            script = tx.pay_script(output_type, addr).decode('hex')
+            tail.append(struct.pack('<q', amount) + var_int(len(script)).decode('hex') + script)
+        tail.append(struct.pack('<I', 0))            # lock time
+        tail.append(struct.pack('<I', 1))            # hash type
+        self.tail = ''.join(tail)
+        h = hashlib.sha256(struct.pack('<iI', 1, tx.time) + var_int(len(inputs)).decode('hex'))
+        self.prefixes = []
+        for empty_input in self.empty_inputs:
+            self.prefixes.append(h.copy())
+            h.update(empty_input)
+
+    def input_data(self, i):
+        txin = self.tx.inputs[i]
+        script = self.tx.input_script(txin, i, i).decode('hex')
+        return self.prevouts[i] + var_int(len(script)).decode('hex') + script + '\xff\xff\xff\xff' \
+            + ''.join(self.empty_inputs[i+1:]) + self.tail
+
+    def get(self, i):
+        """Hash signed by input i"""
+        h = self.prefixes[i].copy()
+        h.update(self.input_data(i))
+        return hashlib.sha256(h.digest()).digest()
+
+
+class Transaction(object):
 
     def __str__(self):
         if self.raw is None:
@@ -484,33 +755,38 @@ class Transaction:
     def __init__(self, raw):
         self.raw = raw
         self.inputs = None
+        self.estimator = None
 
     def update(self, raw):
         self.raw = raw
         self.inputs = None
+        self.estimator = None
         self.deserialize()
 
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
         d = deserialize(raw)
+        hasher = SignatureHasher(self)
         for i, txin in enumerate(self.inputs):
             sigs1 = txin.get('signatures')
             sigs2 = d['inputs'][i].get('signatures')
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                for_sig = Hash(self.tx_for_sig(i).decode('hex'))
+                for_sig = hasher.get(i)
                 # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(sig.decode('hex'), order)
                 sig_string = ecdsa.util.sigencode_string(r, s, order)
                 pubkeys = txin.get('pubkeys')
                 compressed = True
+                backend = get_ec_backend()
                 for recid in range(4):
-                    public_key = MyVerifyingKey.from_signature(sig_string, recid, for_sig, curve = SECP256k1)
-                    pubkey = point_to_ser(public_key.pubkey.point, compressed).encode('hex')
+                    point = backend.recover_pubkey(sig_string, recid, for_sig)
+                    pubkey = point_to_ser(xy_to_point(point), compressed).encode('hex')
                     if pubkey in pubkeys:
-                        public_key.verify_digest(sig_string, for_sig, sigdecode = ecdsa.util.sigdecode_string)
+                        if not backend.verify_digest(point, sig_string, for_sig):
+                            raise Exception("Bad signature")
                         j = pubkeys.index(pubkey)
                         print_error("adding sig", i, j, pubkey, sig)
                         self.inputs[i]['signatures'][j] = sig
@@ -527,8 +803,9 @@ class Transaction:
             return
         d = deserialize(self.raw)
         self.inputs = d['inputs']
-        self.outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
+        self.outputs = d['outputs']
         self.locktime = d['lockTime']
+        self.time = d['nTime']
         return d
 
     @classmethod
@@ -691,6 +968,36 @@ class Transaction:
     def add_input(self, input):
         self.inputs.append(input)
         self.raw = None
+        if self.estimator:
+            self.estimator.add_input(input)
+
+    def remove_input(self, input):
+        self.inputs.remove(input)
+        self.raw = None
+        if self.estimator:
+            self.estimator.remove_input(input)
+
+    def add_output(self, output):
+        self.outputs.append(output)
+        self.raw = None
+        if self.estimator:
+            self.estimator.add_output(output)
+
+    def remove_output(self, output):
+        self.outputs.remove(output)
+        self.raw = None
+        if self.estimator:
+            self.estimator.remove_output(output)
+
+    def estimated_size(self):
+        '''Return the size of the signed transaction, as
+        len(self.serialize(-1))/2.  Inputs and outputs should be changed
+        through add_input(), add_output() and the remove methods; the
+        estimate is recomputed if the lists were modified directly.'''
+        e = self.estimator
+        if e is None or e.n_inputs != len(self.inputs) or e.n_outputs != len(self.outputs):
+            self.estimator = TxSizeEstimator(self)
+        return self.estimator.size()
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs)
@@ -735,6 +1042,7 @@ class Transaction:
         return out
 
     def sign(self, keypairs):
+        hasher = None
         for i, txin in enumerate(self.inputs):
             num = txin['num_sig']
             for x_pubkey in txin['x_pubkeys']:
@@ -742,25 +1050,27 @@ class Transaction:
                 if len(signatures) == num:
                     # txin is complete
                     break
-                if x_pubkey in keypairs.keys():
+                if x_pubkey in keypairs:
                     print_error("adding signature for", x_pubkey)
                     # add pubkey to txin
                     txin = self.inputs[i]
                     x_pubkeys = txin['x_pubkeys']
                     ii = x_pubkeys.index(x_pubkey)
                     sec = keypairs[x_pubkey]
-                    pubkey = public_key_from_private_key(sec)
+                    pkey = regenerate_key(sec)
+                    pubkey = pkey.get_public_key(is_compressed(sec))
                     txin['x_pubkeys'][ii] = pubkey
                     txin['pubkeys'][ii] = pubkey
                     self.inputs[i] = txin
                     # add signature
-                    for_sig = Hash(self.tx_for_sig(i).decode('hex'))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
+                    if hasher is None:
+                        hasher = SignatureHasher(self)
+                    for_sig = hasher.get(i)
+                    r, s = get_ec_backend().sign_digest(pkey.secret, for_sig)
+                    order = generator_secp256k1.order()
+                    sig = ecdsa.util.sigencode_der(r, s, order)
+                    point = pkey.pubkey.point
+                    assert get_ec_backend().verify_digest((point.x(), point.y()), ecdsa.util.sigencode_string(r, s, order), for_sig)
                     txin['signatures'][ii] = sig.encode('hex')
                     self.inputs[i] = txin
         print_error("is_complete", self.is_complete())
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2015 Thomas Voegtlin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import threading
+
+from bitcoin import Hash, hash_encode
+from util import print_error
+from simple_config import get_config
+
+
+def is_tx_hash(tx_hash):
+    '''Transaction hashes come from the servers and name the files of
+    the cache, so they must be checked before any file access.'''
+    return isinstance(tx_hash, basestring) and re.match('^[0-9a-f]{64}$', tx_hash) is not None
+
+
+class TxCache(object):
+    '''Raw transactions shared by all wallets, one file per txid.
+
+    Files are verified against their txid when read, so a damaged or
+    tampered entry is dropped rather than returned.  When the cache
+    grows over max_size bytes, the least recently used files (by
+    mtime, which get() refreshes) are removed.
+    '''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # total size of the files, computed on first put()
+        self.size = None
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+    def print_error(self, *msg):
+        print_error("[TxCache]", *msg)
+
+    def file_path(self, tx_hash):
+        return os.path.join(self.path, tx_hash)
+
+    def get(self, tx_hash):
+        '''Return the raw transaction as hex, or None.'''
+        if not is_tx_hash(tx_hash):
+            return None
+        path = self.file_path(tx_hash)
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except IOError:
+            return None
+        if hash_encode(Hash(raw)) != tx_hash:
+            self.print_error("removing corrupted entry", tx_hash)
+            self.remove(tx_hash)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return raw.encode('hex')
+
+    def put(self, tx_hash, raw):
+        '''Store a raw transaction given as hex.  Returns True if the
+        transaction is in the cache.'''
+        if not is_tx_hash(tx_hash):
+            self.print_error("invalid transaction hash", repr(tx_hash))
+            return False
+        path = self.file_path(tx_hash)
+        if os.path.exists(path):
+            return True
+        raw = raw.decode('hex')
+        if hash_encode(Hash(raw)) != tx_hash:
+            self.print_error("transaction does not match its hash", tx_hash)
+            return False
+        temp_path = "%s.tmp.%s.%s" % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(raw)
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            self.print_error("cannot write", tx_hash, e)
+            return False
+        with self.lock:
+            if self.size is None:
+                self.size = sum(map(lambda x: x[1], self.list_files()))
+            else:
+                self.size += len(raw)
+            if self.size > self.max_size:
+                self.evict()
+        return True
+
+    def remove(self, tx_hash):
+        if not is_tx_hash(tx_hash):
+            return
+        try:
+            os.remove(self.file_path(tx_hash))
+        except OSError:
+            pass
+
+    def list_files(self):
+        '''Returns (mtime, size, name) of the cached transactions.'''
+        out = []
+        for name in os.listdir(self.path):
+            if not is_tx_hash(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            out.append((st.st_mtime, st.st_size, name))
+        return out
+
+    def evict(self):
+        '''Remove the least recently used files until the cache is
+        back to 90% of its maximum size.'''
+        files = sorted(self.list_files())
+        self.size = sum(map(lambda x: x[1], files))
+        target = self.max_size * 9 / 10
+        n = 0
+        for mtime, size, name in files:
+            if self.size <= target:
+                break
+            self.remove(name)
+            self.size -= size
+            n += 1
+        self.print_error("evicted %d transactions" % n)
+
+
+tx_cache = None
+
+def get_tx_cache():
+    '''Returns the cache in the directory of the current config, or
+    None if it is disabled (tx_cache_size = 0, in megabytes).'''
+    global tx_cache
+    config = get_config()
+    if config is None or not config.path or not os.path.isdir(config.path):
+        return None
+    size = config.get('tx_cache_size', 100)
+    if not size:
+        return None
+    path = os.path.join(config.path, 'transactions')
+    if tx_cache is None or tx_cache.path != path:
+        tx_cache = TxCache(path, size * 1000000)
+    return tx_cache
@@ -6,6 +6,7 @@ from decimal import Decimal
 import urlparse
 import urllib
 import threading
+from collections import OrderedDict, deque
 
 def normalize_version(v):
     return [int(x) for x in re.sub(r'(\.0+)*$','', v).split(".")]
@@ -19,8 +20,8 @@ class InvalidPassword(Exception):
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
-        from transaction import Transaction
-        if isinstance(obj, Transaction):
+        from transaction import Transaction, TxInput, TxOutput
+        if isinstance(obj, (Transaction, TxInput, TxOutput)):
             return obj.as_dict()
         return super(MyEncoder, self).default(obj)
 
@@ -326,27 +327,65 @@ import ssl
 import traceback
 import time
 
+# bytes asked from the socket at once; a chunk of headers is ~320 KB
+SOCKET_READ_SIZE = 65536
+SOCKET_WRITE_SIZE = 65536
+
 class SocketPipe:
+    '''Newline-delimited JSON over a socket.
+
+    Data is read in large blocks.  The complete lines of a block are
+    split at once; only the incomplete last line is kept, in a
+    bytearray, so a large response is not copied again for each block
+    or each message.  Parsed messages wait in a deque.
+
+    With a timeout of 0, sending never blocks either: data the socket
+    does not take is kept in send_buffer, and the owner calls flush()
+    when select() reports the socket writable.'''
 
     def __init__(self, socket):
         self.socket = socket
-        self.message = ''
+        self.buffer = bytearray()
+        self.messages = deque()
+        self.send_buffer = bytearray()
+        self.send_lock = threading.Lock()
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
     def set_timeout(self, t):
         self.socket.settimeout(t)
+        self.nonblocking = (t == 0)
 
     def idle_time(self):
         return time.time() - self.recv_time
 
+    def feed(self, data):
+        '''Adds received data, and parses the complete messages'''
+        self.recv_time = time.time()
+        n = data.rfind('\n')
+        if n == -1:
+            self.buffer += data
+            return
+        if self.buffer:
+            lines = (str(self.buffer) + data[:n]).split('\n')
+            del self.buffer[:]
+        else:
+            lines = data[:n].split('\n')
+        self.buffer += data[n+1:]
+        for line in lines:
+            try:
+                j = json.loads(line)
+            except:
+                continue
+            if j is not None:
+                self.messages.append(j)
+
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response:
-                return response
+            if self.messages:
+                return self.messages.popleft()
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(SOCKET_READ_SIZE)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -367,16 +406,82 @@ class SocketPipe:
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
-            self.recv_time = time.time()
+            self.feed(data)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def get_all(self):
+        '''Returns the messages that can be read without blocking, or
+        None if the connection was closed.  The socket must be
+        non-blocking (set_timeout(0)); this is meant to be called when
+        select() reports it readable.'''
+        closed = not self.receive()
+        out = list(self.messages)
+        self.messages.clear()
+        if closed and not out:
+            return None
+        return out
+
+    def receive(self):
+        '''Reads until the socket would block.  Returns False if the
+        connection is closed.'''
+        while True:
+            try:
+                data = self.socket.recv(SOCKET_READ_SIZE)
+            except socket.timeout:
+                return True
+            except ssl.SSLError as e:
+                if e.errno in [ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE]:
+                    return True
+                print_error("pipe: SSL error", e)
+                return False
+            except socket.error, err:
+                if err.errno in [errno.EAGAIN, errno.EWOULDBLOCK, 10035]:
+                    return True
+                print_error("pipe: socket error", err)
+                return False
+            if not data:
+                return False
+            self.feed(data)
 
     def send(self, request):
         out = json.dumps(request) + '\n'
-        self._send(out)
+        self.send_data(out)
 
     def send_all(self, requests):
         out = ''.join(map(lambda x: json.dumps(x) + '\n', requests))
-        self._send(out)
+        self.send_data(out)
+
+    def send_data(self, out):
+        if not self.nonblocking:
+            self._send(out)
+            return
+        with self.send_lock:
+            self.send_buffer += out
+        self.flush()
+
+    def pending_output(self):
+        return len(self.send_buffer)
+
+    def flush(self):
+        '''Sends what the socket takes without blocking.  Raises
+        socket.error if the connection is broken.'''
+        with self.send_lock:
+            while self.send_buffer:
+                try:
+                    sent = self.socket.send(str(self.send_buffer[:SOCKET_WRITE_SIZE]))
+                except ssl.SSLError as e:
+                    if e.errno in [ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE]:
+                        return
+                    raise
+                except socket.error as e:
+                    if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK, 10035]:
+                        return
+                    raise
+                if not sent:
+                    return
+                del self.send_buffer[:sent]
 
     def _send(self, out):
         while out:
@@ -404,13 +509,71 @@ class SocketPipe:
 
 import Queue
 
+def socket_pair():
+    '''A pair of connected sockets'''
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    # Windows; the proxy settings may have replaced socket.socket
+    listener = socket._socketobject(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    a = socket._socketobject(socket.AF_INET, socket.SOCK_STREAM)
+    a.connect(listener.getsockname())
+    b, _ = listener.accept()
+    listener.close()
+    return a, b
+
+
+class SelectableQueue(Queue.Queue):
+    '''A queue that can be passed to select(): it is readable when an
+    item was put since the last call to clear_events().  Consumers call
+    clear_events() first, then take the items with get_nowait(), or
+    use get_all().'''
+
+    def __init__(self):
+        Queue.Queue.__init__(self)
+        self.r, self.w = socket_pair()
+        self.r.setblocking(False)
+        self.w.setblocking(False)
+
+    def fileno(self):
+        return self.r.fileno()
+
+    def _put(self, item):
+        Queue.Queue._put(self, item)
+        try:
+            self.w.send('\0')
+        except socket.error:
+            # the buffer is full, so the queue is readable anyway
+            pass
+
+    def clear_events(self):
+        try:
+            while self.r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def get_all(self):
+        self.clear_events()
+        out = []
+        while True:
+            try:
+                out.append(self.get_nowait())
+            except Queue.Empty:
+                return out
+
+
 class QueuePipe:
 
     def __init__(self, send_queue=None, get_queue=None):
-        self.send_queue = send_queue if send_queue else Queue.Queue()
-        self.get_queue = get_queue if get_queue else Queue.Queue()
+        self.send_queue = send_queue if send_queue else SelectableQueue()
+        self.get_queue = get_queue if get_queue else SelectableQueue()
         self.set_timeout(0.1)
 
+    def fileno(self):
+        return self.get_queue.fileno()
+
     def get(self):
         try:
             return self.get_queue.get(timeout=self.timeout)
@@ -418,6 +581,8 @@ class QueuePipe:
             raise timeout
 
     def get_all(self):
+        if isinstance(self.get_queue, SelectableQueue):
+            return self.get_queue.get_all()
         responses = []
         while True:
             try:
@@ -433,12 +598,44 @@ class QueuePipe:
     def send(self, request):
         self.send_queue.put(request)
 
+    def pending_output(self):
+        return 0
+
     def send_all(self, requests):
         for request in requests:
             self.send(request)
 
 
 
+class LRUCache(object):
+    '''Dictionary holding at most size entries; the least recently
+    used ones are dropped first.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.d = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.d.pop(key)
+            except KeyError:
+                return default
+            self.d[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.d.pop(key, None)
+            self.d[key] = value
+            if len(self.d) > self.size:
+                self.d.popitem(last=False)
+
+    def __len__(self):
+        return len(self.d)
+
+
 class StoreDict(dict):
 
     def __init__(self, config, name):
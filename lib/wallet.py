@@ -36,6 +36,9 @@ from account import *
 from version import *
 
 from transaction import Transaction
+from coinchooser import get_coin_chooser, CoinIndex
+from tx_cache import get_tx_cache, is_tx_hash
+from simple_config import get_config
 from plugins import run_hook
 import bitcoin
 from synchronizer import WalletSynchronizer
@@ -50,23 +53,54 @@ IMPORTED_ACCOUNT = '/x'
 
 
 class WalletStorage(object):
+    """Wallet file with an append-only journal.
+
+    put() marks keys dirty; commit() appends their values to the journal
+    as one JSON line per key.  For a dict value that stays a dict, only
+    its changed items are written, as [key, updates, deleted keys], so
+    that large values such as addr_history are not copied whole on each
+    commit.  While a synchronizer owns the storage
+    (defer_commits), put() commits at most every COMMIT_INTERVAL seconds
+    and the synchronizer commits the rest; otherwise put() commits at
+    once.  The journal is replayed over the JSON file on read, and
+    folded back into it by write() when it grows larger than the file
+    itself, or on flush().
+    """
+
+    COMMIT_INTERVAL = 1.0
+    MIN_JOURNAL_SIZE = 1 << 20
 
     def __init__(self, path):
         self.lock = threading.RLock()
         self.data = {}
         self.path = path
         self.file_exists = False
+        # key -> set of changed items of a dict value, or None if the
+        # whole value must be written
+        self.dirty = {}
+        self.last_commit = 0
+        self.file_size = 0
+        self.journal_size = 0
+        self.defer_commits = False
         print_error( "wallet path", self.path )
         if self.path:
             self.read(self.path)
 
+    def journal_path(self):
+        return self.path + '.journal'
+
     def read(self, path):
         """Read the contents of the wallet file."""
+        self.read_file()
+        self.read_journal()
+
+    def read_file(self):
         try:
             with open(self.path, "r") as f:
                 data = f.read()
         except IOError:
             return
+        self.file_size = len(data)
         try:
             self.data = json.loads(data)
         except:
@@ -92,12 +126,55 @@ class WalletStorage(object):
                 self.data[key] = value
         self.file_exists = True
 
+    def read_journal(self):
+        """Replay the journal over the data read from the wallet file.
+        A truncated last line, left by an interrupted commit, is cut off
+        so that the next commits are not appended after it."""
+        try:
+            with open(self.journal_path(), "rb") as f:
+                lines = f.readlines()
+        except IOError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line) if line.endswith('\n') else None
+            except ValueError:
+                entry = None
+            if entry is None:
+                print_error("dropping truncated journal entry")
+                self.truncate_journal()
+                break
+            key, value = entry[0], entry[1]
+            if len(entry) == 3:
+                d = self.data.get(key)
+                if not isinstance(d, dict):
+                    d = self.data[key] = {}
+                d.update(value)
+                for k in entry[2]:
+                    d.pop(k, None)
+            elif value is not None:
+                self.data[key] = value
+            else:
+                self.data.pop(key, None)
+            self.journal_size += len(line)
+        self.file_exists = True
+
+    def truncate_journal(self):
+        """Cut the journal after its last complete entry"""
+        try:
+            with open(self.journal_path(), "r+b") as f:
+                f.truncate(self.journal_size)
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError) as e:
+            print_error("cannot truncate journal", e)
+
     def get(self, key, default=None):
         with self.lock:
             v = self.data.get(key)
             if v is None:
                 v = default
-            else:
+            elif isinstance(v, (dict, list)):
                 v = copy.deepcopy(v)
             return v
 
@@ -109,30 +186,99 @@ class WalletStorage(object):
             print_error("json error: cannot save", key)
             return
         with self.lock:
+            old = self.data.get(key)
             if value is not None:
                 self.data[key] = copy.deepcopy(value)
             elif key in self.data:
                 self.data.pop(key)
-            if save:
+            self.mark_dirty(key, old, value)
+            if not save:
+                return
+            if self.defer_commits:
+                self.commit_pending()
+            else:
+                self.commit()
+
+    def mark_dirty(self, key, old, new):
+        if isinstance(old, dict) and isinstance(new, dict) and self.dirty.get(key, ()) is not None:
+            changed = self.dirty.setdefault(key, set())
+            missing = object()
+            changed.update(k for k, v in new.iteritems() if old.get(k, missing) != v)
+            changed.update(k for k in old if k not in new)
+        else:
+            self.dirty[key] = None
+
+    def commit_pending(self):
+        """Commit dirty keys unless the last commit was too recent."""
+        with self.lock:
+            if self.dirty and time.time() - self.last_commit >= self.COMMIT_INTERVAL:
+                self.commit()
+
+    def commit(self, compact=False):
+        """Append the dirty keys to the journal, or rewrite the wallet
+        file if compact is set or the journal has outgrown it."""
+        self.check_thread()
+        with self.lock:
+            if not self.dirty and not (compact and self.journal_size):
+                return
+            lines = []
+            for key, changed in sorted(self.dirty.items()):
+                value = self.data.get(key)
+                if changed is None or not isinstance(value, dict):
+                    entry = [key, value]
+                else:
+                    updates = dict((k, value[k]) for k in changed if k in value)
+                    entry = [key, updates, sorted(k for k in changed if k not in value)]
+                lines.append(json.dumps(entry) + '\n')
+            self.dirty = {}
+            self.last_commit = time.time()
+            s = ''.join(lines)
+            if compact or self.journal_size + len(s) > max(self.file_size, self.MIN_JOURNAL_SIZE):
                 self.write()
+                return
+            fd = os.open(self.journal_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+            with os.fdopen(fd, "a") as f:
+                f.write(s)
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_size += len(s)
+            self.file_exists = True
+
+    def flush(self):
+        """Commit pending changes and fold the journal into the
+        wallet file."""
+        self.commit(True)
+
+    def check_thread(self):
+        assert not threading.currentThread().isDaemon()
 
     def write(self):
-        assert not threading.currentThread().isDaemon()
-        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        s = json.dumps(self.data, indent=4, sort_keys=True)
-        with open(temp_path, "w") as f:
-            f.write(s)
-            f.flush()
-            os.fsync(f.fileno())
-        # perform atomic write on POSIX systems
-        try:
-            os.rename(temp_path, self.path)
-        except:
-            os.remove(self.path)
-            os.rename(temp_path, self.path)
-        if 'ANDROID_DATA' not in os.environ:
-            import stat
-            os.chmod(self.path,stat.S_IREAD | stat.S_IWRITE)
+        self.check_thread()
+        with self.lock:
+            temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+            s = json.dumps(self.data, indent=4, sort_keys=True)
+            with open(temp_path, "w") as f:
+                f.write(s)
+                f.flush()
+                os.fsync(f.fileno())
+            # perform atomic write on POSIX systems
+            try:
+                os.rename(temp_path, self.path)
+            except:
+                os.remove(self.path)
+                os.rename(temp_path, self.path)
+            if 'ANDROID_DATA' not in os.environ:
+                import stat
+                os.chmod(self.path,stat.S_IREAD | stat.S_IWRITE)
+            # the journal is now contained in the file; replaying it
+            # again after a crash here would be harmless
+            if os.path.exists(self.journal_path()):
+                os.remove(self.journal_path())
+            self.dirty = {}
+            self.last_commit = time.time()
+            self.file_size = len(s)
+            self.journal_size = 0
+            self.file_exists = True
 
 
 
@@ -157,6 +303,16 @@ class Abstract_Wallet(object):
         self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
         self.fee_per_kb            = int(storage.get('fee_per_kb', RECOMMENDED_FEE))
 
+        # Per-address utxos and balances derived from history, txi and txo,
+        # and the balance of the whole wallet.  Writers of those call
+        # invalidate_cache() once they are done.  Access with self.cache_lock.
+        self.cache_lock = threading.Lock()
+        self.addr_cache = {}
+        self.balance_cache = None
+        self.cache_generation = 0
+        # (key, CoinIndex) of the last get_coin_index() call
+        self.coin_index = None
+
         # This attribute is set when wallet.start_threads is called.
         self.synchronizer = None
 
@@ -198,7 +354,18 @@ class Abstract_Wallet(object):
         self.pruned_txo = self.storage.get('pruned_txo', {})
         tx_list = self.storage.get('transactions', {})
         self.transactions = {}
+        tx_cache = None
         for tx_hash, raw in tx_list.items():
+            if raw is None:
+                # saved as a reference to the transaction cache
+                if not is_tx_hash(tx_hash):
+                    print_error("invalid transaction hash", repr(tx_hash))
+                    continue
+                tx_cache = tx_cache or get_tx_cache()
+                raw = tx_cache.get(tx_hash) if tx_cache else None
+                if raw is None:
+                    print_error("transaction missing from cache", tx_hash)
+                    continue
             tx = Transaction(raw)
             self.transactions[tx_hash] = tx
             if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
@@ -207,10 +374,16 @@ class Abstract_Wallet(object):
 
     @profiler
     def save_transactions(self):
+        config = get_config()
+        tx_cache = get_tx_cache() if config and config.get('tx_cache_refs') else None
         with self.transaction_lock:
             tx = {}
             for k,v in self.transactions.items():
                 tx[k] = str(v)
+                # with tx_cache_refs, the wallet file only references
+                # the transactions that the cache holds
+                if tx_cache and tx_cache.put(k, tx[k]):
+                    tx[k] = None
             # Flush storage only with the last put
             self.storage.put('transactions', tx, False)
             self.storage.put('txi', self.txi, False)
@@ -226,6 +399,7 @@ class Abstract_Wallet(object):
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
+        self.invalidate_cache()
         self.storage.put('addr_history', self.history, True)
 
     @profiler
@@ -254,6 +428,7 @@ class Abstract_Wallet(object):
                     tx.deserialize()
                     self.add_transaction(tx_hash, tx, tx_height)
         if save:
+            self.invalidate_cache()
             self.storage.put('addr_history', self.history, True)
 
     # wizard action
@@ -313,7 +488,7 @@ class Abstract_Wallet(object):
     def is_imported(self, addr):
         account = self.accounts.get(IMPORTED_ACCOUNT)
         if account:
-            return addr in account.get_addresses(0)
+            return account.get_address_index(addr) is not None
         else:
             return False
 
@@ -340,6 +515,7 @@ class Abstract_Wallet(object):
         # force resynchronization, because we need to re-run add_transaction
         if address in self.history:
             self.history.pop(address)
+            self.invalidate_cache([address])
 
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -374,7 +550,7 @@ class Abstract_Wallet(object):
         return list(addr for acc in self.accounts for addr in self.get_account_addresses(acc, include_change))
 
     def is_mine(self, address):
-        return address in self.addresses(True)
+        return self.get_account_from_address(address) is not None
 
     def is_change(self, address):
         if not self.is_mine(address): return False
@@ -383,11 +559,10 @@ class Abstract_Wallet(object):
         return s[0] == 1
 
     def get_address_index(self, address):
-        for acc_id in self.accounts:
-            for for_change in [0,1]:
-                addresses = self.accounts[acc_id].get_addresses(for_change)
-                if address in addresses:
-                    return acc_id, (for_change, addresses.index(address))
+        for acc_id, account in self.accounts.items():
+            sequence = account.get_address_index(address)
+            if sequence is not None:
+                return acc_id, sequence
         raise Exception("Address not found", address)
 
     def get_private_key(self, address, password):
@@ -506,7 +681,6 @@ class Abstract_Wallet(object):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.addresses(True)
         is_relevant = False
         is_send = False
         is_pruned = False
@@ -514,7 +688,7 @@ class Abstract_Wallet(object):
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs:
             addr = item.get('address')
-            if addr in addresses:
+            if self.is_mine(addr):
                 is_send = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
@@ -534,7 +708,7 @@ class Abstract_Wallet(object):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -570,34 +744,69 @@ class Abstract_Wallet(object):
                 sent[txi] = height
         return received, sent
 
+    def invalidate_cache(self, addresses=None):
+        with self.cache_lock:
+            if addresses is None:
+                self.addr_cache = {}
+            else:
+                for addr in addresses:
+                    self.addr_cache.pop(addr, None)
+            self.balance_cache = None
+            self.cache_generation += 1
+
+    def get_addr_cache(self, address):
+        '''Returns (utxos, confirmed, unconfirmed, coinbase, received) for
+        address.  Coinbase outputs are left out of the two balances and
+        listed as (height, value), since their maturity depends on the
+        local height.'''
+        with self.cache_lock:
+            entry = self.addr_cache.get(address)
+            if entry is None:
+                received, sent = self.get_addr_io(address)
+                utxos = dict(received)
+                for txi in sent:
+                    utxos.pop(txi, None)
+                c = u = total = 0
+                coinbase = []
+                for txo, (tx_height, v, is_cb) in received.items():
+                    total += v
+                    if is_cb:
+                        coinbase.append((tx_height, v))
+                    elif tx_height > 0:
+                        c += v
+                    else:
+                        u += v
+                    if txo in sent:
+                        if sent[txo] > 0:
+                            c -= v
+                        else:
+                            u -= v
+                entry = utxos, c, u, coinbase, total
+                self.addr_cache[address] = entry
+            return entry
+
+    def add_coinbase_balance(self, c, u, coinbase):
+        x = 0
+        for tx_height, v in coinbase:
+            if tx_height + COINBASE_MATURITY > self.get_local_height():
+                x += v
+            elif tx_height > 0:
+                c += v
+            else:
+                u += v
+        return c, u, x
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        return coins
+        return dict(self.get_addr_cache(address)[0])
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
-        return sum([v for height, v, is_cb in received.values()])
+        return self.get_addr_cache(address)[4]
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-        return c, u, x
+        utxos, c, u, coinbase, total = self.get_addr_cache(address)
+        return self.add_coinbase_balance(c, u, coinbase)
 
 
     def get_spendable_coins(self, domain = None, exclude_frozen = True):
@@ -607,7 +816,7 @@ class Abstract_Wallet(object):
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
         for addr in domain:
-            c = self.get_addr_utxo(addr)
+            c = self.get_addr_cache(addr)[0]
             for txo, v in c.items():
                 tx_height, value, is_cb = v
                 if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
@@ -623,13 +832,25 @@ class Abstract_Wallet(object):
                 }
                 coins.append((tx_height, output))
                 continue
-        # sort by age
-        if coins:
-            coins = sorted(coins)
-            if coins[-1][0] != 0:
-                while coins[0][0] == 0:
-                    coins = coins[1:] + [ coins[0] ]
-        return [value for height, value in coins]
+        # sort by age, unconfirmed coins last
+        coins.sort(key=itemgetter(0))
+        confirmed = [value for height, value in coins if height != 0]
+        unconfirmed = [value for height, value in coins if height == 0]
+        return confirmed + unconfirmed
+
+    def get_coin_index(self, domain=None, exclude_frozen=True):
+        '''CoinIndex of get_spendable_coins(domain, exclude_frozen).  It
+        is kept until the coins, the frozen addresses or the local height
+        change, so sending again does not sort the coins again.'''
+        key = (None if domain is None else frozenset(domain), exclude_frozen,
+               frozenset(self.frozen_addresses) if exclude_frozen else None,
+               self.cache_generation, self.get_local_height())
+        cached = self.coin_index
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        index = CoinIndex(self.get_spendable_coins(domain, exclude_frozen))
+        self.coin_index = key, index
+        return index
 
     def get_account_name(self, k):
         return self.labels.get(k, self.accounts[k].get_name(k))
@@ -652,8 +873,8 @@ class Abstract_Wallet(object):
 
     def get_account_from_address(self, addr):
         "Returns the account that contains this address, or None"
-        for acc_id in self.accounts:    # similar to get_address_index but simpler
-            if addr in self.get_account_addresses(acc_id):
+        for acc_id, account in self.accounts.items():
+            if account.get_address_index(addr) is not None:
                 return acc_id
         return None
 
@@ -665,14 +886,26 @@ class Abstract_Wallet(object):
 
     def get_balance(self, domain=None):
         if domain is None:
-            domain = self.addresses(True)
-        cc = uu = xx = 0
+            balance = self.balance_cache
+            if balance is None:
+                generation = self.cache_generation
+                balance = self.sum_balances(self.addresses(True))
+                with self.cache_lock:
+                    # do not keep it if it was invalidated meanwhile
+                    if generation == self.cache_generation:
+                        self.balance_cache = balance
+            return self.add_coinbase_balance(*balance)
+        return self.add_coinbase_balance(*self.sum_balances(domain))
+
+    def sum_balances(self, domain):
+        cc = uu = 0
+        coinbase = []
         for addr in domain:
-            c, u, x = self.get_addr_balance(addr)
+            utxos, c, u, cb, total = self.get_addr_cache(addr)
             cc += c
             uu += u
-            xx += x
-        return cc, uu, xx
+            coinbase += cb
+        return cc, uu, coinbase
 
     def set_fee(self, fee, save = True):
         self.fee_per_kb = fee
@@ -700,6 +933,7 @@ class Abstract_Wallet(object):
 
     def add_transaction(self, tx_hash, tx, tx_height):
         is_coinbase = tx.inputs[0].get('is_coinbase') == True
+        touched = set()
         with self.transaction_lock:
             # add inputs
             self.txi[tx_hash] = d = {}
@@ -746,12 +980,17 @@ class Abstract_Wallet(object):
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    touched.add(addr)
             # save
             self.transactions[tx_hash] = tx
+            touched.update(self.txi[tx_hash].keys())
+            touched.update(d.keys())
+        self.invalidate_cache(touched)
 
     def remove_transaction(self, tx_hash, tx_height):
         with self.transaction_lock:
             print_error("removing tx from history", tx_hash)
+            touched = set(self.txi.get(tx_hash, {}).keys()) | set(self.txo.get(tx_hash, {}).keys())
             #tx = self.transactions.pop(tx_hash)
             for ser, hh in self.pruned_txo.items():
                 if hh == tx_hash:
@@ -766,12 +1005,14 @@ class Abstract_Wallet(object):
                         if prev_hash == tx_hash:
                             l.remove(item)
                             self.pruned_txo[ser] = next_tx
+                            touched.add(addr)
                     if l == []:
                         dd.pop(addr)
                     else:
                         dd[addr] = l
             self.txi.pop(tx_hash)
             self.txo.pop(tx_hash)
+        self.invalidate_cache(touched)
 
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
@@ -792,6 +1033,7 @@ class Abstract_Wallet(object):
                         self.remove_transaction(tx_hash, height)
 
             self.history[addr] = hist
+            self.invalidate_cache([addr])
             self.storage.put('addr_history', self.history, True)
 
         for tx_hash, tx_height in hist:
@@ -878,45 +1120,23 @@ class Abstract_Wallet(object):
         return tx.get_fee()
 
     def estimated_fee(self, tx):
-        estimated_size = len(tx.serialize(-1))/2
+        estimated_size = tx.estimated_size()
         fee = int(self.fee_per_kb*estimated_size/1000.)
         if fee < MIN_RELAY_TX_FEE: # and tx.requires_fee(self):
             fee = MIN_RELAY_TX_FEE
         return fee
 
-    def make_unsigned_transaction(self, coins, outputs, fixed_fee=None, change_addr=None):
+    def make_unsigned_transaction(self, coins, outputs, fixed_fee=None, change_addr=None, coin_chooser='oldest'):
         # check outputs
         for type, data, value in outputs:
             if type == 'address':
                 assert is_address(data), "Address " + data + " is invalid!"
 
         amount = sum(map(lambda x:x[2], outputs))
-        total = fee = 0
         inputs = []
         tx = Transaction.from_io(inputs, outputs)
-        # add old inputs first
-        for item in coins:
-            v = item.get('value')
-            total += v
-            self.add_input_info(item)
-            tx.add_input(item)
-            # no need to estimate fee until we have reached desired amount
-            if total < amount:
-                continue
-            fee = fixed_fee if fixed_fee is not None else self.estimated_fee(tx)
-            if total >= amount + fee:
-                break
-        else:
-            raise NotEnoughFunds()
-        # remove unneeded inputs
-        for item in sorted(tx.inputs, key=itemgetter('value')):
-            v = item.get('value')
-            if total - v >= amount + fee:
-                tx.inputs.remove(item)
-                total -= v
-                fee = fixed_fee if fixed_fee is not None else self.estimated_fee(tx)
-            else:
-                break
+        chooser = get_coin_chooser(coin_chooser)(self, fixed_fee)
+        total, fee = chooser.make_tx(tx, coins, amount)
         print_error("using %d inputs"%len(tx.inputs))
 
         # change address
@@ -939,17 +1159,18 @@ class Abstract_Wallet(object):
         # if change is above dust threshold, add a change output.
         change_amount = total - ( amount + fee )
         if fixed_fee is not None and change_amount > 0:
-            tx.outputs.append(('address', change_addr, change_amount))
+            tx.add_output(('address', change_addr, change_amount))
         elif change_amount > DUST_THRESHOLD:
-            tx.outputs.append(('address', change_addr, change_amount))
+            change_output = ('address', change_addr, change_amount)
+            tx.add_output(change_output)
             # recompute fee including change output
             fee = self.estimated_fee(tx)
             # remove change output
-            tx.outputs.pop()
+            tx.remove_output(change_output)
             # if change is still above dust threshold, re-add change output.
             change_amount = total - ( amount + fee )
             if change_amount > DUST_THRESHOLD:
-                tx.outputs.append(('address', change_addr, change_amount))
+                tx.add_output(('address', change_addr, change_amount))
                 print_error('change', change_amount)
             else:
                 print_error('not keeping dust', change_amount)
@@ -962,9 +1183,9 @@ class Abstract_Wallet(object):
         run_hook('make_unsigned_transaction', tx)
         return tx
 
-    def mktx(self, outputs, password, fee=None, change_addr=None, domain=None):
-        coins = self.get_spendable_coins(domain)
-        tx = self.make_unsigned_transaction(coins, outputs, fee, change_addr)
+    def mktx(self, outputs, password, fee=None, change_addr=None, domain=None, coin_chooser='oldest'):
+        coins = self.get_coin_index(domain)
+        tx = self.make_unsigned_transaction(coins, outputs, fee, change_addr, coin_chooser)
         self.sign_transaction(tx, password)
         return tx
 
@@ -1090,6 +1311,7 @@ class Abstract_Wallet(object):
             self.verifier.start()
             self.set_verifier(self.verifier)
             self.synchronizer = WalletSynchronizer(self, network)
+            self.storage.defer_commits = True
             network.jobs.append(self.synchronizer.main_loop)
         else:
             self.verifier = None
@@ -1100,7 +1322,9 @@ class Abstract_Wallet(object):
             self.verifier.stop()
             self.network.jobs.remove(self.synchronizer.main_loop)
             self.synchronizer = None
+            self.storage.defer_commits = False
             self.storage.put('stored_height', self.get_local_height(), True)
+        self.storage.flush()
 
     def restore(self, cb):
         pass
@@ -1116,6 +1340,8 @@ class Abstract_Wallet(object):
         d = {}
         for k, v in self.accounts.items():
             d[k] = v.dump()
+        # the set of addresses may have changed
+        self.invalidate_cache([])
         self.storage.put('accounts', d, True)
 
     def can_import(self):
@@ -1404,6 +1630,7 @@ class Deterministic_Wallet(Abstract_Wallet):
                 n = len(addresses) - k + value
                 account.receiving_pubkeys = account.receiving_pubkeys[0:n]
                 account.receiving_addresses = account.receiving_addresses[0:n]
+                account.build_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit, True)
             self.save_accounts()
@@ -1639,6 +1866,11 @@ class BIP32_HD_Wallet(BIP32_Wallet):
                 return next_id, (0,0)
         return BIP32_Wallet.get_address_index(self, address)
 
+    def is_mine(self, address):
+        if self.next_account and address == self.next_account[3]:
+            return True
+        return BIP32_Wallet.is_mine(self, address)
+
     def num_accounts(self):
         keys = []
         for k, v in self.accounts.items():
@@ -44,7 +44,7 @@ class ElectrumWebSocket(WebSocket):
 
 
 
-class WsClientThread(daemon.ClientThread):
+class WsClientThread(util.DaemonThread):
 
     def __init__(self, config, server):
         util.DaemonThread.__init__(self)
@@ -56,6 +56,9 @@ class WsClientThread(daemon.ClientThread):
         self.sub_ws = defaultdict(list)
         self.counter = 0
 
+    def send_response(self, response):
+        self.response_queue.put(response)
+
     def make_request(self, request_id):
         # read json file
         rdir = self.config.get('requests_dir')